@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Benchmark the import stages on synthetic SOSI files of growing size.
+
+For each size a file is written by make_sosi.py (kept in --data-dir, so
+later runs reuse it), then three stages are timed separately:
+
+    parse     sosi_cache.read_batches, SOSI file to FeatureBatch
+    geometry  sosi_geom_helper.feature_batch_mesh_data, to MeshData
+    build     per object mesh arrays (MeshData.groups + concatenation); run
+              in Blender (blender -b -P) the Blender meshes are created too
+
+The results are written to a JSON file with the commit they were measured
+on. Pass an earlier result file to --compare to see the changes.
+
+    python3 benchmarks/bench_import.py [--sizes 1000,10000,100000,1000000] [--compare old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SCRIPT_DIR), 'scripts'))
+sys.path.insert(0, SCRIPT_DIR)
+
+import make_sosi  # noqa: E402
+from sosi_files_importer import sosi_cache  # noqa: E402
+from sosi_files_importer import sosi_geom_helper as sogeohlp  # noqa: E402
+
+try:
+    import bpy
+    from sosi_files_importer import blender_helper as bldhlp
+except ImportError:
+    bpy = None
+
+DEFAULT_SIZES = '1000,10000,100000,1000000'
+STAGES = ('parse', 'geometry', 'build')
+
+
+def build_meshes(mdatas):
+    """Collect the geometry per object name and assemble the mesh arrays,
+    creating (and removing again) the Blender meshes when run in Blender.
+    Return the number of objects."""
+    objects = {}
+    for mdata in mdatas:
+        for name, coords, edges, loops, face_sizes in mdata.groups():
+            objects.setdefault(name, []).append((coords, edges, loops, face_sizes))
+    for name, parts in objects.items():
+        if bpy is not None:
+            batch = bldhlp.MeshBatch(None, name)
+            for part in parts:
+                batch.add_arrays(*part)
+            mesh = bldhlp.Mesh.from_arrays(name, *batch.arrays())
+            bpy.data.meshes.remove(mesh)
+            continue
+        nverts = np.cumsum([0] + [len(p[0]) for p in parts[:-1]])
+        np.concatenate([p[0] for p in parts])
+        np.concatenate([p[1] + n for p, n in zip(parts, nverts)])
+        np.concatenate([p[2] + n for p, n in zip(parts, nverts)])
+        sizes = np.concatenate([p[3] for p in parts])
+        np.cumsum(sizes) - sizes
+    return len(objects)
+
+
+def run_case(path, engine, repeat):
+    """Best time of each stage over repeat runs, and the data sizes."""
+    best = dict.fromkeys(STAGES, float('inf'))
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        batches = sosi_cache.read_batches(path, engine)
+        t1 = time.perf_counter()
+        mdatas = [sogeohlp.feature_batch_mesh_data(b) for b in batches]
+        t2 = time.perf_counter()
+        nobjects = build_meshes(mdatas)
+        t3 = time.perf_counter()
+        for stage, dt in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2)):
+            best[stage] = min(best[stage], dt)
+    return dict(
+        elements=sum(len(b) for b in batches),
+        vertices=sum(len(m.coords) for m in mdatas),
+        faces=sum(len(m.loop_starts) - 1 for m in mdatas),
+        objects=nobjects,
+        file_bytes=os.path.getsize(path),
+        seconds=best,
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = {r['features']: r for r in json.load(f)['results']}
+    print('\nChange against {} (commit {}):'.format(old_path, old and next(iter(old.values())).get('commit')))
+    for r in results:
+        o = old.get(r['features'])
+        if o is None:
+            continue
+        print('{:>9} '.format(r['features']) + ' '.join(
+            '{:>9}'.format('{:+.0%}'.format(r['seconds'][s] / o['seconds'][s] - 1) if o['seconds'][s] else '-')
+            for s in STAGES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated feature counts')
+    parser.add_argument('--engine', default='NATIVE', choices=('NATIVE', 'GDAL'))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the best is reported')
+    parser.add_argument('--holes', type=int, default=1, help='holes per surface')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'sosi_bench'),
+                        help='where the generated files are kept')
+    parser.add_argument('--output', help='JSON result file (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier JSON result file to compare with')
+    args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else None)
+
+    commit = git_commit()
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    print('{:>9} {:>9} {:>10} '.format('features', 'elements', 'vertices')
+          + ' '.join('{:>9}'.format(s + ' [s]') for s in STAGES))
+    for size in (int(float(s)) for s in args.sizes.split(',')):
+        path = os.path.join(args.data_dir, 'bench_{}_h{}.sos'.format(size, args.holes))
+        if not os.path.exists(path):
+            make_sosi.write_sosi(path, make_sosi.split_features(size), holes=args.holes)
+        res = dict(features=size, commit=commit, **run_case(path, args.engine, args.repeat))
+        results.append(res)
+        print('{:>9} {:>9} {:>10} '.format(size, res['elements'], res['vertices'])
+              + ' '.join('{:>9.3f}'.format(res['seconds'][s]) for s in STAGES))
+
+    output = args.output or os.path.join(SCRIPT_DIR, 'results', '{}.json'.format(commit or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(dict(commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'), engine=args.engine,
+                       python=platform.python_version(), numpy=np.__version__,
+                       blender=bpy.app.version_string if bpy is not None else None,
+                       machine=platform.machine(), results=results), f, indent=2)
+    print('Results written to', output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Benchmark the triangulation of large FLATE surfaces with many holes.
+
+Each case is a wavy exterior ring with a grid of round holes, triangulated
+by sosi_triangulate.polygon_triangulate. The triangle count and the summed
+triangle area are checked against the polygon, then the timings are printed.
+
+    python3 benchmarks/bench_triangulate.py [--repeat N]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SCRIPT_DIR), 'scripts'))
+
+from sosi_files_importer import sosi_triangulate as sotri  # noqa: E402
+
+# (exterior vertices, holes, vertices per hole)
+CASES = [
+    (1000, 10, 16),
+    (10000, 50, 32),
+    (10000, 400, 16),
+    (50000, 100, 64),
+    (100000, 25, 256),
+]
+
+
+def make_surface(nverts, nholes, hole_verts):
+    """Return coords, ring offsets and the exact area of a test surface."""
+    ang = np.linspace(0, 2 * np.pi, nverts, endpoint=False)
+    r = 1000.0 + 40.0 * np.sin(ang * 53)
+    rings = [np.column_stack((r * np.cos(ang), r * np.sin(ang)))]
+    g = int(np.ceil(np.sqrt(nholes)))
+    hr = 0.4 * 1200.0 / g
+    a = np.linspace(0, 2 * np.pi, hole_verts, endpoint=False)
+    for k in range(nholes):
+        cx = -600.0 + 1200.0 * (k // g + 0.5) / g
+        cy = -600.0 + 1200.0 * (k % g + 0.5) / g
+        rings.append(np.column_stack((cx + hr * np.cos(a), cy + hr * np.sin(a))))
+    coords = np.column_stack((np.concatenate(rings), np.zeros(sum(len(x) for x in rings))))
+    offsets = np.concatenate(([0], np.cumsum([len(x) for x in rings])))
+    area = abs(sotri._signed_area(rings[0])) - sum(abs(sotri._signed_area(x)) for x in rings[1:])
+    return coords, offsets, area
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best is reported')
+    args = parser.parse_args()
+
+    print('{:>9} {:>6} {:>9} {:>10} {:>9}'.format('vertices', 'holes', 'triangles', 'best [s]', 'tris/s'))
+    for nverts, nholes, hole_verts in CASES:
+        coords, offsets, area = make_surface(nverts, nholes, hole_verts)
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            tris = sotri.polygon_triangulate(coords, offsets)
+            dt = time.perf_counter() - t0
+            best = dt if best is None else min(best, dt)
+        p = coords[tris]
+        tri_area = 0.5 * ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1])
+                          - (p[:, 1, 1] - p[:, 0, 1]) * (p[:, 2, 0] - p[:, 0, 0]))
+        expected = len(coords) + 2 * nholes - 2
+        if len(tris) != expected or tri_area.min() < 0 or not np.isclose(tri_area.sum(), area):
+            print('  FAILED: {} triangles (expected {}), area {} (expected {})'.format(
+                len(tris), expected, tri_area.sum(), area))
+        print('{:>9} {:>6} {:>9} {:>10.3f} {:>9.0f}'.format(
+            len(coords), nholes, len(tris), best, len(tris) / best))
+
+
+if __name__ == '__main__':
+    main()
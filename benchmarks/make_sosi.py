@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Write synthetic SOSI files for benchmarks and tests.
+
+The features are laid out on a grid of cells, one feature per cell: points
+(PUNKT), random walk curves (KURVE), three point arcs (BUEP) and star
+shaped surfaces (FLATE) with round holes. The rings of a surface are
+written as KURVE elements referred to by the FLATE, as in real SOSI data,
+so a surface adds 1 + holes curves to the file.
+
+    python3 benchmarks/make_sosi.py out.sos --features 100000 [--holes 2] [--charset UTF-8]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SCRIPT_DIR), 'scripts'))
+
+from sosi_files_importer.sosi_native_parser import CHARSETS, SosiCodec  # noqa: E402
+
+# Share of each element type when only --features is given
+DEFAULT_MIX = (('PUNKT', 0.25), ('KURVE', 0.35), ('BUEP', 0.1), ('FLATE', 0.3))
+
+# South west corner of the data [m] (UTM 32) and the cell size of one feature
+ORIGIN_E, ORIGIN_N = 580000.0, 6630000.0
+CELL_SIZE = 50.0
+
+OBJTYPES = {
+    'PUNKT': ('Terrengpunkt', 'Høydepunkt'),
+    'KURVE': ('Høydekurve', 'Veikant', 'Takkant'),
+    'BUEP': ('Bue',),
+    'FLATE': ('Bygning', 'Åpent område'),
+    'RING': ('Avgrensning',),
+}
+
+
+def split_features(features):
+    """Element counts for a total number of features, see DEFAULT_MIX."""
+    counts = {name: int(features * share) for name, share in DEFAULT_MIX}
+    counts['KURVE'] += features - sum(counts.values())
+    return counts
+
+
+def circle(center, radius, n, jitter=0.0, rng=None):
+    a = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    r = radius * (1.0 - jitter * rng.random(n)) if jitter else np.full(n, radius)
+    return center + np.column_stack((r * np.cos(a), r * np.sin(a)))
+
+
+# Attribute values written with --attributes, picked by serial number
+MEDIUMS = ('T', 'L', 'U', 'B')
+DATAFANGSTMETODER = ('fot', 'dig', 'gen', 'sat')
+
+
+class SosiWriter:
+    """Writes the elements of one SOSI file, numbering them from 1."""
+
+    def __init__(self, f, codec, enhet, heights, attributes=False):
+        self.f = f
+        self.codec = codec
+        self.enhet = enhet
+        self.heights = heights
+        self.attributes = attributes
+        self.serial = 0
+
+    def write(self, text):
+        self.f.write(self.codec.encode(text))
+
+    def attribute_text(self):
+        """Typical attributes of map data: text, date, group and code values."""
+        s = self.serial
+        return ('..MEDIUM {}\n..DATAFANGSTDATO {}\n..KVALITET\n...DATAFANGSTMETODE {}\n'
+                '...NØYAKTIGHET {}\n..KOMM 0{}\n'.format(MEDIUMS[s % len(MEDIUMS)], 20000101 + s % 28,
+                                                       DATAFANGSTMETODER[s % 3], 10 + s % 90, 301 + s % 5))
+
+    def element(self, name, objtype, coords, extra=''):
+        """Write an element with coords in meters, return its serial number."""
+        self.serial += 1
+        if self.attributes:
+            extra += self.attribute_text()
+        units = np.rint(coords / self.enhet).astype(np.int64)
+        if self.heights:
+            z = np.rint(np.full(len(units), 100.0 + self.serial % 50) / self.enhet).astype(np.int64)
+            units = np.column_stack((units[:, 1], units[:, 0], z))
+            fmt, kw = '%d %d %d\n', 'NØH'
+        else:
+            units = units[:, ::-1]
+            fmt, kw = '%d %d\n', 'NØ'
+        self.write('.{} {}:\n..OBJTYPE {}\n{}..{}\n'.format(name, self.serial, objtype, extra, kw)
+                   + (fmt * len(units)) % tuple(units.ravel().tolist()))
+        return self.serial
+
+
+def write_sosi(path, counts, verts=20, holes=1, hole_verts=8, enhet=0.01, charset='UTF-8',
+               heights=False, seed=0, attributes=False):
+    """Write a SOSI file with counts (dict element name -> number) features,
+    with attributes also MEDIUM, DATAFANGSTDATO, KVALITET and KOMM.
+
+    Return the number of elements written (surfaces count with their rings).
+    """
+    rng = np.random.default_rng(seed)
+    codec = SosiCodec(charset)
+    total = sum(counts.values())
+    ncols = max(int(np.ceil(np.sqrt(total))), 1)
+    nrows = max(int(np.ceil(total / ncols)), 1)
+    cells = np.arange(total)
+    rng.shuffle(cells)
+    centers = np.column_stack((ORIGIN_E + CELL_SIZE * (cells % ncols + 0.5),
+                               ORIGIN_N + CELL_SIZE * (cells // ncols + 0.5)))
+    r = 0.4 * CELL_SIZE
+    with open(path, 'wb') as f:
+        w = SosiWriter(f, codec, enhet, heights, attributes)
+        w.write('.HODE\n..TEGNSETT {}\n..TRANSPAR\n...KOORDSYS 22\n...ORIGO-NØ 0 0\n'
+                '...ENHET {}\n..OMRÅDE\n...MIN-NØ {:.0f} {:.0f}\n...MAX-NØ {:.0f} {:.0f}\n'
+                '..SOSI-VERSJON 4.5\n'.format(charset, enhet, ORIGIN_N, ORIGIN_E,
+                                              ORIGIN_N + nrows * CELL_SIZE, ORIGIN_E + ncols * CELL_SIZE))
+        k = 0
+        for name in ('PUNKT', 'KURVE', 'BUEP', 'FLATE'):
+            types = OBJTYPES[name]
+            for i in range(counts.get(name, 0)):
+                c = centers[k]
+                k += 1
+                objtype = types[i % len(types)]
+                if name == 'PUNKT':
+                    w.element(name, objtype, c[None, :])
+                elif name == 'KURVE':
+                    steps = rng.normal(0.0, r / max(verts, 2), (verts, 2))
+                    pts = c + np.cumsum(steps, axis=0).clip(-r, r)
+                    w.element(name, objtype, pts, '..HØYDE {}\n'.format(i % 20 * 5))
+                elif name == 'BUEP':
+                    a = rng.uniform(0, 2 * np.pi) + np.array([0.0, 0.8, 1.6])
+                    w.element(name, objtype, c + r * np.column_stack((np.cos(a), np.sin(a))))
+                else:
+                    ring = circle(c, r, verts, 0.3, rng)
+                    rings = [w.element('KURVE', OBJTYPES['RING'][0], np.vstack([ring, ring[:1]]))]
+                    hr = min(0.15 * r, 0.8 * np.pi * 0.35 * r / max(holes, 1))
+                    for h in range(holes):
+                        a = 2 * np.pi * h / holes
+                        hc = c + 0.35 * r * np.array([np.cos(a), np.sin(a)])
+                        ring = circle(hc, hr, hole_verts)
+                        rings.append(w.element('KURVE', OBJTYPES['RING'][0], np.vstack([ring, ring[:1]])))
+                    ref = ':{}'.format(rings[0]) + ''.join(' (:{})'.format(s) for s in rings[1:])
+                    w.element(name, objtype, (c + np.array([0.0, -0.7 * r]))[None, :],
+                              '..REF {}\n'.format(ref))
+        w.write('.SLUTT\n')
+    return w.serial
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='SOSI file to write')
+    parser.add_argument('--features', type=int, default=1000,
+                        help='number of features, split over the element types (default 1000)')
+    for name, opt in (('PUNKT', 'points'), ('KURVE', 'curves'), ('BUEP', 'arcs'), ('FLATE', 'surfaces')):
+        parser.add_argument('--' + opt, type=int, help='number of {} elements, overrides --features'.format(name))
+    parser.add_argument('--verts', type=int, default=20, help='vertices per curve and exterior ring')
+    parser.add_argument('--holes', type=int, default=1, help='holes per surface')
+    parser.add_argument('--hole-verts', type=int, default=8, help='vertices per hole')
+    parser.add_argument('--enhet', type=float, default=0.01, help='coordinate unit ..ENHET [m]')
+    parser.add_argument('--charset', default='UTF-8', choices=sorted(CHARSETS), help='..TEGNSETT')
+    parser.add_argument('--heights', action='store_true', help='write 3D coordinates (..NØH)')
+    parser.add_argument('--attributes', action='store_true',
+                        help='write MEDIUM, DATAFANGSTDATO, KVALITET and KOMM attributes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    counts = split_features(args.features)
+    for name, opt in (('PUNKT', 'points'), ('KURVE', 'curves'), ('BUEP', 'arcs'), ('FLATE', 'surfaces')):
+        if getattr(args, opt) is not None:
+            counts[name] = getattr(args, opt)
+    n = write_sosi(args.path, counts, args.verts, args.holes, args.hole_verts, args.enhet,
+                   args.charset, args.heights, args.seed, args.attributes)
+    print('{}: {} elements ({})'.format(args.path, n, ', '.join('{} {}'.format(v, k) for k, v in counts.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -39,9 +39,6 @@ bl_info = {
 
 import os
 
-from bpy_extras.io_utils import ImportHelper
-from bpy.props import CollectionProperty, StringProperty
-
 # Determine if the code is running from within Blender
 env_blender = True
 try:
@@ -59,7 +56,10 @@ print('INFO: Blender environment:', env_blender)
 #else:
 #	from . import blender_temporary as bldtmp
 
-from . import sosi_importer as sosimp
+# Worker processes parsing files (see sosi_parallel) import the package
+# without bpy, only the bpy-free modules are used there
+if env_blender:
+    from . import sosi_importer as sosimp
 #from . import blender_temporary as bldtmp
 
 # -----------------------------------------------------------------------------
@@ -68,31 +68,18 @@ def main(file_paths=None):
     sosimp.do_imports(file_paths)
 
 # -----------------------------------------------------------------------------
-
-class ImportSOSIData(bpy.types.Operator, ImportHelper):
-    """Import SOSI data using GDAL."""
-    bl_idname = "import_files.sosi_data"
-    bl_label = "Import SOSI Data"
-
-    filename_ext = ".sos"
-    filter_glob: StringProperty(default="*.sos", options={'HIDDEN'})
-    files: CollectionProperty(type=bpy.types.PropertyGroup)
-
-    def execute(self, context):
-        directory = os.path.dirname(self.filepath)
-        paths = [os.path.join(directory, f.name) for f in self.files] or [self.filepath]
-        main(paths)
-        return {'FINISHED'}
-        
-# -----------------------------------------------------------------------------
     
 def menu_func_import(self, context):
-    self.layout.operator(ImportSOSIData.bl_idname)
+    self.layout.operator(sosimp.ImportSOSIData.bl_idname)
+    self.layout.operator(sosimp.LoadSOSITiles.bl_idname)
 
 # -----------------------------------------------------------------------------
 
 def register():
-    bpy.utils.register_class(ImportSOSIData)
+    bpy.utils.register_class(sosimp.ImportSOSIData)
+    bpy.utils.register_class(sosimp.ClearSOSICache)
+    bpy.utils.register_class(sosimp.LoadSOSITiles)
+    bpy.utils.register_class(sosimp.ShowSOSITiles)
     bpy.utils.register_class(sosimp.SosiImporterPreferences)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
 
@@ -100,7 +87,10 @@ def register():
 
 def unregister():
     bpy.utils.unregister_class(sosimp.SosiImporterPreferences)
-    bpy.utils.unregister_class(ImportSOSIData)
+    bpy.utils.unregister_class(sosimp.ShowSOSITiles)
+    bpy.utils.unregister_class(sosimp.LoadSOSITiles)
+    bpy.utils.unregister_class(sosimp.ClearSOSICache)
+    bpy.utils.unregister_class(sosimp.ImportSOSIData)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
 
 # -----------------------------------------------------------------------------
@@ -24,8 +24,13 @@ This file is part of SosiImporter, an addon to import SOSI files containing
 3D model data into Blender.
 """
 
+import json
 import bpy
-import bmesh
+from mathutils import Matrix, Vector
+import numpy as np
+from . import sosi_datahelper as sodhlp
+from . import sosi_geom_helper as sogeohlp
+from . import sosi_stats as sostats
 
 # -----------------------------------------------------------------------------
 
@@ -120,45 +125,765 @@ class Mesh():
         
         mesh.from_pydata(coords, edges, faces)
         mesh.update()
-        
+
         return obj
-        
-# -----------------------------------------------------------------------------
-        
-class Collection():
 
     @staticmethod
-    def get_or_create_linked_collection_by_name(coll_name):
-        coll = bpy.data.collections.get(coll_name)
-        # if it doesn't exist create it
-        if coll is None:
-            coll = bpy.data.collections.new(coll_name)
-            #print('Main collection created')
-            bpy.context.scene.collection.children.link(coll )
-        return coll
+    def from_arrays(me_name, coords, edges, loops, loop_starts):
+        """Create a mesh in one go using bulk foreach_set calls.
+
+        Keyword arguments:
+        me_name -- new mesh name
+        coords -- (n, 3) float array of vertex coordinates
+        edges -- (m, 2) int array of vertex indices
+        loops -- flat int array of polygon vertex indices
+        loop_starts -- int array, index into loops for the start of each polygon
+        """
+        mesh = bpy.data.meshes.new(me_name)
+
+        mesh.vertices.add(len(coords))
+        mesh.vertices.foreach_set("co", np.ascontiguousarray(coords, dtype=np.float32).ravel())
+        mesh.edges.add(len(edges))
+        mesh.edges.foreach_set("vertices", np.ascontiguousarray(edges, dtype=np.int32).ravel())
+        mesh.loops.add(len(loops))
+        mesh.loops.foreach_set("vertex_index", np.ascontiguousarray(loops, dtype=np.int32))
+        mesh.polygons.add(len(loop_starts))
+        mesh.polygons.foreach_set("loop_start", np.ascontiguousarray(loop_starts, dtype=np.int32))
+
+        mesh.update(calc_edges=True)
+        return mesh
 
     @staticmethod
-    def get_or_create_linked_subcollection_by_name(mcoll_name, scoll_name):
-        mcoll = Collection.get_or_create_linked_collection_by_name(mcoll_name)
-        scoll = bpy.data.collections.get(scoll_name)
-        if scoll is None:
-            scoll = bpy.data.collections.new(scoll_name)
-            #print('Sub collection created')
-            mcoll.children.link(scoll)
-        return scoll
+    def to_arrays(mesh):
+        """Read back the geometry of a mesh as arrays (see from_arrays)."""
+        coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", coords)
+        edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edges)
+        loops = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loops)
+        loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        return coords.reshape(-1, 3), edges.reshape(-1, 2), loops, loop_starts
 
     @staticmethod
-    def get_or_create_linked_sub2collection_by_name(mcoll_name, scoll1_name, scoll2_name):
-        scoll1 = Collection.get_or_create_linked_subcollection_by_name(mcoll_name, scoll1_name)
-        scoll2 = bpy.data.collections.get(scoll2_name)
-        if scoll2 is None:
-            scoll2 = bpy.data.collections.new(scoll2_name)
-            #print('Sub2 collection created')
-            scoll1.children.link(scoll2)
-        return scoll2
-    
+    def append_arrays(mesh, coords, edges, loops, loop_starts):
+        """Append geometry to mesh in place, the arrays being as from_arrays
+        takes them with indices of the vertices appended. Return the number
+        of vertices, edges and faces mesh had before."""
+        nverts, nedges = len(mesh.vertices), len(mesh.edges)
+        nloops, nfaces = len(mesh.loops), len(mesh.polygons)
+        mesh.vertices.add(len(coords))
+        Mesh.foreach_set_tail(mesh.vertices, "co", nverts, np.asarray(coords, dtype=np.float32), 3)
+        mesh.edges.add(len(edges))
+        Mesh.foreach_set_tail(mesh.edges, "vertices", nedges, np.asarray(edges, dtype=np.int32) + nverts, 2)
+        mesh.loops.add(len(loops))
+        Mesh.foreach_set_tail(mesh.loops, "vertex_index", nloops, np.asarray(loops, dtype=np.int32) + nverts)
+        mesh.polygons.add(len(loop_starts))
+        Mesh.foreach_set_tail(mesh.polygons, "loop_start", nfaces,
+                              np.asarray(loop_starts, dtype=np.int32) + nloops)
+        mesh.update(calc_edges=True)
+        return nverts, nedges, nfaces
+
+    @staticmethod
+    def foreach_set_tail(seq, prop, start, values, width=1, fill=None):
+        """Set prop of the elements start: of seq (mesh vertices, attribute
+        data, ...) to values, width numbers per element. bpy only sets whole
+        collections, so the values of the elements before start are read
+        back first, or set to fill if given."""
+        if start == len(seq):
+            return
+        full = np.empty(len(seq) * width, dtype=values.dtype)
+        if fill is not None:
+            full[:start * width] = fill
+        elif start:
+            seq.foreach_get(prop, full)
+        full[start * width:] = values.ravel()
+        seq.foreach_set(prop, full)
+
+    # Point attributes holding the feature key (see sosi_datahelper.feature_keys)
+    # of each vertex, so a re-import can tell which features changed
+    SERIAL_ATTR = "sosi_serial"
+    HASH_ATTR = "sosi_hash"
+
+    @staticmethod
+    def set_feature_keys(mesh, keys, start=0):
+        """Store the int64 feature key of each vertex of mesh from vertex
+        start on. The vertices before keep theirs, or get -1 if mesh had none."""
+        keys = np.asarray(keys, dtype=np.int64)
+        for name, values in ((Mesh.SERIAL_ATTR, keys >> 32), (Mesh.HASH_ATTR, keys & 0xFFFFFFFF)):
+            attr = mesh.attributes.get(name)
+            fill = None
+            if attr is None:
+                attr = mesh.attributes.new(name, 'INT', 'POINT')
+                fill = -1
+            Mesh.foreach_set_tail(attr.data, "value", start, values.astype(np.uint32).view(np.int32),
+                                  fill=fill)
+
+    @staticmethod
+    def feature_keys(mesh):
+        """Return the feature key of each vertex of mesh, -1 where unknown
+        (meshes from older imports or welded ones)."""
+        serials = mesh.attributes.get(Mesh.SERIAL_ATTR)
+        hashes = mesh.attributes.get(Mesh.HASH_ATTR)
+        if serials is None or hashes is None or serials.domain != 'POINT' or hashes.domain != 'POINT':
+            return np.full(len(mesh.vertices), -1, dtype=np.int64)
+        s = np.empty(len(mesh.vertices), dtype=np.int32)
+        serials.data.foreach_get("value", s)
+        h = np.empty(len(mesh.vertices), dtype=np.int32)
+        hashes.data.foreach_get("value", h)
+        return (s.astype(np.int64) << 32) | h.view(np.uint32).astype(np.int64)
+
+    # Mesh custom property with the kind ('INT', 'FLOAT' or 'CODE') of each
+    # SOSI attribute stored on the mesh, as JSON
+    ATTRS_PROP = "sosi_attrs"
+    # Suffix of the name of an attribute stored on more than one domain, for
+    # the domains after the first one (a mesh mixing surfaces, lines and points)
+    ATTR_DOMAIN_SUFFIX = {'EDGE': "_edges", 'POINT': "_points"}
+
+    @staticmethod
+    def attr_domains(nverts, edges, loops, loop_starts):
+        """Return the domains the SOSI attributes of a mesh made of these
+        arrays go to, as [(domain, vertex of each element)]: faces (their
+        first corner) for surfaces, edges (their first vertex) for lines
+        and points for loose vertices, each domain the mesh has features of."""
+        loops = np.asarray(loops)
+        edges = np.asarray(edges).reshape(-1, 2)
+        on_face = np.zeros(nverts, dtype=bool)
+        on_face[loops] = True
+        on_edge = np.zeros(nverts, dtype=bool)
+        on_edge[edges] = True
+        domains = []
+        if len(loop_starts):
+            domains.append(('FACE', loops[np.asarray(loop_starts)]))
+        if len(edges) and not on_face[edges[:, 0]].all():
+            domains.append(('EDGE', edges[:, 0]))
+        if not (on_face | on_edge).all():
+            domains.append(('POINT', np.arange(nverts)))
+        return domains
+
+    @staticmethod
+    def attr_kind(values, coded):
+        return ('CODE' if coded else 'INT') if values.dtype == np.int32 else 'FLOAT'
+
+    @staticmethod
+    def set_sosi_attrs(mesh, rows, attrs, loops, loop_starts):
+        """Store SOSI attributes on mesh (made from loops and loop_starts),
+        vertex i having the values values[rows[i]] of attrs, {name: (values,
+        coded)}, see MeshBatch.vertex_attrs, on the domains of attr_domains.
+        Text attributes are codes, see ImportRegistry.attr_codes."""
+        if not attrs:
+            return
+        edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edges)
+        domains = Mesh.attr_domains(len(rows), edges, loops, loop_starts)
+        kinds = {}
+        for name, (values, coded) in attrs.items():
+            kinds[name] = Mesh.attr_kind(values, coded)
+            if kinds[name] == 'FLOAT':
+                values = values.astype(np.float32)
+            for i, (domain, index) in enumerate(domains):
+                attr = mesh.attributes.new(name + (Mesh.ATTR_DOMAIN_SUFFIX[domain] if i else ""),
+                                           'INT' if kinds[name] != 'FLOAT' else 'FLOAT', domain)
+                attr.data.foreach_set("value", values[rows[index]])
+        mesh[Mesh.ATTRS_PROP] = json.dumps(kinds)
+
+    @staticmethod
+    def sosi_attr_domains(mesh):
+        """Return the domains of the SOSI attributes of mesh, in the order
+        of attr_domains, or None if it has none."""
+        kinds = json.loads(mesh.get(Mesh.ATTRS_PROP, "{}"))
+        if not kinds:
+            return None
+        name = next(iter(kinds))
+        attrs = [mesh.attributes.get(name + suffix) for suffix in [""] + list(Mesh.ATTR_DOMAIN_SUFFIX.values())]
+        return [attr.domain for attr in attrs if attr is not None]
+
+    @staticmethod
+    def append_sosi_attrs(mesh, rows, attrs, elements):
+        """Store the SOSI attributes of the elements append_arrays added to
+        mesh, elements being {domain: (first new element, vertex of each new
+        element)} for the domains of mesh (see sosi_attr_domains) and rows
+        and attrs those of the new vertices as set_sosi_attrs takes them.
+        Attributes new to mesh get no value on the old elements, nor the
+        attributes of mesh not in attrs on the new ones."""
+        kinds = json.loads(mesh.get(Mesh.ATTRS_PROP, "{}"))
+        new_kinds = {name: Mesh.attr_kind(values, coded) for name, (values, coded) in attrs.items()}
+        for name in dict.fromkeys(list(kinds) + list(new_kinds)):
+            kind = kinds.get(name, new_kinds.get(name))
+            missing = np.float32(np.nan) if kind == 'FLOAT' else np.int32(sodhlp.ATTR_INT_MISSING)
+            for i, (domain, (start, index)) in enumerate(elements.items()):
+                attr_name = name + (Mesh.ATTR_DOMAIN_SUFFIX[domain] if i else "")
+                if name in attrs:
+                    values = attrs[name][0][rows[index]].astype(missing.dtype)
+                else:
+                    values = np.full(len(index), missing)
+                attr = mesh.attributes.get(attr_name)
+                fill = None
+                if attr is None:
+                    attr = mesh.attributes.new(attr_name, 'INT' if kind != 'FLOAT' else 'FLOAT', domain)
+                    fill = missing
+                Mesh.foreach_set_tail(attr.data, "value", start, values, fill=fill)
+        kinds.update(new_kinds)
+        mesh[Mesh.ATTRS_PROP] = json.dumps(kinds)
+
+    @staticmethod
+    def sosi_attrs(mesh, edges, loops, loop_starts):
+        """Return the SOSI attributes of mesh as (rows, attrs) like
+        set_sosi_attrs takes them, or None if it has none, edges, loops and
+        loop_starts being the mesh arrays (see to_arrays). Vertices not used
+        by an element with a value get none."""
+        kinds = json.loads(mesh.get(Mesh.ATTRS_PROP, "{}"))
+        if not kinds:
+            return None
+        nverts = len(mesh.vertices)
+        res = {}
+        for name, kind in kinds.items():
+            if kind == 'FLOAT':
+                vertex_values = np.full(nverts, np.nan, dtype=np.float32)
+            else:
+                vertex_values = np.full(nverts, sodhlp.ATTR_INT_MISSING, dtype=np.int32)
+            for suffix in [""] + list(Mesh.ATTR_DOMAIN_SUFFIX.values()):
+                attr = mesh.attributes.get(name + suffix)
+                if attr is None:
+                    continue
+                values = np.empty(len(attr.data), dtype=vertex_values.dtype)
+                attr.data.foreach_get("value", values)
+                if attr.domain == 'FACE':
+                    vertex_values[loops] = np.repeat(values, np.diff(np.append(loop_starts, len(loops))))
+                elif attr.domain == 'EDGE':
+                    vertex_values[edges] = values[:, None]
+                else:
+                    vertex_values[:] = values
+            res[name] = (vertex_values, kind == 'CODE')
+        return np.arange(nverts), res
+
 # -----------------------------------------------------------------------------
-    
+
+class MeshBatch():
+    """Geometry collected for one target object, built into a single mesh."""
+
+    def __init__(self, coll, ob_name):
+        self.coll = coll
+        self.ob_name = ob_name
+        self.coords = []
+        self.edges = []
+        self.loops = []
+        self.loop_totals = []
+        self.keys = []
+        # (vertices of each feature, SOSI attributes of each feature) of each
+        # piece added, see vertex_attrs
+        self.attrs = []
+        self.num_verts = 0
+        # Bytes held by the arrays collected
+        self.nbytes = 0
+        # Vertices of the existing object to keep, None keeps all
+        self.keep = None
+
+    def add_arrays(self, coords, edges, loops, loop_totals, keys=None, attrs=None,
+                   feature_verts=None):
+        """Add geometry given as arrays: loops holds the vertex indices of all
+        faces, face f having loop_totals[f] corners (see MeshData.groups).
+        keys are the feature keys of the vertices (see MeshData.vertex_keys)
+        or None. The vertices are those of features having feature_verts[f]
+        vertices each (default one feature), attrs their SOSI attributes as
+        {name: (value of each feature, coded)}."""
+        self.coords.append(np.asarray(coords, dtype=np.float64).reshape(-1, 3))
+        self.keys.append(keys)
+        if feature_verts is None:
+            feature_verts = [len(self.coords[-1])]
+        self.attrs.append((np.asarray(feature_verts, dtype=np.int64), attrs or {}))
+        self.nbytes += (self.coords[-1].nbytes + (0 if keys is None else keys.nbytes)
+                        + self.attrs[-1][0].nbytes
+                        + sum(values.nbytes for values, coded in self.attrs[-1][1].values()))
+        if len(edges):
+            self.edges.append(np.asarray(edges, dtype=np.int32).reshape(-1, 2) + self.num_verts)
+            self.nbytes += self.edges[-1].nbytes
+        if len(loops):
+            self.loops.append(np.asarray(loops, dtype=np.int32) + self.num_verts)
+            self.loop_totals.append(np.asarray(loop_totals, dtype=np.int32))
+            self.nbytes += self.loops[-1].nbytes + self.loop_totals[-1].nbytes
+        self.num_verts += len(self.coords[-1])
+
+    def release(self):
+        """Drop the collected pieces, once arrays() and the vertex keys and
+        attributes have been taken from them."""
+        for pieces in (self.coords, self.edges, self.loops, self.loop_totals, self.keys, self.attrs):
+            pieces.clear()
+        self.num_verts = 0
+        self.nbytes = 0
+
+    def arrays(self, base=None, weld_tolerance=None, return_inverse=False):
+        """Return the collected geometry as arrays (see Mesh.from_arrays).
+
+        base -- optional arrays of an existing mesh the batch is appended to
+        weld_tolerance -- if set, merge vertices closer than this distance
+        return_inverse -- also return the welded index of each vertex (None
+        when not welding)
+        """
+        if base is None:
+            base = (np.zeros((0, 3)), np.zeros((0, 2), dtype=np.int32),
+                    np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        base_coords, base_edges, base_loops, base_loop_starts = base
+        nbase = len(base_coords)
+        coords = np.concatenate([base_coords] + self.coords)
+        edges = np.concatenate([base_edges] + [e + nbase for e in self.edges])
+        loops = np.concatenate([base_loops] + [l + nbase for l in self.loops])
+        loop_totals = np.concatenate([np.zeros(0, dtype=np.int32)] + self.loop_totals)
+        loop_starts = np.concatenate((base_loop_starts,
+                                      len(base_loops) + np.cumsum(loop_totals) - loop_totals))
+        if weld_tolerance:
+            with sostats.timer("welding"):
+                return sogeohlp.weld_mesh_arrays(coords, edges, loops, loop_starts, weld_tolerance,
+                                                 return_inverse)
+        return (coords, edges, loops, loop_starts) + ((None,) if return_inverse else ())
+
+    def vertex_keys(self, base_keys=None):
+        """Return the feature keys of the vertices of arrays(base) (not
+        welded), -1 where unknown, or None when no vertex has a key."""
+        if base_keys is not None and (base_keys == -1).all():
+            base_keys = None
+        if base_keys is None and all(keys is None for keys in self.keys):
+            return None
+        pieces = [np.zeros(0, dtype=np.int64) if base_keys is None else base_keys]
+        for coords, keys in zip(self.coords, self.keys):
+            pieces.append(np.full(len(coords), -1, dtype=np.int64) if keys is None else keys)
+        return np.concatenate(pieces)
+
+    def vertex_attrs(self, base=None, nbase=0, encode=None):
+        """Return the SOSI attributes of the vertices of arrays(base) (not
+        welded) as (rows, {name: (values, coded)}), vertex i having the
+        values values[rows[i]], one row per feature added. base holds those
+        of the nbase vertices of the existing mesh the same way (see
+        Mesh.sosi_attrs). Where the pieces disagree on the type of an
+        attribute, integers become floats, or when some piece has text,
+        numbers become text through encode(name, values) (see
+        ImportRegistry.encode_attr). Return None without attributes."""
+        if base is None:
+            base = (np.zeros(nbase, dtype=np.int64), {})
+        base_rows, base_attrs = base
+        nrows = max((len(values) for values, coded in base_attrs.values()), default=1)
+        parts = [(nrows, base_attrs)] + [(len(counts), attrs) for counts, attrs in self.attrs]
+        names = {name: None for count, attrs in parts for name in attrs}
+        if not names:
+            return None
+        row_starts = np.cumsum([0] + [count for count, attrs in parts])
+        rows = np.concatenate([base_rows] + [np.repeat(np.arange(len(counts)) + start, counts)
+                                             for (counts, attrs), start in zip(self.attrs, row_starts[1:])])
+        res = {}
+        for name in names:
+            have = [attrs[name] for count, attrs in parts if name in attrs]
+            coded = any(c for values, c in have)
+            floats = not coded and any(values.dtype != np.int32 for values, c in have)
+            columns = []
+            for count, attrs in parts:
+                if name not in attrs:
+                    columns.append(np.full(count, np.nan) if floats
+                                   else np.full(count, sodhlp.ATTR_INT_MISSING, dtype=np.int32))
+                    continue
+                values, part_coded = attrs[name]
+                if coded and not part_coded:
+                    values = encode(name, values)
+                elif floats and values.dtype == np.int32:
+                    values = np.where(values == sodhlp.ATTR_INT_MISSING, np.nan, values)
+                columns.append(values)
+            res[name] = (np.concatenate(columns), coded)
+        return rows, res
+
+# -----------------------------------------------------------------------------
+
+class MeshBatchBuilder():
+    """Collect geometry per file collection and object name while parsing,
+    then create each Blender mesh object once using bulk array operations.
+    With feature_keys the meshes store the feature key of each vertex
+    (see Mesh.set_feature_keys), objects that have them keep them anyway.
+    """
+
+    def __init__(self, registry=None, weld_tolerance=None, feature_keys=True):
+        self.batches = {}
+        self.registry = registry if registry is not None else ImportRegistry()
+        self.weld_tolerance = weld_tolerance
+        self.feature_keys = feature_keys
+        # Bytes held by the batches not built yet
+        self.nbytes = 0
+
+    def batch(self, coll, ob_name):
+        key = (coll.name, ob_name)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = MeshBatch(coll, ob_name)
+            self.batches[key] = batch
+        return batch
+
+    def add_mesh_data(self, coll, mdata, start=0, stop=None):
+        """Add the features start:stop (default all) of a sosi_datahelper.MeshData,
+        all features of an object at once."""
+        for name, idx in mdata.name_groups(start, stop).items():
+            batch = self.batch(coll, name)
+            nbytes = batch.nbytes
+            keys = mdata.vertex_keys(idx) if self.feature_keys else None
+            batch.add_arrays(*mdata.group(idx), keys=keys, attrs=self.feature_attrs(mdata, idx),
+                             feature_verts=mdata.vert_offsets[idx + 1] - mdata.vert_offsets[idx])
+            self.nbytes += batch.nbytes - nbytes
+
+    def feature_attrs(self, mdata, idx):
+        """Return the SOSI attributes of the features idx of mdata as
+        MeshBatch.add_arrays takes them, text as scene wide codes."""
+        res = {}
+        for name, values in mdata.feature_attrs(idx).items():
+            enum = mdata.attrs.enums.get(name)
+            if enum is None:
+                res[name] = (values, False)
+            else:
+                codes = self.registry.attr_codes(name, enum)
+                missing = values == sodhlp.ATTR_INT_MISSING
+                res[name] = (np.where(missing, values, codes[np.where(missing, 0, values)]), True)
+        return res
+
+    def remove_stale(self, coll, file_keys):
+        """Remove the features of the objects in coll whose keys are not in
+        file_keys, the keys of the features now in the source file: features
+        deleted from the file and the old version of changed ones. The
+        objects are rewritten by build(), those left empty are deleted.
+        """
+        for sosi_name, ob in self.registry.coll_mesh_objects(coll).items():
+            keep = np.isin(self.registry.feature_keys(ob), file_keys)
+            if not keep.all():
+                self.batch(coll, sosi_name).keep = keep
+
+    def build(self, parent=None):
+        """Create (or extend) one mesh object per collected batch.
+        Return the list of objects touched.
+        """
+        return list(self.build_iter(parent))
+
+    def build_iter(self, parent=None):
+        """Generator version of build(), yielding each object once it is
+        built, so callers can spread the work over several steps. Batches
+        added meanwhile are built too. Building again later appends what
+        was added since to the objects, so the geometry collected can be
+        flushed into Blender whenever it grows too large. Appending still
+        copies the whole arrays of the object (see Mesh.foreach_set_tail).
+        """
+        while self.batches:
+            key = next(iter(self.batches))
+            batch = self.batches.pop(key)
+            self.nbytes -= batch.nbytes
+            ob = self.registry.get_coll_mesh_obj(batch.coll, batch.ob_name)
+            if (ob is not None and batch.keep is None and not self.weld_tolerance
+                    and self.append_mesh(batch, ob.data)):
+                # Appended to the object from an earlier import or flush
+                self.registry.forget_feature_keys(ob)
+                sostats.incr("objects extended")
+            elif ob is not None:
+                # Rewrite the object from an earlier import or flush
+                me_orig = ob.data
+                with sostats.timer("joins"):
+                    base = Mesh.to_arrays(me_orig)
+                    base_keys = self.registry.feature_keys(ob)
+                    base_attrs = Mesh.sosi_attrs(me_orig, *base[1:])
+                    if batch.keep is not None:
+                        base = sogeohlp.select_mesh_vertices(*base, batch.keep)
+                        base_keys = base_keys[batch.keep]
+                        if base_attrs is not None:
+                            base_attrs = (base_attrs[0][batch.keep], base_attrs[1])
+                    if batch.num_verts == 0 and len(base[0]) == 0:
+                        # All its features were removed from the file
+                        self.registry.remove_object(ob, batch.coll, batch.ob_name)
+                        self.registry.remove_mesh(me_orig)
+                        sostats.incr("objects removed")
+                        continue
+                ob.data = self.create_mesh(batch, base, base_keys, base_attrs)
+                self.registry.remove_mesh(me_orig)
+                self.registry.forget_feature_keys(ob)
+                sostats.incr("objects updated" if batch.keep is not None else "objects rewritten")
+            else:
+                mesh = self.create_mesh(batch)
+                sostats.incr("objects created")
+                ob = bpy.data.objects.new(batch.ob_name, mesh)
+                ob.parent = parent
+                batch.coll.objects.link(ob)
+                self.registry.add_object(ob, batch.coll, batch.ob_name)
+            self.registry.store_attr_codes(bpy.context.scene)
+            lock_obj_to_parent(ob)
+            # Not kept while the caller has the object
+            batch = base = base_keys = base_attrs = None
+            yield ob
+        self.registry.link_collections()
+
+    def append_mesh(self, batch, mesh):
+        """Append the geometry of batch to mesh in place (see
+        Mesh.append_arrays), with its feature keys and SOSI attributes.
+        Return False, leaving mesh alone, when the attributes do not fit
+        those of mesh (another kind, or features needing another domain):
+        then the mesh has to be rewritten."""
+        coords, edges, loops, loop_starts = batch.arrays()
+        with sostats.timer("attributes"):
+            attrs = batch.vertex_attrs(encode=self.registry.encode_attr)
+            domains = Mesh.sosi_attr_domains(mesh)
+            if attrs is not None or domains is not None:
+                needed = [domain for domain, index in Mesh.attr_domains(len(coords), edges, loops, loop_starts)]
+                if domains is None:
+                    if len(mesh.vertices):
+                        return False
+                    domains = needed
+                kinds = json.loads(mesh.get(Mesh.ATTRS_PROP, "{}"))
+                rows, values = attrs if attrs is not None else (np.zeros(len(coords), dtype=np.int64), {})
+                if not set(needed) <= set(domains) or any(
+                        kinds.get(name, kind) != kind
+                        for name, kind in ((n, Mesh.attr_kind(*v)) for n, v in values.items())):
+                    return False
+        keys = batch.vertex_keys()
+        if keys is None and mesh.attributes.get(Mesh.SERIAL_ATTR) is not None:
+            keys = np.full(len(coords), -1, dtype=np.int64)
+        # All is in the joined arrays now, free the pieces before Blender copies them
+        batch.release()
+        with sostats.timer("mesh creation"):
+            nverts, nedges, nfaces = Mesh.append_arrays(mesh, coords, edges, loops, loop_starts)
+            if keys is not None:
+                Mesh.set_feature_keys(mesh, keys, nverts)
+        if domains is not None:
+            with sostats.timer("attributes"):
+                elements = {}
+                for domain in domains:
+                    if domain == 'FACE':
+                        elements[domain] = (nfaces, np.asarray(loops)[np.asarray(loop_starts, dtype=np.int64)])
+                    elif domain == 'EDGE':
+                        all_edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+                        mesh.edges.foreach_get("vertices", all_edges)
+                        elements[domain] = (nedges, all_edges[nedges * 2::2] - nverts)
+                    else:
+                        elements[domain] = (nverts, np.arange(len(coords)))
+                Mesh.append_sosi_attrs(mesh, rows, values, elements)
+        return True
+
+    def create_mesh(self, batch, base=None, base_keys=None, base_attrs=None):
+        """Create the mesh of batch appended to the base arrays of an existing
+        mesh (see MeshBatch.arrays), with the feature keys (if any, unless
+        welding) and the SOSI attributes of the features."""
+        *arrays, inverse = batch.arrays(base, self.weld_tolerance, return_inverse=True)
+        with sostats.timer("attributes"):
+            attrs = batch.vertex_attrs(base_attrs, 0 if base is None else len(base[0]),
+                                       self.registry.encode_attr)
+            if attrs is not None and inverse is not None:
+                # A welded vertex takes the values of one of the vertices merged
+                welded = np.empty(len(arrays[0]), dtype=attrs[0].dtype)
+                welded[inverse] = attrs[0]
+                attrs = (welded, attrs[1])
+        keys = None if self.weld_tolerance else batch.vertex_keys(base_keys)
+        # All is in the joined arrays now, free the pieces before Blender copies them
+        batch.release()
+        with sostats.timer("mesh creation"):
+            mesh = Mesh.from_arrays(batch.ob_name, *arrays)
+            if keys is not None:
+                Mesh.set_feature_keys(mesh, keys)
+        with sostats.timer("attributes"):
+            if attrs is not None:
+                Mesh.set_sosi_attrs(mesh, *attrs, arrays[2], arrays[3])
+        return mesh
+
+# -----------------------------------------------------------------------------
+
+class ImportRegistry():
+    """Lookups for one import session.
+
+    The objects of a collection and the feature keys of an object are read
+    from the scene once and updated as the importer creates objects, so
+    lookups cost the same however many objects the scene holds.
+
+    The parent empty and the collections of the importer (the root
+    collection, one per file and their tile and level of detail children)
+    are resolved once per session and handed out from then on. They are
+    found by custom properties, not by name, so user collections with the
+    same names are left alone. New collections are linked into the scene
+    by link_collections, once their objects are in them.
+    """
+
+    # Custom property holding the SOSI object name the object was created for
+    # (Blender may have added a .001 suffix to the object name itself)
+    SOSI_NAME_PROP = "sosi_name"
+
+    # Scene custom property with the values of the text attributes, so the
+    # codes stored in the meshes mean the same in all objects of the scene:
+    # {name: [text of code 0, text of code 1, ...]} as JSON
+    ATTR_CODES_PROP = "sosi_attr_codes"
+
+    # Collection custom properties marking the root collection and the
+    # collection of each file (holding its file name)
+    ROOT_PROP = "sosi_root"
+    FILE_PROP = "sosi_file"
+    ROOT_COLLECTION = "SOSI"
+
+    def __init__(self):
+        self.coll_objects = {}
+        self.keys = {}
+        self.codes = json.loads(bpy.context.scene.get(ImportRegistry.ATTR_CODES_PROP, "{}"))
+        self.code_index = {name: {v: i for i, v in enumerate(values)} for name, values in self.codes.items()}
+        self.codes_changed = False
+        self.parent = None
+        self.root = None
+        self.file_colls = {}    # file name -> collection
+        self.child_colls = {}   # (parent name, property, value) -> collection
+        self.new_links = []     # (parent, collection) not linked yet
+
+    def parent_object(self, sosi_parent_name):
+        """Return the parent empty of the SOSI objects, created if missing."""
+        if self.parent is None:
+            self.parent = get_or_create_SOSI_parent_object(sosi_parent_name)
+        return self.parent
+
+    def root_collection(self, create=True):
+        """Return the collection holding the file collections, None if there
+        is none and not create."""
+        if self.root is None:
+            self.root = self._child(bpy.context.scene.collection, ImportRegistry.ROOT_COLLECTION,
+                                    ImportRegistry.ROOT_PROP, True, create)
+        return self.root
+
+    def file_collection(self, filename, create=True):
+        """Return the collection of the objects imported from the file
+        filename (without directory), None if there is none and not create."""
+        coll = self.file_colls.get(filename)
+        if coll is None:
+            root = self.root_collection(create)
+            if root is None:
+                return None
+            coll = self._child(root, filename, ImportRegistry.FILE_PROP, filename, create)
+            if coll is not None:
+                self.file_colls[filename] = coll
+        return coll
+
+    def child_collection(self, parent, coll_name, prop, value, init=None):
+        """Return the child collection of parent marked with the custom
+        property prop = value, created as coll_name if new and then passed
+        to init."""
+        key = (parent.name, prop, str(value))
+        coll = self.child_colls.get(key)
+        if coll is None:
+            coll = self.child_colls[key] = self._child(parent, coll_name, prop, value, init=init)
+        return coll
+
+    def _child(self, parent, coll_name, prop, value, create=True, init=None):
+        # Collections of imports from older versions are not marked, those
+        # are taken by name and marked
+        legacy = None
+        for coll in parent.children:
+            mark = coll.get(prop)
+            if mark is None:
+                if coll.name == coll_name:
+                    legacy = coll
+            elif _same_prop_value(mark, value):
+                return coll
+        if legacy is not None:
+            legacy[prop] = value
+            return legacy
+        if not create:
+            return None
+        coll = bpy.data.collections.new(coll_name)
+        coll[prop] = value
+        if init is not None:
+            init(coll)
+        self.new_links.append((parent, coll))
+        return coll
+
+    def link_collections(self):
+        """Link the collections created since the last call to their parents.
+        New collections get their objects while outside the scene, so the
+        scene takes in each new collection once, complete, instead of
+        updating for every object linked."""
+        for parent, coll in reversed(self.new_links):
+            parent.children.link(coll)
+        self.new_links = []
+
+    def remove_mesh(self, mesh):
+        bpy.data.meshes.remove(mesh, do_unlink=True)
+
+    def _coll_objects(self, coll):
+        # Indexed on first use, only collections touched by the import are scanned
+        objs = self.coll_objects.get(coll.name)
+        if objs is None:
+            objs = {}
+            for o in coll.objects:
+                if o.type == 'MESH':
+                    objs[o.get(ImportRegistry.SOSI_NAME_PROP, o.name)] = o
+            self.coll_objects[coll.name] = objs
+        return objs
+
+    def get_coll_mesh_obj(self, coll, sosi_name):
+        """Return the mesh object created for sosi_name in the collection coll."""
+        return self._coll_objects(coll).get(sosi_name)
+
+    def coll_mesh_objects(self, coll):
+        """Return {SOSI object name: mesh object} of the collection coll."""
+        return dict(self._coll_objects(coll))
+
+    def feature_keys(self, obj):
+        """Return the feature key of each vertex of obj (see Mesh.feature_keys),
+        read from the mesh once per import."""
+        keys = self.keys.get(obj.name)
+        if keys is None:
+            keys = Mesh.feature_keys(obj.data)
+            self.keys[obj.name] = keys
+        return keys
+
+    def forget_feature_keys(self, obj):
+        self.keys.pop(obj.name, None)
+
+    def collection_feature_keys(self, filename):
+        """Return the keys of all features imported from the file filename
+        (its collection and the child collections), None if there is no
+        such collection."""
+        coll = self.file_collection(filename, create=False)
+        if coll is None:
+            return None
+        keys = [self.feature_keys(o) for o in coll.all_objects if o.type == 'MESH']
+        return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+
+    def attr_codes(self, name, values):
+        """Return the int32 codes of the text values of the attribute name,
+        adding the values not seen before to the code table of the scene."""
+        table = self.codes.setdefault(name, [])
+        index = self.code_index.setdefault(name, {})
+        res = np.empty(len(values), dtype=np.int32)
+        for i, v in enumerate(values):
+            code = index.get(v)
+            if code is None:
+                code = index[v] = len(table)
+                table.append(v)
+                self.codes_changed = True
+            res[i] = code
+        return res
+
+    def encode_attr(self, name, values):
+        """Return the codes (see attr_codes) of numeric attribute values
+        (int32 or float array) written as text, for an attribute that is
+        text elsewhere."""
+        missing = sodhlp.attr_missing(values)
+        uniq, inverse = np.unique(values[~missing], return_inverse=True)
+        res = np.full(len(values), sodhlp.ATTR_INT_MISSING, dtype=np.int32)
+        res[~missing] = self.attr_codes(name, [str(v) for v in uniq.tolist()])[inverse.reshape(-1)]
+        return res
+
+    def store_attr_codes(self, scene):
+        if self.codes_changed:
+            scene[ImportRegistry.ATTR_CODES_PROP] = json.dumps(self.codes)
+            self.codes_changed = False
+
+    def add_object(self, obj, coll=None, sosi_name=None):
+        if coll is not None:
+            if sosi_name is None:
+                sosi_name = obj.name
+            obj[ImportRegistry.SOSI_NAME_PROP] = sosi_name
+            self._coll_objects(coll)[sosi_name] = obj
+
+    def remove_object(self, obj, coll=None, sosi_name=None):
+        self.keys.pop(obj.name, None)
+        if coll is not None:
+            self._coll_objects(coll).pop(sosi_name, None)
+        bpy.data.objects.remove(obj, do_unlink=True)
+
+# -----------------------------------------------------------------------------
+        
 class SceneSettings():
                 
     @staticmethod
@@ -200,10 +925,40 @@ class SceneSettings():
         
 # -----------------------------------------------------------------------------
 
+def _same_prop_value(prop, value):
+    """Compare a custom property as read back (arrays as IDPropertyArray)
+    with the value it was set to."""
+    if isinstance(value, (list, tuple)):
+        return hasattr(prop, "__len__") and list(prop) == list(value)
+    return prop == value
+
+# -----------------------------------------------------------------------------
+
+# Object custom property marking the parent empty of the SOSI objects
+PARENT_PROP = "sosi_parent"
+
+def find_SOSI_parent_object(sosi_parent_name):
+    """Return the parent empty of the SOSI objects in the scene, or None.
+    That is the object marked with PARENT_PROP, or (imports from older
+    versions) the empty named sosi_parent_name."""
+    objects = bpy.context.scene.objects
+    top_parent = objects.get(sosi_parent_name)
+    if top_parent is not None and top_parent.get(PARENT_PROP):
+        return top_parent
+    marked = next((o for o in objects if o.type == 'EMPTY' and o.get(PARENT_PROP)), None)
+    if marked is not None:
+        return marked
+    if top_parent is not None and top_parent.type == 'EMPTY':
+        return top_parent
+    return None
+
 def get_or_create_SOSI_parent_object(sosi_parent_name):
-    top_parent = bpy.data.objects.get(sosi_parent_name)
-    if top_parent == None:
+    top_parent = find_SOSI_parent_object(sosi_parent_name)
+    if top_parent != None:
+        top_parent[PARENT_PROP] = True
+    else:
         top_parent = bpy.data.objects.new(sosi_parent_name, None)
+        top_parent[PARENT_PROP] = True
         top_parent.empty_display_size = 1
         #top_parent.empty_display_type = 'PLAIN_AXES'
         top_parent.empty_display_type = 'SPHERE'
@@ -212,6 +967,93 @@ def get_or_create_SOSI_parent_object(sosi_parent_name):
     return top_parent
     
 # -----------------------------------------------------------------------------
+
+def objects_bbox_2d(objs, sosi_parent_name="SOSI_Parent"):
+    """
+    Return the (min x, min y, max x, max y) of the bounding boxes of objs,
+    in the frame of the SOSI parent object (world frame if there is none),
+    or None when objs is empty.
+    """
+    if not objs:
+        return None
+    to_local = Matrix.Identity(4)
+    top_parent = find_SOSI_parent_object(sosi_parent_name)
+    if top_parent != None:
+        to_local = top_parent.matrix_world.inverted()
+    pts = np.array([to_local @ ob.matrix_world @ Vector(c) for ob in objs for c in ob.bound_box])
+    return (pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max())
+
+# -----------------------------------------------------------------------------
+
+# Name of the Geometry Nodes modifier instancing symbols on point objects
+POINT_SYMBOLS_MODIFIER = "SOSI Point Symbols"
+
+def is_point_cloud(obj):
+    """True for a mesh object with vertices only (PUNKT features)."""
+    me = obj.data
+    return len(me.vertices) > 0 and len(me.edges) == 0 and len(me.polygons) == 0
+
+
+def point_symbols_node_group(symbols):
+    """
+    Return the Geometry Nodes group instancing the objects of the collection
+    symbols on the points of a mesh, created once per collection. Each
+    point picks one child of the collection by its feature serial number
+    (the sosi_serial attribute), so several symbols spread over the points.
+    """
+    name = "{} {}".format(POINT_SYMBOLS_MODIFIER, symbols.name)
+    group = bpy.data.node_groups.get(name)
+    if group is not None:
+        return group
+    group = bpy.data.node_groups.new(name, 'GeometryNodeTree')
+    group.interface.new_socket("Geometry", in_out='INPUT', socket_type='NodeSocketGeometry')
+    group.interface.new_socket("Geometry", in_out='OUTPUT', socket_type='NodeSocketGeometry')
+    nodes = group.nodes
+    n_in = nodes.new('NodeGroupInput')
+    n_out = nodes.new('NodeGroupOutput')
+    info = nodes.new('GeometryNodeCollectionInfo')
+    info.transform_space = 'ORIGINAL'
+    info.inputs["Collection"].default_value = symbols
+    info.inputs["Separate Children"].default_value = True
+    info.inputs["Reset Children"].default_value = True
+    serial = nodes.new('GeometryNodeInputNamedAttribute')
+    serial.data_type = 'INT'
+    serial.inputs["Name"].default_value = Mesh.SERIAL_ATTR
+    inst = nodes.new('GeometryNodeInstanceOnPoints')
+    inst.inputs["Pick Instance"].default_value = True
+    links = group.links
+    links.new(n_in.outputs[0], inst.inputs["Points"])
+    links.new(info.outputs[0], inst.inputs["Instance"])
+    # Older versions have one (hidden) Attribute output per data type
+    attr = next(s for s in serial.outputs if s.name == "Attribute" and s.enabled)
+    links.new(attr, inst.inputs["Instance Index"])
+    links.new(inst.outputs[0], n_out.inputs[0])
+    n_in.location = (-400, 0)
+    info.location = (-400, -150)
+    serial.location = (-400, -400)
+    n_out.location = (300, 0)
+    return group
+
+
+def instance_point_symbols(obj, symbols):
+    """Draw the points of obj as instances of the collection symbols, see
+    point_symbols_node_group. The mesh itself is not changed."""
+    mod = obj.modifiers.get(POINT_SYMBOLS_MODIFIER)
+    if mod is None:
+        mod = obj.modifiers.new(POINT_SYMBOLS_MODIFIER, 'NODES')
+    mod.node_group = point_symbols_node_group(symbols)
+
+# -----------------------------------------------------------------------------
+
+def scene_point_to_sosi(point, sosi_parent_name="SOSI_Parent"):
+    """Return the (x, y) of the scene point in SOSI coordinates, the frame of
+    the SOSI parent object (world frame if there is none)."""
+    top_parent = find_SOSI_parent_object(sosi_parent_name)
+    if top_parent != None:
+        point = top_parent.matrix_world.inverted() @ Vector(point)
+    return (point[0], point[1])
+
+# -----------------------------------------------------------------------------
         
 def setMyEnvironment():
     SceneSettings.set_clip_end(20000)
@@ -222,56 +1064,6 @@ def setMyEnvironment():
     
 # -----------------------------------------------------------------------------
     
-def get_mesh_obj_named(obname):
-    for o in bpy.context.scene.objects:
-        if o.type == 'MESH' and o.name == obname:
-            return o
-    return None
-
-# -----------------------------------------------------------------------------
-
-    
-# Join the two meshes together and name the resulting mesh name
-def meshes_join(name, me1, me2):
-    bm = bmesh.new()
-    bm.from_mesh(me1)
-    #print(bm)
-    bm.from_mesh(me2)
-    #print(bm)
-    me = bpy.data.meshes.new(name)
-    bm.to_mesh(me)
-    bm.free()
-    return me
-
-# -----------------------------------------------------------------------------    
-
-# Join the mesh in the object ob_new to the existing mesh object eith name obname
-def mesh_obj_join_existing(obname, ob_new):
-    
-    ob_orig = None
-    for o in bpy.context.scene.objects:
-        if o.type == 'MESH':
-            if o.name == obname:
-                ob_orig = o
-                
-    if ob_orig != None:
-        #print('Found orig', ob_orig)
-        
-        me_orig = ob_orig.data
-        me_joined = meshes_join(obname, me_orig, ob_new.data)
-        
-        ob_orig.data = me_joined
-        bpy.data.meshes.remove(me_orig, do_unlink=True)
-        return ob_orig
-    else:
-        return None
-    #    me_new = ob_new.data
-    #    me_new.name = obname
-    #    ob_new.name = obname
-    #    return ob_new   
-    
-# -----------------------------------------------------------------------------
-
 def lock_obj_to_parent(obj):
     if obj.parent != None:
         #print(obj.name)
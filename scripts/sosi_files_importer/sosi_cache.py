@@ -0,0 +1,216 @@
+"""On-disk cache of parsed SOSI files.
+
+The features of a parsed file (sosi_datahelper.FeatureBatch) are stored
+as an uncompressed .npz file, keyed by the file path, size, modification
+time and parser engine. A changed file therefore never hits a stale entry.
+The cache is kept below a size limit by evicting the least recently used
+entries.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import zipfile
+import numpy as np
+from . import sosi_datahelper as sodhlp
+from . import sosi_geom_helper as sogeohlp
+from . import sosi_settings as soset
+from . import sosi_stats as sostats
+
+# Bump when the stored layout or the parsers' output changes
+CACHE_VERSION = 3
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "sosi_importer_cache")
+CACHE_EXT = ".npz"
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class FeatureCache:
+    """Cache of FeatureBatch objects in the directory cache_dir."""
+
+    def __init__(self, cache_dir=None, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+
+    def entry_path(self, path, engine):
+        st = os.stat(path)
+        key = "{}|{}|{}|{}|{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns,
+                                      engine, CACHE_VERSION)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + CACHE_EXT)
+
+    def load(self, path, engine):
+        """Return the cached list of FeatureBatch for path, or None. An entry
+        that can not be read (e.g. truncated) is removed."""
+        try:
+            entry = self.entry_path(path, engine)
+        except OSError:
+            return None
+        try:
+            with np.load(entry, allow_pickle=False) as data:
+                batches = []
+                if len(data["filename"]):
+                    batches.append(sodhlp.FeatureBatch(
+                        str(data["filename"][0]),
+                        data["obj_ids"],
+                        data["serials"],
+                        data["names"].tolist(),
+                        data["coords"],
+                        data["offsets"],
+                        data["part_offsets"],
+                        data["feat_parts"],
+                        data["holes"],
+                        sodhlp.FeatureAttrs.from_arrays(len(data["obj_ids"]), data)))
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            logging.warning("%s: removing unreadable cache entry (%s)", path, e)
+            _remove(entry)
+            return None
+        try:
+            os.utime(entry)  # Most recently used
+        except OSError:
+            pass
+        return batches
+
+    def store(self, path, engine, batches):
+        """Store the list of FeatureBatch parsed from path, as one batch."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry = self.entry_path(path, engine)
+            if batches:
+                b = sodhlp.FeatureBatch.concat(batches)
+                arrays = dict(filename=np.array([b.filename]), obj_ids=b.obj_ids, serials=b.serials,
+                              names=np.array(b.names, dtype=str), coords=b.coords, offsets=b.offsets,
+                              part_offsets=b.part_offsets, feat_parts=b.feat_parts, holes=b.holes,
+                              **b.attrs.to_arrays())
+            else:
+                arrays = dict(filename=np.array([], dtype=str))
+            # Write to a temporary file first, parallel workers may store the same entry
+            fd, tmp = tempfile.mkstemp(suffix=CACHE_EXT, dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp, entry)
+            except BaseException:
+                _remove(tmp)
+                raise
+        except OSError as e:
+            logging.warning("Could not cache %s: %s", path, e)
+
+    def entries(self):
+        try:
+            names = [n for n in os.listdir(self.cache_dir) if n.endswith(CACHE_EXT)]
+        except OSError:
+            return []
+        res = []
+        for n in names:
+            p = os.path.join(self.cache_dir, n)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            res.append((st.st_mtime, st.st_size, p))
+        return res
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+    def clear(self):
+        """Remove all entries. Return the number of entries removed."""
+        n = 0
+        for mtime, size, p in self.entries():
+            try:
+                os.remove(p)
+                n += 1
+            except OSError:
+                pass
+        return n
+
+
+def get_parser(engine):
+    if engine == "GDAL":
+        from . import sosi_gdal_parser as sosi_parser
+    else:
+        from . import sosi_native_parser as sosi_parser
+    return sosi_parser
+
+
+def file_in_bbox(path, bbox):
+    """False if the ..OMRÅDE in the header of path lies outside bbox."""
+    try:
+        from . import sosi_native_parser
+        extent = sosi_native_parser.read_sosi_extent(path)
+    except OSError:
+        return True
+    return extent is None or sogeohlp.bbox_intersects(extent, bbox)
+
+
+def filter_batches(batches, bbox=None, filt=None):
+    """Select the features of cached batches within bbox and accepted by filt."""
+    res = []
+    for b in batches:
+        keep = np.ones(len(b), dtype=bool)
+        if bbox is not None:
+            keep &= sogeohlp.features_in_bbox(b.coords, b.offsets, bbox)
+        if filt and filt.predicates:
+            keep &= np.array([filt.accepts(n, b.attrs.row(i)) for i, n in enumerate(b.names)], dtype=bool)
+        elif filt:
+            keep &= np.array([filt.accepts_objtype(n) for n in b.names], dtype=bool)
+        if keep.any():
+            res.append(b if keep.all() else b.select(keep))
+    return res
+
+
+def read_batches(path, engine, cache=None, bbox=None, filt=None):
+    """Return the list of FeatureBatch of one SOSI file.
+
+    The cache (a FeatureCache, may be None) is checked before the parser
+    is run, and updated after. With a bbox (min E, min N, max E, max N)
+    only the features intersecting it are returned, and files whose
+    header extent lies outside are not read at all. filt is an optional
+    sosi_filter.FeatureFilter. Files that can not be read are logged and
+    give no batches, they are not cached.
+    """
+    if bbox is not None and not file_in_bbox(path, bbox):
+        logging.info("%s: outside the spatial window, skipped", path)
+        return []
+    if cache is not None:
+        with sostats.timer("cache read"):
+            batches = cache.load(path, engine)
+        if batches is not None:
+            logging.info("%s: read from cache", path)
+            sostats.incr("files from cache")
+            return filter_batches(batches, bbox, filt) if bbox is not None or filt else batches
+    parser = get_parser(engine)
+    try:
+        if cache is None or filt:
+            # Filtered files are not stored, the filters are applied by the parser
+            return list(parser.iter_feature_batches([path], soset.PARSE_BATCH_FEATURES, bbox, filt,
+                                                    strict=True))
+        # The whole file is cached, so other windows can use the entry too
+        batches = list(parser.iter_feature_batches([path], soset.PARSE_BATCH_FEATURES, strict=True))
+    except (OSError, ValueError) as e:
+        logging.error("Could not read %s: %s", path, e)
+        return []
+    if os.path.exists(path):
+        with sostats.timer("cache write"):
+            cache.store(path, engine, batches)
+    return batches if bbox is None else filter_batches(batches, bbox)
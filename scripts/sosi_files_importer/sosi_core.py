@@ -0,0 +1,205 @@
+"""Blender independent part of the importer: SOSI files to mesh ready
+geometry.
+
+read_files() yields for each file a list of sosi_datahelper.MeshData, the
+coordinates, edges and faces of all its features as columnar arrays,
+together with the type (SosiObjId), object name, serial number and SOSI
+attributes (sosi_datahelper.FeatureAttrs) of each feature and the source
+file name. None of the modules used here imports
+bpy, so the core runs headless (tests, benchmarks, server side pipelines)
+at full speed. In Blender, blender_helper.MeshBatchBuilder.add_mesh_data
+turns the batches into objects.
+
+    from sosi_files_importer import sosi_core
+    for path, mdatas in sosi_core.read_files(paths, workers=4):
+        for mdata in mdatas:
+            for name, coords, edges, loops, face_sizes in mdata.groups():
+                ...
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from . import sosi_cache
+from . import sosi_datahelper as sodhlp
+from . import sosi_geom_helper as sogeohlp
+from . import sosi_stats as sostats
+from . import sosi_tiles as sotiles
+
+try:
+    from osgeo import ogr  # noqa
+    GDAL_AVAILABLE = True
+except Exception:
+    GDAL_AVAILABLE = False
+
+ENGINES = ("NATIVE", "GDAL")
+
+
+def resolve_engine(engine):
+    """Return engine, or 'NATIVE' when GDAL is asked for but not installed."""
+    if engine == "GDAL" and not GDAL_AVAILABLE:
+        logging.warning("GDAL Python bindings not available, using the native parser")
+        return "NATIVE"
+    return engine
+
+
+def read_file(path, engine="NATIVE", cache=None, bbox=None, filt=None, known=None, simplify=None,
+              tiling=None):
+    """Parse one SOSI file and prepare the mesh data of its features.
+
+    With known, the keys (see sosi_datahelper.feature_keys) of the features
+    imported from the file before, only the new and changed features are
+    prepared, and MeshData.file_keys lists the keys of all features in the
+    file, so the features no longer there can be removed.
+
+    simplify is a (method, tolerances) pair to simplify the lines, see
+    sosi_geom_helper.simplify_batch. With several tolerances the lines get
+    one MeshData per level of detail (MeshData.lod), in addition to the one
+    holding the other features.
+
+    tiling is a (tile size, tiles) pair: the features are split into one
+    MeshData per tile (MeshData.tile, see sosi_tiles), and only those in
+    the set tiles are prepared (all if tiles is None). MeshData.tile_counts
+    gives the features of every tile of the file, so a file with none in
+    tiles still yields an (empty) MeshData.
+
+    Args:
+        path (str): SOSI file to parse
+        engine (str): 'NATIVE' or 'GDAL'
+        cache (sosi_cache.FeatureCache): parsed file cache, or None
+        bbox (tuple): spatial window (min E, min N, max E, max N), or None
+        filt (sosi_filter.FeatureFilter): OBJTYPE/attribute filter, or None
+        known (numpy.ndarray): int64 keys of the features already imported, or None
+        simplify (tuple): (method, list of tolerances [m]), or None
+        tiling (tuple): (tile size [m], set of (ix, iy) or None), or None
+    Returns:
+        list[sosi_datahelper.MeshData]: mesh data of the file, empty if nothing was read
+    """
+    batches = sosi_cache.read_batches(path, engine, cache, bbox, filt)
+    mdatas, file_keys, tile_counts = [], [], {}
+    for batch in batches:
+        with sostats.timer("feature hashing"):
+            hashes = batch.hashes()
+        keep = np.ones(len(batch), dtype=bool)
+        if known is not None:
+            keys = sodhlp.feature_keys(batch.serials, hashes)
+            file_keys.append(keys)
+            keep = ~np.isin(keys, known)
+            sostats.incr("features unchanged", len(batch) - int(keep.sum()))
+        if tiling is None:
+            if not keep.all():
+                batch, hashes = batch.select(keep), hashes[keep]
+            with sostats.timer("mesh data"):
+                batch_mdatas = batch_mesh_data(batch, hashes, simplify)
+        else:
+            batch_mdatas, counts = tiled_mesh_data(batch, hashes, keep, simplify, *tiling)
+            for tile, n in counts.items():
+                tile_counts[tile] = tile_counts.get(tile, 0) + n
+        mdatas.extend(batch_mdatas)
+    # The file keys and tile counts are those of the whole file, not a batch
+    if file_keys:
+        file_keys = np.concatenate(file_keys)
+    for mdata in mdatas:
+        if known is not None:
+            mdata.file_keys = file_keys
+        if tiling is not None:
+            mdata.tile_counts = tile_counts
+    if sostats.active() is not None:
+        count_features(mdatas)
+    sostats.incr("files")
+    return mdatas
+
+
+def batch_mesh_data(batch, hashes, simplify=None):
+    """Return the list of MeshData of a FeatureBatch, see read_file."""
+    if simplify is None:
+        return [sogeohlp.feature_batch_mesh_data(batch, hashes)]
+    method, tolerances = simplify
+    if len(tolerances) == 1:
+        return [sogeohlp.feature_batch_mesh_data(sogeohlp.simplify_batch(batch, tolerances[0], method),
+                                                 hashes)]
+    lines = batch.obj_ids == sodhlp.SosiObjId.KURVE.value
+    mdatas = [sogeohlp.feature_batch_mesh_data(batch.select(~lines), hashes[~lines])]
+    line_batch = batch.select(lines)
+    for lod, tolerance in enumerate(tolerances):
+        mdata = sogeohlp.feature_batch_mesh_data(sogeohlp.simplify_batch(line_batch, tolerance, method),
+                                                 hashes[lines])
+        mdata.lod = lod
+        mdatas.append(mdata)
+    return mdatas
+
+
+def tiled_mesh_data(batch, hashes, keep, simplify, tile_size, tiles=None):
+    """Return the MeshData per tile of the features of a FeatureBatch where
+    keep is True, and the {tile: features} counts of the whole batch."""
+    ftiles = sotiles.feature_tiles(batch.coords, batch.offsets, tile_size)
+    uniq, inverse, counts = np.unique(ftiles, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    uniq = [tuple(t) for t in uniq.tolist()]
+    if tiles is not None:
+        keep = keep & np.isin(inverse, [i for i, t in enumerate(uniq) if t in tiles])
+    mdatas = []
+    with sostats.timer("mesh data"):
+        # Kept features ordered by tile, each tile a contiguous slice
+        idx = np.flatnonzero(keep)
+        idx = idx[np.argsort(inverse[idx], kind='stable')]
+        tiled, tiled_hashes = batch.take(idx), hashes[idx]
+        tile_ids = inverse[idx]
+        bounds = np.flatnonzero(np.diff(tile_ids)) + 1
+        for lo, hi in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(idx)]))):
+            if lo == hi:
+                continue
+            for mdata in batch_mesh_data(tiled.take(np.arange(lo, hi)), tiled_hashes[lo:hi], simplify):
+                mdata.tile = uniq[tile_ids[lo]]
+                mdatas.append(mdata)
+        if not mdatas:
+            # Nothing to load, still report the tile counts
+            mdatas = batch_mesh_data(batch.select(keep), hashes[keep])
+    return mdatas, dict(zip(uniq, counts.tolist()))
+
+
+def count_features(mdatas):
+    """Add the features and vertices per element type to the active sosi_stats."""
+    for mdata in mdatas:
+        if mdata.lod:
+            continue  # Counted at the first level
+        ids = np.asarray(mdata.obj_ids, dtype=np.int64)
+        nverts = np.diff(mdata.vert_offsets)
+        for obj_id in np.unique(ids):
+            sel = ids == obj_id
+            sostats.count(sodhlp.SosiObjId(int(obj_id)).name, int(sel.sum()), int(nverts[sel].sum()))
+
+
+def read_files(file_paths, engine="NATIVE", workers=1, cache=None, bbox=None, filt=None,
+               known=None, simplify=None, tiling=None):
+    """Yield (path, list[MeshData]) for each file, in file order.
+
+    With workers > 1 the files are parsed in that many worker processes
+    (see sosi_parallel). If the pool breaks, the remaining files are parsed
+    in this process. Closing the generator stops the parsing. known maps
+    file names (without directory) to the keys of the features imported
+    from them before. See read_file for the other arguments.
+    """
+    file_paths = list(file_paths)
+    known = known or {}
+    if workers > 1 and len(file_paths) > 1:
+        from . import sosi_parallel
+        done = set()
+        results = sosi_parallel.parse_files_parallel(file_paths, engine, min(workers, len(file_paths)),
+                                                     cache, bbox, filt, known, simplify, tiling)
+        try:
+            for path, mdatas in results:
+                done.add(path)
+                yield path, mdatas
+                del mdatas  # Not kept while waiting for the next file
+            return
+        except sosi_parallel.BrokenProcessPool as e:
+            logging.warning("Parallel parsing failed (%s), continuing in this process", e)
+        finally:
+            results.close()
+        file_paths = [p for p in file_paths if p not in done]
+    for path in file_paths:
+        yield path, read_file(path, engine, cache, bbox, filt, known.get(os.path.basename(path)), simplify,
+                              tiling)
@@ -25,6 +25,9 @@ This file is part of SosiImporter, an addon to import SOSI files containing
 """
 
 from enum import Enum
+import re
+import zlib
+import numpy as np
 
 # -----------------------------------------------------------------------------
 
@@ -37,19 +40,507 @@ class SosiObjId(Enum):
 
 # -----------------------------------------------------------------------------
 
-# pntlst: sequential list of points
-# return list of point indices defining edges
-def points_to_edglist(pntlst):
-    edglst = []
-    for i in range(1, len(pntlst)):
-        edglst.append((i - 1, i))
-    return edglst
+# npnts: number of sequential points
+# return (npnts - 1, 2) array of point indices defining edges
+def points_to_edgarray(npnts):
+    idx = np.arange(npnts, dtype=np.int32)
+    return np.column_stack((idx[:-1], idx[1:]))
 
 # -----------------------------------------------------------------------------
 
-def intary_to_trilist(ints, ilen):
-    trilist = []
-    for i in range(0, ilen):
-        trilist.append((ints[3 * i], ints[3 * i + 1], ints[3 * i + 2]))
-    return trilist
+# pntlst: sequential list of points forming a ring
+# return the ring without the closing point (if it repeats the first point)
+def ring_open(pntlst):
+    if len(pntlst) > 1 and tuple(pntlst[0]) == tuple(pntlst[-1]):
+        return pntlst[:-1]
+    return pntlst
 
+# -----------------------------------------------------------------------------
+
+# pntlst: sequential list of points forming an open ring (see ring_open)
+# return list with the single face (ngon) made by the ring
+def ring_to_facelist(pntlst):
+    if len(pntlst) < 3:
+        return []
+    return [np.arange(len(pntlst), dtype=np.int32)]
+
+# -----------------------------------------------------------------------------
+
+def ranges_concat(starts, counts):
+    """Concatenated np.arange(starts[i], starts[i] + counts[i]) for all i."""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + counts, counts)
+
+# -----------------------------------------------------------------------------
+
+def feature_keys(serials, hashes):
+    """Key of each feature, stable over re-imports of its file: the serial
+    number (.KURVE 12:) in the high 32 bits, the content hash (see
+    FeatureBatch.hashes) in the low 32 bits, as int64."""
+    serials = np.asarray(serials).astype(np.int32).astype(np.int64)
+    return (serials << 32) | np.asarray(hashes, dtype=np.uint32).astype(np.int64)
+
+# -----------------------------------------------------------------------------
+
+# Value of an integer or text (code) attribute a feature does not have,
+# missing float attributes are NaN
+ATTR_INT_MISSING = np.iinfo(np.int32).min
+
+# Codes such as 0301 are text, not numbers
+_LEADING_ZERO_RE = re.compile(r"-?0\d")
+
+# Golden ratio multiplier spreading the bits of attribute values when hashing
+_HASH_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def attr_column(values):
+    """Return (column, enum) for the text values of one attribute, one per
+    feature and None where the feature does not have it (see FeatureAttrs).
+    A column of integers (written plainly) fitting 32 bits is int32, one of
+    numbers float64. Other text columns, including numbers with leading
+    zeros such as KOMM 0301, are int32 codes into enum, the sorted distinct
+    values; enum is None for numbers."""
+    present = np.array([v is not None for v in values], dtype=bool)
+    texts = [v for v in values if v is not None]
+    floats = None
+    if not any(_LEADING_ZERO_RE.match(t) for t in texts):
+        try:
+            floats = np.array(texts, dtype=np.float64)
+        except ValueError:
+            pass
+    if floats is not None and np.isfinite(floats).all():
+        if (np.abs(floats) < 2**31).all() and [str(int(f)) for f in floats.tolist()] == texts:
+            column = np.full(len(values), ATTR_INT_MISSING, dtype=np.int32)
+            column[present] = floats
+            return column, None
+        column = np.full(len(values), np.nan)
+        column[present] = floats
+        return column, None
+    return text_column(values)
+
+
+def text_column(values):
+    """Return (codes, enum) for text values as attr_column does for text."""
+    present = np.array([v is not None for v in values], dtype=bool)
+    enum, codes = np.unique(np.array([v for v in values if v is not None], dtype=str), return_inverse=True)
+    column = np.full(len(values), ATTR_INT_MISSING, dtype=np.int32)
+    column[present] = codes.reshape(-1)
+    return column, enum.tolist()
+
+
+def attr_missing(column):
+    """Bool mask of the missing values of an attribute column."""
+    if column.dtype == np.int32:
+        return column == ATTR_INT_MISSING
+    return np.isnan(column)
+
+# -----------------------------------------------------------------------------
+
+class FeatureAttrs():
+    """Columnar SOSI attributes (..HØYDE, ..DATAFANGSTDATO, ...) of a number
+    of features, one array per attribute name (see attr_column).
+
+    Sub-attributes are named after their group, e.g. KVALITET.NØYAKTIGHET.
+    Text attributes hold codes into enums[name]. Missing values are
+    ATTR_INT_MISSING, or NaN for floats.
+    """
+    __slots__ = ('size', 'columns', 'enums')
+
+    def __init__(self, size, columns=None, enums=None):
+        self.size = size
+        self.columns = columns if columns is not None else {}
+        self.enums = enums if enums is not None else {}
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from a list with one {NAME: text value} dict per feature."""
+        attrs = cls(len(rows))
+        for name in sorted({name for row in rows for name in row}):
+            column, enum = attr_column([row.get(name) for row in rows])
+            attrs.columns[name] = column
+            if enum is not None:
+                attrs.enums[name] = enum
+        return attrs
+
+    def row(self, i):
+        """Return the {NAME: text value} of feature i."""
+        res = {}
+        for name, column in self.columns.items():
+            v = column[i]
+            if attr_missing(column[i:i + 1])[0]:
+                continue
+            if name in self.enums:
+                res[name] = self.enums[name][v]
+            else:
+                res[name] = str(v) if column.dtype == np.int32 else repr(float(v))
+        return res
+
+    @classmethod
+    def concat(cls, attrs_list):
+        """Return the attributes of the features of all attrs_list, one after
+        the other. Integers become floats where another part has floats, and
+        numbers text where another part has text."""
+        res = cls(sum(len(a) for a in attrs_list))
+        names = sorted({name for a in attrs_list for name in a.columns})
+        for name in names:
+            have = [a for a in attrs_list if name in a.columns]
+            if any(name in a.enums for a in have):
+                parts = []
+                for a in attrs_list:
+                    column, texts = a.columns.get(name), a.enums.get(name)
+                    if column is None:
+                        column, texts = np.full(len(a), ATTR_INT_MISSING, dtype=np.int32), []
+                    elif texts is None:
+                        column, texts = text_column([None if m else str(v) for v, m in
+                                                     zip(column.tolist(), attr_missing(column).tolist())])
+                    parts.append((column, texts))
+                # Merge the distinct values, then recode each part
+                enum = sorted({t for column, texts in parts for t in texts})
+                columns = []
+                for column, texts in parts:
+                    codes = np.searchsorted(enum, texts).astype(np.int32) if texts else np.zeros(1, dtype=np.int32)
+                    missing = column == ATTR_INT_MISSING
+                    columns.append(np.where(missing, column, codes[np.where(missing, 0, column)]))
+                res.columns[name] = np.concatenate(columns)
+                res.enums[name] = enum
+            else:
+                floats = any(a.columns[name].dtype != np.int32 for a in have)
+                columns = []
+                for a in attrs_list:
+                    column = a.columns.get(name)
+                    if column is None:
+                        column = np.full(len(a), np.nan if floats else ATTR_INT_MISSING,
+                                         dtype=np.float64 if floats else np.int32)
+                    elif floats and column.dtype == np.int32:
+                        column = np.where(column == ATTR_INT_MISSING, np.nan, column)
+                    columns.append(column)
+                res.columns[name] = np.concatenate(columns)
+        return res
+
+    def select(self, idx):
+        """Return the attributes of the features idx (index array)."""
+        return FeatureAttrs(len(idx), {name: column[idx] for name, column in self.columns.items()},
+                            self.enums)
+
+    def hashes(self):
+        """Return a uint32 hash of the attribute values of each feature.
+        Attributes a feature does not have add nothing, so adding an
+        attribute to some features leaves the hash of the others alone."""
+        res = np.zeros(self.size, dtype=np.uint64)
+        for name, column in self.columns.items():
+            missing = attr_missing(column)
+            if name in self.enums:
+                text_hashes = np.array([zlib.crc32(v.encode('utf-8')) for v in self.enums[name]],
+                                       dtype=np.uint64)
+                bits = text_hashes[np.where(missing, 0, column)]
+            elif column.dtype == np.int32:
+                bits = column.astype(np.int64).view(np.uint64)
+            else:
+                bits = column.view(np.uint64)
+            mixed = (bits ^ np.uint64(zlib.crc32(name.encode('utf-8')))) * _HASH_MIX
+            res += np.where(missing, np.uint64(0), mixed)
+        return (res ^ (res >> np.uint64(32))).astype(np.uint32)
+
+    def to_arrays(self):
+        """Return the attributes as a dict of arrays for numpy.savez."""
+        names = list(self.columns)
+        arrays = dict(attr_names=np.array(names, dtype=str))
+        for i, name in enumerate(names):
+            arrays['attr_{}'.format(i)] = self.columns[name]
+            if name in self.enums:
+                arrays['enum_{}'.format(i)] = np.array(self.enums[name], dtype=str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, size, data):
+        """Inverse of to_arrays, data being the loaded .npz."""
+        attrs = cls(size)
+        for i, name in enumerate(data['attr_names'].tolist()):
+            attrs.columns[name] = data['attr_{}'.format(i)]
+            if 'enum_{}'.format(i) in data:
+                attrs.enums[name] = data['enum_{}'.format(i)].tolist()
+        return attrs
+
+# -----------------------------------------------------------------------------
+
+class FeatureBatch():
+    """Columnar store of the features read from one SOSI file.
+
+    coords holds the (n, 3) float64 coordinates of all features,
+    feature i owns coords[offsets[i]:offsets[i + 1]]. A feature consists
+    of the parts feat_parts[i]:feat_parts[i + 1], part j being
+    coords[part_offsets[j]:part_offsets[j + 1]]. For a FLATE the parts
+    are rings, holes[j] is True for an interior ring. attrs holds the other
+    SOSI attributes of the features (FeatureAttrs).
+    """
+    __slots__ = ('filename', 'obj_ids', 'serials', 'names', 'coords', 'offsets',
+                 'part_offsets', 'feat_parts', 'holes', 'attrs')
+
+    def __init__(self, filename, obj_ids, serials, names, coords, offsets,
+                 part_offsets=None, feat_parts=None, holes=None, attrs=None):
+        self.filename = filename
+        self.obj_ids = obj_ids
+        self.serials = serials
+        self.names = names
+        self.coords = coords
+        self.offsets = offsets
+        if part_offsets is None:
+            # One part per feature
+            part_offsets = offsets
+            feat_parts = np.arange(len(offsets), dtype=np.int64)
+            holes = np.zeros(len(offsets) - 1, dtype=bool)
+        self.part_offsets = part_offsets
+        self.feat_parts = feat_parts
+        self.holes = holes
+        self.attrs = attrs if attrs is not None else FeatureAttrs(len(obj_ids))
+
+    @classmethod
+    def from_lists(cls, filename, ids, serials, names, coords, parts, holes, attrs):
+        """Build a batch from lists with one item per feature: object id,
+        serial, name, (n, 3) coordinates, part offsets into them, hole flag
+        of each part and {NAME: text value} attributes."""
+        counts = [len(c) for c in coords]
+        part_sizes = [np.diff(p) for p in parts]
+        return cls(
+            filename,
+            np.asarray(ids, dtype=np.int8),
+            np.asarray(serials, dtype=np.int64),
+            list(names),
+            np.concatenate(coords) if coords else np.zeros((0, 3)),
+            np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            np.concatenate(([0], np.cumsum(np.concatenate(part_sizes) if part_sizes else []))).astype(np.int64),
+            np.concatenate(([0], np.cumsum([len(p) for p in part_sizes]))).astype(np.int64),
+            np.concatenate(holes) if holes else np.zeros(0, dtype=bool),
+            FeatureAttrs.from_rows(attrs))
+
+    @classmethod
+    def concat(cls, batches):
+        """Return the features of batches (from one file) as one batch."""
+        if len(batches) == 1:
+            return batches[0]
+        vbase = np.cumsum([0] + [len(b.coords) for b in batches])
+        pbase = np.cumsum([0] + [len(b.holes) for b in batches])
+        return cls(
+            batches[0].filename,
+            np.concatenate([b.obj_ids for b in batches]),
+            np.concatenate([b.serials for b in batches]),
+            [name for b in batches for name in b.names],
+            np.concatenate([b.coords for b in batches]),
+            np.concatenate([b.offsets[:-1] + vbase[i] for i, b in enumerate(batches)] + [vbase[-1:]]),
+            np.concatenate([b.part_offsets[:-1] + vbase[i] for i, b in enumerate(batches)] + [vbase[-1:]]),
+            np.concatenate([b.feat_parts[:-1] + pbase[i] for i, b in enumerate(batches)] + [pbase[-1:]]),
+            np.concatenate([b.holes for b in batches]),
+            FeatureAttrs.concat([b.attrs for b in batches]))
+
+    def __len__(self):
+        return len(self.obj_ids)
+
+    def feature_coords(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def feature_parts(self, i):
+        """Return the part offsets (local to the feature coords) and hole
+        flags of feature i, or None, None for a single part feature."""
+        p0, p1 = self.feat_parts[i], self.feat_parts[i + 1]
+        if p1 - p0 < 2:
+            return None, None
+        return self.part_offsets[p0:p1 + 1] - self.offsets[i], self.holes[p0:p1]
+
+    def hashes(self):
+        """Return the CRC-32 of each feature's type, name, coordinates,
+        rings and attributes as a uint32 array, telling changed features from
+        unchanged ones when a file is imported again."""
+        res = np.empty(len(self), dtype=np.uint32)
+        attr_hashes = self.attrs.hashes()
+        data = memoryview(np.ascontiguousarray(self.coords, dtype=np.float64)).cast('B')
+        row = 3 * 8
+        multi = np.flatnonzero(np.diff(self.feat_parts) > 1)
+        for i in range(len(self)):
+            h = zlib.crc32(self.names[i].encode('utf-8'), int(self.obj_ids[i]) ^ int(attr_hashes[i]))
+            res[i] = zlib.crc32(data[self.offsets[i] * row:self.offsets[i + 1] * row], h)
+        for i in multi:
+            parts, holes = self.feature_parts(i)
+            res[i] = zlib.crc32(parts.tobytes() + holes.tobytes(), int(res[i]))
+        return res
+
+    def select(self, mask):
+        """Return a new FeatureBatch holding the features where mask is True."""
+        return self.take(np.flatnonzero(mask))
+
+    def take(self, idx):
+        """Return a new FeatureBatch holding the features idx (index array), in that order."""
+        counts = np.diff(self.offsets)[idx]
+        part_counts = np.diff(self.feat_parts)[idx]
+        parts = ranges_concat(self.feat_parts[idx], part_counts)
+        return FeatureBatch(self.filename, self.obj_ids[idx], self.serials[idx],
+                            [self.names[i] for i in idx],
+                            self.coords[ranges_concat(self.offsets[idx], counts)],
+                            np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+                            np.concatenate(([0], np.cumsum(np.diff(self.part_offsets)[parts]))).astype(np.int64),
+                            np.concatenate(([0], np.cumsum(part_counts))).astype(np.int64),
+                            self.holes[parts], self.attrs.select(idx))
+
+    def replay(self, callback):
+        """Call a process_sosi_files() callback for every feature in the batch."""
+        pfilename = self.filename.encode('utf-8')
+        multi = np.diff(self.feat_parts) > 1
+        for i in range(len(self)):
+            coords = self.feature_coords(i)
+            args = (int(self.obj_ids[i]), int(self.serials[i]), 0, self.names[i].encode('utf-8'),
+                    3, len(coords), coords, pfilename)
+            if multi[i]:
+                parts, holes = self.feature_parts(i)
+                callback(*args, parts=parts, holes=holes, attrs=self.attrs.row(i))
+            else:
+                callback(*args, attrs=self.attrs.row(i))
+
+# -----------------------------------------------------------------------------
+
+class MeshData():
+    """Mesh ready geometry of the features from one SOSI file.
+
+    The vertices, edges and faces of feature i are the ranges
+    vert_offsets[i]:vert_offsets[i + 1], edge_offsets[i]:edge_offsets[i + 1]
+    and face_offsets[i]:face_offsets[i + 1]. Face f uses the loops
+    loops[loop_starts[f]:loop_starts[f + 1]]. Edge and loop vertex
+    indices refer to coords of the whole batch.
+
+    hashes are the content hashes of the features (see feature_keys).
+    When only the new and changed features of a file are prepared (see
+    sosi_core.read_file), file_keys holds the keys of all its features.
+    lod is the level of detail of simplified lines, None for the features
+    that are not simplified. In a tiled import tile is the (ix, iy) tile of
+    the features (see sosi_tiles) and tile_counts the number of features
+    of the file in each tile, loaded or not. attrs holds the SOSI attributes
+    of the features (FeatureAttrs).
+    """
+    __slots__ = ('filename', 'obj_ids', 'serials', 'names', 'hashes', 'attrs', 'file_keys', 'lod', 'tile',
+                 'tile_counts', 'coords', 'vert_offsets', 'edges', 'edge_offsets', 'loops', 'loop_starts',
+                 'face_offsets')
+
+    def __init__(self, filename, obj_ids, serials, names, coords, vert_offsets, edges, edge_offsets,
+                 loops, loop_starts, face_offsets, hashes=None, attrs=None):
+        self.filename = filename
+        self.obj_ids = obj_ids
+        self.serials = serials
+        self.names = names
+        self.hashes = hashes
+        self.attrs = attrs if attrs is not None else FeatureAttrs(len(obj_ids))
+        self.file_keys = None
+        self.lod = None
+        self.tile = None
+        self.tile_counts = None
+        self.coords = coords
+        self.vert_offsets = vert_offsets
+        self.edges = edges
+        self.edge_offsets = edge_offsets
+        self.loops = loops
+        self.loop_starts = loop_starts
+        self.face_offsets = face_offsets
+
+    @classmethod
+    def from_geoms(cls, filename, obj_ids, serials, names, geoms, hashes=None, attrs=None):
+        """geoms -- list of (coords, edges, faces) per feature, indices local to the
+        feature. faces is a list of index arrays or an (m, k) array of m faces."""
+        coords, edges, loops, face_sizes = [], [], [], []
+        nverts, nedges, nfaces = [0], [0], [0]
+        vbase = 0
+        for c, e, f in geoms:
+            if e is not None and len(e) > 0:
+                edges.append(np.asarray(e, dtype=np.int32).reshape(-1, 2) + vbase)
+            if isinstance(f, np.ndarray) and f.ndim == 2:
+                loops.append(f.astype(np.int32).ravel() + vbase)
+                face_sizes.append(np.full(len(f), f.shape[1]))
+            elif f is not None:
+                for face in f:
+                    loops.append(np.asarray(face, dtype=np.int32) + vbase)
+                    face_sizes.append((len(face),))
+            coords.append(c)
+            nverts.append(len(c))
+            vbase += len(c)
+            nedges.append(len(e) if e is not None else 0)
+            nfaces.append(len(f) if f is not None else 0)
+        face_sizes = np.concatenate(face_sizes) if face_sizes else np.zeros(0, dtype=np.int64)
+        return cls(
+            filename, obj_ids, serials, names,
+            np.concatenate(coords) if coords else np.zeros((0, 3)),
+            np.cumsum(nverts),
+            np.concatenate(edges) if edges else np.zeros((0, 2), dtype=np.int32),
+            np.cumsum(nedges),
+            np.concatenate(loops) if loops else np.zeros(0, dtype=np.int32),
+            np.concatenate(([0], np.cumsum(face_sizes))).astype(np.int64),
+            np.cumsum(nfaces),
+            hashes, attrs)
+
+    def __len__(self):
+        return len(self.obj_ids)
+
+    def feature(self, i):
+        """Return coords, edges and faces of feature i, indices local to the feature.
+        Faces of equal size (triangulated FLATE) are returned as one 2D array."""
+        v0, v1 = self.vert_offsets[i], self.vert_offsets[i + 1]
+        edges = self.edges[self.edge_offsets[i]:self.edge_offsets[i + 1]] - v0
+        starts = self.loop_starts[self.face_offsets[i]:self.face_offsets[i + 1] + 1]
+        sizes = np.diff(starts)
+        if len(sizes) > 1 and (sizes == sizes[0]).all():
+            faces = (self.loops[starts[0]:starts[-1]] - v0).reshape(-1, sizes[0])
+        else:
+            faces = [self.loops[starts[j]:starts[j + 1]] - v0 for j in range(len(starts) - 1)]
+        return self.coords[v0:v1], edges, faces
+
+    def name_groups(self, start=0, stop=None):
+        """Return {name: feature indices} for the features start:stop
+        (default all), in order of first appearance."""
+        stop = len(self) if stop is None else stop
+        first = {}
+        for i in range(start, stop):
+            first.setdefault(self.names[i], []).append(i)
+        return {name: np.asarray(idx) for name, idx in first.items()}
+
+    def group(self, idx):
+        """Return coords, edges, loops and face_sizes of the features idx as
+        one piece of geometry, indices local to it."""
+        vstart = self.vert_offsets[idx]
+        nverts = self.vert_offsets[idx + 1] - vstart
+        # Shift from batch to group vertex indices, per feature
+        shift = vstart - (np.cumsum(nverts) - nverts)
+        coords = self.coords[ranges_concat(vstart, nverts)]
+        nedges = self.edge_offsets[idx + 1] - self.edge_offsets[idx]
+        edges = (self.edges[ranges_concat(self.edge_offsets[idx], nedges)]
+                 - np.repeat(shift, nedges)[:, None])
+        nfaces = self.face_offsets[idx + 1] - self.face_offsets[idx]
+        faces = ranges_concat(self.face_offsets[idx], nfaces)
+        sizes = np.diff(self.loop_starts)[faces]
+        loops = (self.loops[ranges_concat(self.loop_starts[faces], sizes)]
+                 - np.repeat(np.repeat(shift, nfaces), sizes))
+        return coords, edges, loops, sizes
+
+    def vertex_keys(self, idx):
+        """Return the feature key (see feature_keys) of each vertex of group(idx),
+        or None when the hashes are not known."""
+        if self.hashes is None:
+            return None
+        keys = feature_keys(self.serials[idx], self.hashes[idx])
+        return np.repeat(keys, self.vert_offsets[idx + 1] - self.vert_offsets[idx])
+
+    def feature_attrs(self, idx):
+        """Return {name: value of each feature idx} of the attributes any of
+        the features idx has (see FeatureAttrs, text attributes are codes
+        into attrs.enums)."""
+        res = {}
+        for name, column in self.attrs.columns.items():
+            values = column[idx]
+            if not attr_missing(values).all():
+                res[name] = values
+        return res
+
+    def groups(self, start=0, stop=None):
+        """Yield (name, coords, edges, loops, face_sizes) for the features
+        start:stop (default all) grouped by object name, in order of first
+        appearance. Indices are local to the group, so each group can be
+        added to its object in one go.
+        """
+        for name, idx in self.name_groups(start, stop).items():
+            yield (name,) + self.group(idx)
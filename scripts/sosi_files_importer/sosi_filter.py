@@ -0,0 +1,139 @@
+"""Feature filters applied while the SOSI files are parsed.
+
+A FeatureFilter holds an include and an exclude list of OBJTYPE values and
+simple attribute predicates such as 'HØYDE>100' or 'MEDIUM=T'. The parsers
+apply it before the coordinates of a feature are decoded. The GDAL parser
+hands it to OGR as an attribute filter (SQL WHERE clause).
+"""
+
+import re
+
+# Longest operators first, so '<=' is not read as '<'
+PREDICATE_OPS = ("!=", "<=", ">=", "=", "<", ">")
+
+_PREDICATE_RE = re.compile(r"^\s*\.*([^\s=!<>]+)\s*(!=|<=|>=|=|<|>)\s*(.*?)\s*$")
+
+# OGR field holding the OBJTYPE in the GDAL SOSI driver
+OGR_OBJTYPE_FIELD = "objekttypenavn"
+
+
+def split_list(text):
+    """Split a comma (or semicolon) separated list, dropping empty items."""
+    return [s.strip() for s in re.split(r"[,;]", text or "") if s.strip()]
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _compare(a, op, b):
+    if op == "=":
+        return a == b
+    if op == "!=":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    return a >= b
+
+
+class Predicate:
+    """Attribute comparison 'KEY op VALUE', compared as numbers when both
+    sides are numeric, else as text."""
+
+    __slots__ = ("key", "op", "value")
+
+    def __init__(self, key, op, value):
+        self.key = key.upper()
+        self.op = op
+        self.value = value.strip("\"'")
+
+    @classmethod
+    def parse(cls, text):
+        m = _PREDICATE_RE.match(text)
+        if m is None:
+            raise ValueError("Invalid attribute predicate: {}".format(text))
+        return cls(*m.groups())
+
+    def __str__(self):
+        return "{}{}{}".format(self.key, self.op, self.value)
+
+    def matches(self, attrs):
+        """attrs maps upper case attribute names to their (text) values.
+        A missing attribute only matches '!='."""
+        if self.key not in attrs:
+            return self.op == "!="
+        value = attrs[self.key]
+        a, b = _number(value), _number(self.value)
+        if a is not None and b is not None:
+            return _compare(a, self.op, b)
+        return _compare(value, self.op, self.value)
+
+    def to_sql(self):
+        value = self.value
+        if _number(value) is None:
+            value = "'" + value.replace("'", "''") + "'"
+        op = "<>" if self.op == "!=" else self.op
+        return '"{}" {} {}'.format(self.key.lower(), op, value)
+
+
+class FeatureFilter:
+    """OBJTYPE include/exclude lists and attribute predicates (all must hold).
+
+    An empty include list accepts every OBJTYPE.
+    """
+
+    __slots__ = ("include", "exclude", "predicates")
+
+    def __init__(self, include=(), exclude=(), predicates=()):
+        self.include = frozenset(include)
+        self.exclude = frozenset(exclude)
+        self.predicates = tuple(p if isinstance(p, Predicate) else Predicate.parse(p)
+                                for p in predicates)
+
+    @classmethod
+    def from_text(cls, include="", exclude="", predicates=""):
+        """Build a filter from comma separated lists, None if it accepts all."""
+        filt = cls(split_list(include), split_list(exclude), split_list(predicates))
+        return filt if filt else None
+
+    def __bool__(self):
+        return bool(self.include or self.exclude or self.predicates)
+
+    def to_dict(self):
+        """JSON compatible form of the filter, see from_dict."""
+        return dict(include=sorted(self.include), exclude=sorted(self.exclude),
+                    predicates=[str(p) for p in self.predicates])
+
+    @classmethod
+    def from_dict(cls, d):
+        filt = cls(d.get("include", ()), d.get("exclude", ()), d.get("predicates", ()))
+        return filt if filt else None
+
+    def accepts_objtype(self, objtype):
+        if self.include and objtype not in self.include:
+            return False
+        return objtype not in self.exclude
+
+    def accepts(self, objtype, attrs=None):
+        if not self.accepts_objtype(objtype):
+            return False
+        return all(p.matches(attrs or {}) for p in self.predicates)
+
+    def to_sql(self):
+        """The filter as an OGR SQL WHERE clause, or None if it accepts all."""
+        def names(values):
+            return ", ".join("'" + v.replace("'", "''") + "'" for v in sorted(values))
+        terms = []
+        if self.include:
+            terms.append("{} IN ({})".format(OGR_OBJTYPE_FIELD, names(self.include)))
+        if self.exclude:
+            terms.append("{} NOT IN ({})".format(OGR_OBJTYPE_FIELD, names(self.exclude)))
+        terms.extend(p.to_sql() for p in self.predicates)
+        return " AND ".join(terms) if terms else None
@@ -1,50 +1,161 @@
 """Simple SOSI parser using GDAL as a fallback for non-Windows systems."""
 
+import logging
 import os
+import numpy as np
 from osgeo import ogr
 from . import sosi_datahelper as sodhlp
+from . import sosi_filter as sofilt
+from . import sosi_settings as soset
+from . import sosi_stats as sostats
+from . import sosi_wkb as sowkb
 
 
-def process_sosi_files(file_paths, callback):
+def geometry_coords(geom):
+    """Return the coordinates of a (multi) point, line or polygon as an
+    (n, 3) array, plus the part offsets and hole flags, see
+    sosi_wkb.wkb_coords. The geometry is exported as little endian ISO WKB
+    with Z values, whose coordinates are viewed without copies.
+    """
+    if not geom.Is3D():
+        geom.Set3D(True)
+    if geom.IsMeasured():
+        geom.SetMeasured(False)
+    try:
+        return sowkb.wkb_coords(geom.ExportToIsoWkb(ogr.wkbNDR))
+    except ValueError as e:
+        logging.warning("Geometry skipped: %s", e)
+        return np.zeros((0, 3)), None, None
+
+
+def feature_attrs(feature, fields):
+    """Return the {NAME: text value} of the set fields of an OGR feature,
+    fields being the (index, upper case name) of the attribute fields."""
+    return {name: feature.GetFieldAsString(i) for i, name in fields if feature.IsFieldSetAndNotNull(i)}
+
+
+def _open_layer(path, bbox=None, filt=None, strict=False):
+    """Open a SOSI file and its layer with the spatial and attribute
+    filters set. Return the data source (keep it while using the layer)
+    and the layer, or None, None (with strict raise OSError or ValueError)."""
+    with sostats.timer("file open"):
+        ds = ogr.Open(path)
+    if ds is None:
+        if strict:
+            raise OSError("GDAL can not open the file")
+        logging.error("Could not read %s", path)
+        return None, None
+    layer = ds.GetLayer(0)
+    if bbox is not None:
+        layer.SetSpatialFilterRect(*bbox)
+    where = filt.to_sql() if filt else None
+    if where and layer.SetAttributeFilter(where) != 0:
+        if strict:
+            raise ValueError("invalid attribute filter {}".format(where))
+        logging.error("%s: invalid attribute filter %s", path, where)
+        return None, None
+    return ds, layer
+
+
+def _read_features(features, fields, count=None):
+    """Read up to count (None: all) features from an enumerate(layer)
+    iterator, as the lists sosi_datahelper.FeatureBatch.from_lists takes.
+    fields are the attribute fields, see feature_attrs."""
+    lists = ([], [], [], [], [], [], [])
+    for idx, feature in features:
+        geom = feature.geometry()
+        if geom is None:
+            continue
+        gname = geom.GetGeometryName().upper()
+        if gname in ("POINT", "MULTIPOINT"):
+            obj_id = sodhlp.SosiObjId.PUNKT.value
+        elif gname in ("LINESTRING", "MULTILINESTRING"):
+            obj_id = sodhlp.SosiObjId.KURVE.value
+        elif gname in ("POLYGON", "MULTIPOLYGON"):
+            obj_id = sodhlp.SosiObjId.FLATE.value
+        else:
+            continue
+        with sostats.timer("coordinate decoding"):
+            coords, parts, holes = geometry_coords(geom)
+        if parts is None:
+            parts, holes = (0, len(coords)), (False,)
+        name = feature.GetField(sofilt.OGR_OBJTYPE_FIELD) or f"feat_{idx}"
+        for values, value in zip(lists, (obj_id, idx, name, coords, parts, holes,
+                                         feature_attrs(feature, fields))):
+            values.append(value)
+        if count is not None and len(lists[0]) >= count:
+            break
+    return lists
+
+
+def _layer_batches(path, layer, batch_size):
+    """Yield the features of an open layer as FeatureBatch of at most
+    batch_size features (None: one batch)."""
+    defn = layer.GetLayerDefn()
+    fields = [(i, defn.GetFieldDefn(i).GetName().upper()) for i in range(defn.GetFieldCount())
+              if defn.GetFieldDefn(i).GetName() != sofilt.OGR_OBJTYPE_FIELD]
+    features = enumerate(layer)
+    while True:
+        # Timed per batch, not while the caller has it
+        with sostats.timer("feature iteration"):
+            lists = _read_features(features, fields, batch_size)
+        if not lists[0]:
+            break
+        yield sodhlp.FeatureBatch.from_lists(os.path.basename(path), *lists)
+
+
+def iter_feature_batches(file_paths, batch_size=soset.PARSE_BATCH_FEATURES, bbox=None, filt=None,
+                         strict=False):
+    """Read SOSI files using GDAL, yielding their features as
+    sosi_datahelper.FeatureBatch of at most batch_size features.
+
+    A batch holds features of one file only. The serial numbers are the
+    OGR feature indices. Features with several parts (multi-geometries,
+    FLATE with holes) keep them as parts.
+
+    Args:
+        file_paths (list[str]): list of SOSI files to parse
+        batch_size (int): features per batch, None for one batch per file
+        bbox (tuple): optional (min E, min N, max E, max N), only
+            features intersecting it are read (OGR spatial filter)
+        filt (sosi_filter.FeatureFilter): optional OBJTYPE/attribute
+            filter, passed to OGR as an attribute filter
+        strict (bool): raise OSError or ValueError on files that can not
+            be read, instead of logging and skipping them
+    """
+    for path in file_paths:
+        ds, layer = _open_layer(path, bbox, filt, strict)
+        if layer is not None:
+            yield from _layer_batches(path, layer, batch_size)
+
+
+def process_sosi_files(file_paths, callback, bbox=None, filt=None):
     """Process SOSI files using GDAL and invoke callback for each feature.
 
+    Kept for the callers of the old per feature interface: the batches of
+    iter_feature_batches are replayed through the callback.
+
     Args:
         file_paths (list[str]): list of SOSI files to parse
-        callback (callable): function called for each geometry
+        callback (callable): function called for each geometry, the
+            coordinates are passed as an (n, 3) float64 array. Features
+            with several parts (multi-geometries, FLATE with holes) also
+            get the keyword arguments parts (part offsets into the
+            coordinates) and holes (True for interior rings). The other
+            fields are passed as attrs, {NAME: text value}
+        bbox (tuple): optional (min E, min N, max E, max N), only
+            features intersecting it are read (OGR spatial filter)
+        filt (sosi_filter.FeatureFilter): optional OBJTYPE/attribute
+            filter, passed to OGR as an attribute filter
     Returns:
         int: number of files processed
     """
     count = 0
     for path in file_paths:
-        ds = ogr.Open(path)
-        if ds is None:
+        ds, layer = _open_layer(path, bbox, filt)
+        if layer is None:
             continue
-        layer = ds.GetLayer(0)
-        for idx, feature in enumerate(layer):
-            geom = feature.geometry()
-            if geom is None:
-                continue
-            gname = geom.GetGeometryName().upper()
-            if gname in ("POINT", "MULTIPOINT"):
-                obj_id = sodhlp.SosiObjId.PUNKT.value
-            elif gname in ("LINESTRING", "MULTILINESTRING"):
-                obj_id = sodhlp.SosiObjId.KURVE.value
-            elif gname in ("POLYGON", "MULTIPOLYGON"):
-                obj_id = sodhlp.SosiObjId.FLATE.value
-            else:
-                continue
-            coords = [geom.GetPoint(i) for i in range(geom.GetPointCount())]
-            flat = [c for pt in coords for c in (pt[0], pt[1], pt[2])]
-            name = feature.GetField("objekttypenavn") or f"feat_{idx}"
-            callback(
-                obj_id,
-                idx,
-                0,
-                name.encode("utf-8"),
-                3,
-                len(coords),
-                flat,
-                os.path.basename(path).encode("utf-8"),
-            )
+        for batch in _layer_batches(path, layer, None):
+            batch.replay(callback)
         count += 1
     return count
@@ -25,10 +25,14 @@ This file is part of SosiImporter, an addon to import SOSI files containing
 """
 
 import numpy as np
+import heapq
 import math
 import logging
 from . import sosi_log_helper as sologhlp
 from . import sosi_settings as soset
+from . import sosi_datahelper as sodhlp
+from . import sosi_stats as sostats
+from . import sosi_triangulate as sotri
 
 # -----------------------------------------------------------------------------
 
@@ -342,3 +346,548 @@ def arc_pts_segments_3D(arc_pts, num_splits):
         arc_pts_nonhorz = arc_pts_horz
     return arc_pts_nonhorz
 
+# -----------------------------------------------------------------------------
+
+def arcs_tessellate(arcs, tolerance=soset.SOSI_ARC_TOLERANCE, max_segs=soset.SOSI_ARC_SEGMENTS):
+    """
+    Tessellate many 3-point arcs (BUEP) in one vectorised pass.
+    arcs is an (m, 3, 3) array holding start, middle and end point of m arcs.
+    Each arc gets the number of segments needed to keep the chord error
+    below tolerance, at most max_segs (at least 2), shared between the
+    half arcs (start to middle, middle to end) by angle. Collinear or otherwise degenerate arcs are kept
+    as the polyline through their 3 points.
+    Return coords, offsets: the (n, 3) points of all arcs and the per-arc
+    offsets into coords. The original 3 points are part of the result,
+    unchanged, so shared end points stay identical.
+    """
+    arcs = np.asarray(arcs, dtype=np.float64).reshape(-1, 3, 3)
+    p1, p2, p3 = arcs[:, 0], arcs[:, 1], arcs[:, 2]
+    a = p1 - p3
+    b = p2 - p3
+    axb = np.cross(a, b)
+    axb2 = np.einsum('ij,ij->i', axb, axb)
+    a2 = np.einsum('ij,ij->i', a, a)
+    b2 = np.einsum('ij,ij->i', b, b)
+    # Collinear (or coincident) points: the cross product vanishes
+    degen = axb2 <= 1e-18 * a2 * b2
+    degen |= (a2 == 0.0) | (b2 == 0.0)
+    axb2_safe = np.where(degen, 1.0, axb2)
+
+    # Circle center and plane basis (u towards p1, v a quarter turn further
+    # along the direction p1 -> p2 -> p3)
+    ctr = p3 + np.cross(a2[:, None] * b - b2[:, None] * a, axb) / (2.0 * axb2_safe[:, None])
+    ru = p1 - ctr
+    radius = np.sqrt(np.einsum('ij,ij->i', ru, ru))
+    radius_safe = np.where(degen | (radius == 0.0), 1.0, radius)
+    u = ru / radius_safe[:, None]
+    nrm = axb / np.sqrt(axb2_safe)[:, None]
+    v = np.cross(nrm, u)
+
+    def angle(p):
+        d = p - ctr
+        return np.arctan2(np.einsum('ij,ij->i', d, v), np.einsum('ij,ij->i', d, u)) % (2.0 * np.pi)
+    t2 = angle(p2)
+    t3 = angle(p3)
+    t3 = np.where(t3 <= t2, 2.0 * np.pi, t3) # p3 at p1 is a full circle
+
+    # Largest angle step with a chord error (sagitta) below tolerance
+    step = 2.0 * np.arccos(np.clip(1.0 - tolerance / radius_safe, -1.0, 1.0))
+    step = np.maximum(step, 1e-12)
+    max_segs = max(int(max_segs), 2)
+    n1 = np.clip(np.ceil(t2 / step), 1, max_segs).astype(np.int64)
+    n2 = np.clip(np.ceil((t3 - t2) / step), 1, max_segs).astype(np.int64)
+    over = n1 + n2 > max_segs
+    n1[over] = np.clip(np.rint(max_segs * t2[over] / t3[over]), 1, max_segs - 1)
+    n2[over] = max_segs - n1[over]
+    n1[degen] = 1
+    n2[degen] = 1
+
+    counts = n1 + n2 + 1
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    k = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    n1r = np.repeat(n1, counts)
+    t2r = np.repeat(t2, counts)
+    t = np.where(k <= n1r,
+                 k * t2r / n1r,
+                 t2r + (k - n1r) * (np.repeat(t3, counts) - t2r) / np.repeat(n2, counts))
+    coords = (np.repeat(ctr, counts, axis=0)
+              + np.repeat(radius, counts)[:, None]
+              * (np.cos(t)[:, None] * np.repeat(u, counts, axis=0)
+                 + np.sin(t)[:, None] * np.repeat(v, counts, axis=0)))
+    # Exact original points (this also makes degenerate arcs a polyline)
+    coords[offsets[:-1]] = p1
+    coords[offsets[:-1] + n1] = p2
+    coords[offsets[1:] - 1] = p3
+    return coords, offsets
+
+# -----------------------------------------------------------------------------
+
+def bbox_intersects(b1, b2):
+    """
+    Return True if the 2D boxes b1 and b2, given as (min x, min y, max x, max y),
+    intersect (touching counts).
+    """
+    return b1[0] <= b2[2] and b2[0] <= b1[2] and b1[1] <= b2[3] and b2[1] <= b1[3]
+
+# -----------------------------------------------------------------------------
+
+def features_in_bbox(coords, offsets, bbox):
+    """
+    Per-feature bounding box test. coords are the (n, 3) coordinates of all
+    features, feature i owns coords[offsets[i]:offsets[i + 1]].
+    Return a bool array, True for the features whose bounding box intersects
+    bbox (min x, min y, max x, max y). Features without coordinates are False.
+    """
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    keep = np.zeros(len(counts), dtype=bool)
+    nonempty = counts > 0
+    if not nonempty.any():
+        return keep
+    # Empty features own no coordinates, so reduceat over the non-empty
+    # starts gives exactly the range of each non-empty feature
+    starts = offsets[:-1][nonempty]
+    mins = np.minimum.reduceat(coords[:, :2], starts, axis=0)
+    maxs = np.maximum.reduceat(coords[:, :2], starts, axis=0)
+    keep[nonempty] = ((mins[:, 0] <= bbox[2]) & (maxs[:, 0] >= bbox[0])
+                      & (mins[:, 1] <= bbox[3]) & (maxs[:, 1] >= bbox[1]))
+    return keep
+
+# -----------------------------------------------------------------------------
+
+def weld_vertices(coords, tolerance):
+    """
+    Merge vertices closer than tolerance. In input order, each vertex is
+    merged into the first kept vertex within tolerance, or kept itself, so
+    merged vertices are within tolerance of the vertex they are merged
+    into (no chaining) and no two kept vertices are within tolerance.
+    Kept vertices keep their coordinates, so exactly shared points (SOSI
+    curve end points) stay exact. Near vertices are found in the 3x3
+    neighbouring cells of a horizontal grid of cell size tolerance.
+    Return the welded coords and, per input vertex, its index in them.
+    """
+    pts = np.asarray(coords, dtype=np.float64)
+    if len(pts) == 0:
+        return pts, np.zeros(0, dtype=np.int64)
+    # Cells numbered row by row, larger cells when the grid would not fit
+    # an int64, so the cells next to a cell are at fixed number offsets
+    lo = pts[:, :2].min(axis=0)
+    size = max(tolerance, float((pts[:, :2].max(axis=0) - lo).max()) / (1 << 30))
+    keys = np.floor((pts[:, :2] - lo) / size).astype(np.int64) + 1
+    ny = int(keys[:, 1].max()) + 2
+    cell = keys[:, 0] * ny + keys[:, 1]
+    order = np.argsort(cell, kind='stable')
+    cells = cell[order]
+    # Pairs (i, j) of near vertices with j < i, the other half of the
+    # neighbouring cells gives the same pairs the other way round
+    near_i, near_j = [], []
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        q = cells + (dx * ny + dy)
+        start = np.searchsorted(cells, q, 'left')
+        cnt = np.searchsorted(cells, q, 'right') - start
+        a = np.repeat(order, cnt)
+        b = order[sodhlp.ranges_concat(start, cnt)]
+        i, j = np.maximum(a, b), np.minimum(a, b)
+        near = (j < i) & (np.sum((pts[i] - pts[j]) ** 2, axis=1) <= tolerance * tolerance)
+        near_i.append(i[near])
+        near_j.append(j[near])
+    i, j = np.concatenate(near_i), np.concatenate(near_j)
+    if len(i) == 0:
+        return pts, np.arange(len(pts))
+    # Only vertices with an earlier near vertex need the sequential pass
+    pair_order = np.lexsort((j, i))
+    rep = list(range(len(pts)))
+    for a, b in zip(i[pair_order].tolist(), j[pair_order].tolist()):
+        if rep[a] == a and rep[b] == b:
+            rep[a] = b
+    rep = np.array(rep)
+    kept = rep == np.arange(len(pts))
+    new_index = np.cumsum(kept) - 1
+    return pts[kept], new_index[rep]
+
+# -----------------------------------------------------------------------------
+
+def weld_mesh_arrays(coords, edges, loops, loop_starts, tolerance, return_inverse=False):
+    """
+    Weld the vertices of mesh arrays (see blender_helper.Mesh.from_arrays)
+    with weld_vertices. Edges that collapse or repeat another edge are
+    dropped, as are repeated corners of faces and faces left with fewer
+    than 3 corners.
+    Return the welded coords, edges, loops and loop_starts, and with
+    return_inverse the welded index of each vertex.
+    """
+    coords, inverse = weld_vertices(coords, tolerance)
+    edges = inverse[np.asarray(edges, dtype=np.int64).reshape(-1, 2)]
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    if len(edges):
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+    loops = inverse[np.asarray(loops, dtype=np.int64)]
+    loop_starts = np.asarray(loop_starts, dtype=np.int64)
+    if len(loops):
+        sizes = np.diff(np.append(loop_starts, len(loops)))
+        face = np.repeat(np.arange(len(sizes)), sizes)
+        # Next corner of the same face
+        nxt = np.arange(1, len(loops) + 1)
+        nxt[loop_starts + sizes - 1] = loop_starts
+        keep = loops != loops[nxt]
+        sizes = np.bincount(face[keep], minlength=len(sizes))
+        keep &= (sizes >= 3)[face]
+        loops = loops[keep]
+        sizes = sizes[sizes >= 3]
+        loop_starts = np.cumsum(sizes) - sizes
+    res = coords, edges.astype(np.int32), loops.astype(np.int32), loop_starts.astype(np.int32)
+    return res + (inverse,) if return_inverse else res
+
+# -----------------------------------------------------------------------------
+
+def select_mesh_vertices(coords, edges, loops, loop_starts, keep):
+    """
+    Keep the vertices of mesh arrays (see blender_helper.Mesh.from_arrays)
+    where the bool array keep is True, with the edges and faces using
+    only those. Return the new coords, edges, loops and loop_starts.
+    """
+    new_index = np.cumsum(keep, dtype=np.int64) - 1
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    edges = new_index[edges[keep[edges].all(axis=1)]]
+    loops = np.asarray(loops, dtype=np.int64)
+    loop_starts = np.asarray(loop_starts, dtype=np.int64)
+    if len(loops):
+        sizes = np.diff(np.append(loop_starts, len(loops)))
+        face_keep = np.logical_and.reduceat(keep[loops], loop_starts)
+        loops = new_index[loops[np.repeat(face_keep, sizes)]]
+        sizes = sizes[face_keep]
+        loop_starts = np.cumsum(sizes) - sizes
+    return coords[keep], edges.astype(np.int32), loops.astype(np.int32), loop_starts.astype(np.int32)
+
+# -----------------------------------------------------------------------------
+
+def _line_ends(offsets, n):
+    """Bool mask of the first and last vertex of each polyline."""
+    ends = np.zeros(n, dtype=bool)
+    counts = np.diff(offsets)
+    ends[offsets[:-1][counts > 0]] = True
+    ends[offsets[1:][counts > 0] - 1] = True
+    return ends
+
+
+def _keep_closed_rings(coords, offsets, keep):
+    """
+    Closed polylines (first point == last point) simplified to less than 4
+    vertices are no rings any more: keep the vertex farthest from the start
+    and the one farthest from the line through those two as well.
+    Return keep, updated in place.
+    """
+    counts = np.diff(offsets)
+    first, last = offsets[:-1], offsets[1:] - 1
+    closed = counts >= 4
+    closed[closed] = np.all(coords[first[closed]] == coords[last[closed]], axis=1)
+    kept = np.add.reduceat(keep.astype(np.int64), offsets[:-1][counts > 0])
+    short = np.zeros(len(counts), dtype=bool)
+    short[counts > 0] = kept < 4
+    for line in np.flatnonzero(closed & short):
+        pts = coords[first[line]:last[line]]
+        d = pts - pts[0]
+        far = int(np.argmax(np.einsum('ij,ij->i', d, d)))
+        cr = np.cross(d, pts[far] - pts[0])
+        keep[first[line] + far] = True
+        keep[first[line] + int(np.argmax(np.einsum('ij,ij->i', cr, cr)))] = True
+    return keep
+
+
+def douglas_peucker(coords, offsets, tolerance):
+    """
+    Douglas-Peucker simplification of all polylines coords[offsets[i]:offsets[i + 1]]
+    at once. The segments of all lines still to split are handled together,
+    one level of the recursion per round. Distances are 3D, to the chord
+    segment, so closed lines work too. Return the bool mask of the vertices
+    to keep; the end points of every line are kept.
+    """
+    keep = _line_ends(offsets, len(coords))
+    counts = np.diff(offsets)
+    long = counts > 2
+    starts = offsets[:-1][long]
+    ends = offsets[1:][long] - 1
+    tol2 = tolerance * tolerance
+    while len(starts):
+        inner = ends - starts - 1
+        idx = sodhlp.ranges_concat(starts + 1, inner)
+        seg = np.repeat(np.arange(len(starts)), inner)
+        a = coords[starts][seg]
+        ab = coords[ends][seg] - a
+        ap = coords[idx] - a
+        l2 = np.einsum('ij,ij->i', ab, ab)
+        t = np.clip(np.einsum('ij,ij->i', ap, ab) / np.where(l2 > 0, l2, 1.0), 0.0, 1.0)
+        d = ap - t[:, None] * ab
+        d2 = np.einsum('ij,ij->i', d, d)
+        first = np.cumsum(inner) - inner
+        dmax = np.maximum.reduceat(d2, first)
+        # First vertex at the max distance of each segment
+        at_max = np.flatnonzero(d2 == dmax[seg])
+        at_max = at_max[np.unique(seg[at_max], return_index=True)[1]]
+        split = dmax > tol2
+        pos = idx[at_max][split]
+        keep[pos] = True
+        starts = np.concatenate((starts[split], pos))
+        ends = np.concatenate((pos, ends[split]))
+        todo = ends - starts > 1
+        starts, ends = starts[todo], ends[todo]
+    return _keep_closed_rings(coords, offsets, keep)
+
+
+VISVALINGAM_ROUNDS = 32   # Vectorised rounds before finishing lines one by one
+
+
+def _triangle_area2(pts, i, j, k):
+    """Squared doubled area of the triangle of the points i, j and k of pts,
+    a list of (x, y, z) tuples."""
+    (ax, ay, az), (bx, by, bz), (cx, cy, cz) = pts[i], pts[j], pts[k]
+    ux, uy, uz = bx - ax, by - ay, bz - az
+    vx, vy, vz = cx - ax, cy - ay, cz - az
+    x, y, z = uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+    return x * x + y * y + z * z
+
+
+def _visvalingam_line(coords, idx, min_area2):
+    """Visvalingam-Whyatt simplification of the one polyline coords[idx]
+    with a heap, smallest area first. Return the indices kept."""
+    pts = coords[idx].tolist()
+    n = len(pts)
+    prv = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    area = [None] + [_triangle_area2(pts, i - 1, i, i + 1) for i in range(1, n - 1)] + [None]
+    heap = [(area[i], i) for i in range(1, n - 1)]
+    heapq.heapify(heap)
+    alive = [True] * n
+    while heap:
+        a, i = heapq.heappop(heap)
+        if not alive[i] or a != area[i]:
+            continue  # Removed, or its area changed since
+        if a >= min_area2:
+            break
+        alive[i] = False
+        p, q = prv[i], nxt[i]
+        nxt[p], prv[q] = q, p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                area[j] = _triangle_area2(pts, prv[j], j, nxt[j])
+                heapq.heappush(heap, (area[j], j))
+    return idx[np.flatnonzero(alive)]
+
+
+def visvalingam(coords, offsets, tolerance):
+    """
+    Visvalingam-Whyatt simplification of all polylines at once: vertices
+    whose triangle with their neighbours has an area below tolerance**2 are
+    removed, smallest first. Each round removes the vertices that are local
+    minima of the area (never two neighbours), then the areas are updated.
+    A line can need one round per vertex (areas growing along it), so after
+    VISVALINGAM_ROUNDS the lines not done yet are finished one by one with
+    a heap (_visvalingam_line).
+    Return the bool mask of the vertices to keep; end points are kept.
+    """
+    counts = np.diff(offsets)
+    feat = np.repeat(np.arange(len(counts)), counts)
+    rem = np.arange(len(coords))
+    min_area2 = (tolerance * tolerance) ** 2 * 4.0   # Compare squared doubled areas
+    for rnd in range(VISVALINGAM_ROUNDS + 1):
+        if len(rem) <= 2:
+            break
+        f = feat[rem]
+        interior = (f[1:-1] == f[:-2]) & (f[1:-1] == f[2:])
+        a = coords[rem[:-2]]
+        cr = np.cross(coords[rem[1:-1]] - a, coords[rem[2:]] - a)
+        area = np.where(interior, np.einsum('ij,ij->i', cr, cr), np.inf)
+        left = np.concatenate(([np.inf], area[:-1]))
+        right = np.concatenate((area[1:], [np.inf]))
+        sel = (area < min_area2) & (area <= left) & (area <= right)
+        if not sel.any():
+            break
+        if rnd == VISVALINGAM_ROUNDS:
+            # Finish the lines still having vertices to remove one by one
+            keep = np.zeros(len(coords), dtype=bool)
+            keep[rem] = True
+            for line in np.unique(f[1:-1][sel]):
+                lo, hi = np.searchsorted(f, [line, line + 1])
+                keep[rem[lo:hi]] = False
+                keep[_visvalingam_line(coords, rem[lo:hi], min_area2)] = True
+            return _keep_closed_rings(coords, offsets, keep)
+        # Of a run of equal minima only every other vertex goes this round
+        pos = np.arange(len(sel))
+        run_start = np.maximum.accumulate(np.where(sel & ~np.concatenate(([False], sel[:-1])), pos, 0))
+        sel &= (pos - run_start) % 2 == 0
+        rem = np.delete(rem, np.flatnonzero(sel) + 1)
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[rem] = True
+    return _keep_closed_rings(coords, offsets, keep)
+
+
+SIMPLIFY_METHODS = {'DOUGLAS_PEUCKER': douglas_peucker, 'VISVALINGAM': visvalingam}
+
+
+def simplify_batch(batch, tolerance, method='DOUGLAS_PEUCKER'):
+    """
+    Return a copy of a sosi_datahelper.FeatureBatch with its KURVE features
+    simplified (see SIMPLIFY_METHODS). The end points of every part stay,
+    so lines sharing an end point still meet. Arcs (BUEP, tessellated later), points and
+    surfaces (whose rings must stay valid for the triangulation) are kept
+    as they are.
+    """
+    # Each part of a multi-part line (GDAL MULTILINESTRING) on its own
+    counts = np.diff(batch.part_offsets)
+    part_ids = np.repeat(batch.obj_ids, np.diff(batch.feat_parts))
+    lines = np.flatnonzero((part_ids == sodhlp.SosiObjId.KURVE.value) & (counts > 2))
+    vidx = sodhlp.ranges_concat(batch.part_offsets[lines], counts[lines])
+    keep = np.ones(len(batch.coords), dtype=bool)
+    with sostats.timer("simplification"):
+        keep[vidx] = SIMPLIFY_METHODS[method](batch.coords[vidx], np.concatenate(
+            ([0], np.cumsum(counts[lines]))), tolerance)
+    # Kept vertices before each old offset give the new offsets
+    kept = np.concatenate(([0], np.cumsum(keep))).astype(np.int64)
+    return sodhlp.FeatureBatch(batch.filename, batch.obj_ids, batch.serials, batch.names,
+                               batch.coords[keep], kept[batch.offsets], kept[batch.part_offsets],
+                               batch.feat_parts, batch.holes, batch.attrs)
+
+# -----------------------------------------------------------------------------
+
+def parts_to_edgarray(parts):
+    """
+    Edges chaining the points of each part (line), part j being the points
+    parts[j]:parts[j + 1]. No edge joins the end of a part to the next one.
+    """
+    edges = sodhlp.points_to_edgarray(int(parts[-1]))
+    return edges[~np.isin(edges[:, 1], parts[1:-1])]
+
+# -----------------------------------------------------------------------------
+
+def polygon_mesh_data(coords, parts, holes):
+    """
+    Mesh data of a FLATE made of several rings: coords holds the rings,
+    ring j is coords[parts[j]:parts[j + 1]] and holes[j] tells if it is an
+    interior ring of the exterior ring before it.
+    A polygon with holes is triangulated (see sosi_triangulate), one
+    without holes stays a single ngon.
+    Return coords, None and the faces, indices local to the returned coords.
+    """
+    rings = [sodhlp.ring_open(coords[parts[j]:parts[j + 1]]) for j in range(len(parts) - 1)]
+    sizes = [len(r) for r in rings]
+    ring_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    coords = np.concatenate(rings) if rings else np.zeros((0, 3))
+    starts = [j for j in range(len(rings)) if not holes[j]] + [len(rings)]
+    ngons, tris = [], []
+    for k in range(len(starts) - 1):
+        j0, j1 = starts[k], starts[k + 1]
+        base = ring_offsets[j0]
+        if sizes[j0] < 3:
+            continue
+        if j1 - j0 == 1:
+            ngons.append(np.arange(base, base + sizes[j0], dtype=np.int32))
+        else:
+            poly = coords[base:ring_offsets[j1]]
+            tris.append(sotri.polygon_triangulate(poly, ring_offsets[j0:j1 + 1] - base) + base)
+    if not ngons:
+        faces = np.concatenate(tris) if tris else None
+    else:
+        faces = ngons + [t for tri in tris for t in tri]
+    return coords, None, faces
+
+# -----------------------------------------------------------------------------
+
+def feature_mesh_data(sosi_id, coords, parts=None, holes=None):
+    """
+    Turn the (n, 3) coordinates of a SOSI feature into mesh data.
+    Return coords, edges and faces (or None), indices local to the feature:
+    PUNKT gives loose vertices, KURVE an edge chain, BUEP the tessellated
+    arc as an edge chain and FLATE a single ngon, or triangles when the
+    FLATE has holes. A feature of several parts (part offsets and hole
+    flags, see polygon_mesh_data) gives one edge chain per line and one
+    face (or triangle set) per polygon.
+    """
+    if (sosi_id == sodhlp.SosiObjId.PUNKT):
+        return coords, None, None
+    elif (sosi_id == sodhlp.SosiObjId.FLATE):
+        with sostats.timer("face fill"):
+            if parts is not None:
+                return polygon_mesh_data(coords, parts, holes)
+            # The ngon goes straight into the mesh data, no edit mode operators needed
+            ring = sodhlp.ring_open(coords)
+            fac_list = sodhlp.ring_to_facelist(ring)
+        if fac_list:
+            return ring, None, fac_list
+    elif (sosi_id == sodhlp.SosiObjId.BUEP) and (len(coords) == 3):
+        with sostats.timer("arc tessellation"):
+            coords = arcs_tessellate(coords)[0]
+    elif parts is not None:
+        return coords, parts_to_edgarray(parts), None
+    return coords, sodhlp.points_to_edgarray(len(coords)), None
+
+# -----------------------------------------------------------------------------
+
+def feature_batch_mesh_data(batch, hashes=None):
+    """
+    Prepare the mesh data (see feature_mesh_data) for all features of
+    a sosi_datahelper.FeatureBatch. Return a sosi_datahelper.MeshData.
+    All arcs of the batch are tessellated in a single call and the vertices
+    and edge chains of the points and lines are laid out with offset
+    arithmetic, only the FLATE go through feature_mesh_data one by one.
+    hashes are the batch.hashes() when already computed.
+    """
+    n = len(batch)
+    ids = batch.obj_ids
+    counts = np.diff(batch.offsets)
+    arc_idx = np.flatnonzero((ids == sodhlp.SosiObjId.BUEP.value) & (counts == 3))
+    arcs = batch.coords[batch.offsets[arc_idx][:, None] + np.arange(3)]
+    with sostats.timer("arc tessellation"):
+        arc_coords, arc_offsets = arcs_tessellate(arcs)
+    flate_idx = np.flatnonzero(ids == sodhlp.SosiObjId.FLATE.value)
+    flates = sodhlp.MeshData.from_geoms(
+        batch.filename, ids[flate_idx], batch.serials[flate_idx], None,
+        [feature_mesh_data(sodhlp.SosiObjId.FLATE, batch.feature_coords(i), *batch.feature_parts(i))
+         for i in flate_idx.tolist()])
+
+    # Vertices: the batch coords, the tessellated arcs or the FLATE geometry
+    nverts = counts.copy()
+    nverts[arc_idx] = np.diff(arc_offsets)
+    nverts[flate_idx] = np.diff(flates.vert_offsets)
+    vert_offsets = np.concatenate(([0], np.cumsum(nverts))).astype(np.int64)
+    coords = np.empty((vert_offsets[-1], 3))
+    plain = np.ones(n, dtype=bool)
+    plain[arc_idx] = False
+    plain[flate_idx] = False
+    idx = np.flatnonzero(plain)
+    coords[sodhlp.ranges_concat(vert_offsets[idx], nverts[idx])] = \
+        batch.coords[sodhlp.ranges_concat(batch.offsets[idx], nverts[idx])]
+    coords[sodhlp.ranges_concat(vert_offsets[arc_idx], nverts[arc_idx])] = arc_coords
+    flate_shift = vert_offsets[flate_idx] - flates.vert_offsets[:-1]
+    coords[sodhlp.ranges_concat(vert_offsets[flate_idx], nverts[flate_idx])] = flates.coords
+
+    # Edge chains of the lines: an edge from each vertex but the last one of
+    # each part, parts of arcs and single part lines are the whole feature
+    line = ids != sodhlp.SosiObjId.PUNKT.value
+    line[flate_idx] = False
+    chain = np.repeat(line, nverts)
+    chain[vert_offsets[1:][line & (nverts > 0)] - 1] = False
+    lines = np.flatnonzero(line & plain)
+    nparts = batch.feat_parts[lines + 1] - batch.feat_parts[lines]
+    parts = sodhlp.ranges_concat(batch.feat_parts[lines] + 1, np.maximum(nparts - 1, 0))
+    part_feature = np.repeat(lines, np.maximum(nparts - 1, 0))
+    part_starts = batch.part_offsets[parts] - batch.offsets[part_feature] + vert_offsets[part_feature]
+    chain[part_starts[part_starts > vert_offsets[part_feature]] - 1] = False
+    starts = np.flatnonzero(chain)
+    line_edges = np.column_stack((starts, starts + 1))
+    flate_edges = flates.edges + np.repeat(flate_shift, np.diff(flates.edge_offsets))[:, None]
+    # Both are sorted by vertex, so by feature
+    edges = np.concatenate((line_edges, flate_edges))
+    edges = edges[np.argsort(edges[:, 0], kind='stable')].astype(np.int32)
+    nedges = np.bincount(np.searchsorted(vert_offsets, edges[:, 0], side='right') - 1, minlength=n)
+
+    # Faces only come from the FLATE
+    nfaces = np.zeros(n, dtype=np.int64)
+    nfaces[flate_idx] = np.diff(flates.face_offsets)
+    nloops = np.diff(flates.loop_starts[flates.face_offsets])
+    loops = (flates.loops + np.repeat(flate_shift, nloops)).astype(np.int32)
+
+    if hashes is None:
+        hashes = batch.hashes()
+    return sodhlp.MeshData(batch.filename, ids, batch.serials, batch.names, coords, vert_offsets,
+                           edges, np.concatenate(([0], np.cumsum(nedges))), loops, flates.loop_starts,
+                           np.concatenate(([0], np.cumsum(nfaces))), hashes, batch.attrs)
@@ -23,21 +23,20 @@ This file is part of SosiImporter, an addon to import SOSI files containing
 3D model data into Blender.
 """
 
-import bpy
 import os
-import numpy as np
 import logging
-import platform
+import queue
+import threading
+import time
 
-try:
-    from osgeo import ogr  # noqa
-    GDAL_AVAILABLE = True
-except Exception:
-    GDAL_AVAILABLE = False
-    
 from . import sosi_settings as soset
 from . import sosi_log_helper as sologhlp
-from . import sosi_geom_helper as sogeohlp
+from . import sosi_cache
+from . import sosi_core
+from . import sosi_filter
+from . import sosi_native_parser
+from . import sosi_stats as sostats
+from . import sosi_tiles as sotiles
 
 # -----------------------------------------------------------------------------
 RES_SOSI_GENERAL_ERROR	    = 0x0001
@@ -48,7 +47,17 @@ RES_SOSI_LOOP_UNCLOSED      = 0x0100
 #D = bpy.data
 
 # Parent object for all SOSI elements
-#top_parent = None
+SOSI_PARENT_NAME = "SOSI_Parent"
+
+# The ImportJob started and not ended yet, one runs at a time
+_running_job = None
+
+# Scene custom property holding the sosi_tiles.TileIndex of a tiled import
+TILE_INDEX_PROP = "sosi_tile_index"
+# Collection custom property holding the (ix, iy) of a tile collection
+TILE_PROP = "sosi_tile"
+# Collection custom property holding the level of a level of detail collection
+LOD_PROP = "sosi_lod"
 
 # Determine if the code is running from within Blender
 in_blender = True
@@ -63,12 +72,14 @@ except ModuleNotFoundError:
 if (in_blender == True):
     from . import sosi_datahelper as sodhlp    
     from . import blender_helper as bldhlp
-    from bpy.types import AddonPreferences
-    from bpy.props import EnumProperty
+    from bpy.types import AddonPreferences, Operator, PropertyGroup
+    from bpy.props import BoolProperty, CollectionProperty, EnumProperty, FloatProperty, IntProperty, StringProperty
+    from bpy_extras.io_utils import ImportHelper
 else:
-    import sosi_datahelper as sodhlp    
-    import blender_helper as bldhlp
-    
+    # The operators and blender_helper need bpy, sosi_core reads SOSI files
+    # into mesh data without Blender
+    raise ImportError('sosi_importer only runs in Blender, use sosi_core outside Blender')
+
 #import sosi_datahelper as sodhlp
 #from . import sosi_datahelper as sodhlp
 #from sosi_importer import sosi_datahelper as sodhlp # from directory sosi_importer
@@ -84,10 +95,7 @@ class SosiImporterPreferences(AddonPreferences):
     bl_idname = __package__
     
     def update_log_level(self, context):
-        logging.info("Setting log level to %s", self.log_level)
-        #logging.setLevel(self.log_level)
-        #print('-->', self.log_level)
-        return
+        sologhlp.get_logger(self.log_level)
     
     # Debug levels:
     # CRITICAL  50
@@ -110,6 +118,70 @@ class SosiImporterPreferences(AddonPreferences):
         items = log_levels,
         update = update_log_level,  # update method when changing
         default = 'INFO')
+
+    parser_engines = [
+        ('NATIVE', "Native", "Built-in SOSI reader, no extra libraries needed", 0),
+        ('GDAL', "GDAL", "Read the files with the GDAL/OGR SOSI driver (requires the GDAL Python bindings)", 1)
+        ]
+
+    parser_engine: EnumProperty(
+        name = "SOSI parser",
+        description = "Engine used to read the SOSI files",
+        items = parser_engines,
+        default = 'NATIVE')
+
+    use_cache: BoolProperty(
+        name = "Cache parsed files",
+        description = "Keep parsed SOSI files in an on-disk cache, files imported again are not parsed again unless they changed",
+        default = True)
+
+    cache_dir: StringProperty(
+        name = "Cache directory",
+        description = "Directory for the parsed files cache. Empty uses a directory in the system temporary directory",
+        subtype = 'DIR_PATH',
+        default = "")
+
+    cache_max_mb: IntProperty(
+        name = "Cache size limit (MB)",
+        description = "Least recently used files are removed from the cache when it grows beyond this size",
+        default = 1024,
+        min = 1)
+
+    parallel_workers: IntProperty(
+        name = "Parsing processes",
+        description = "Number of worker processes parsing files when several files are imported. 0 uses one per CPU core, 1 parses on the main thread",
+        default = 0,
+        min = 0,
+        max = 256)
+
+    stats_modes = [
+        ('NONE', "Off", "No instrumentation", 0),
+        ('SUMMARY', "Summary", "Print the time per import stage and the features per type after each import", 1),
+        ('JSON', "JSON", "Print the statistics as JSON after each import", 2)
+        ]
+
+    stats_mode: EnumProperty(
+        name = "Import statistics",
+        description = "Time the import stages and count the features, printed to the system console",
+        items = stats_modes,
+        default = 'NONE')
+
+    stats_memory: BoolProperty(
+        name = "Trace memory",
+        description = "Also report the peak memory allocated by Python (tracemalloc, slows the import down) and the peak resident memory of each stage",
+        default = False)
+
+    memory_budget_mb: IntProperty(
+        name = "Memory budget (MB)",
+        description = "Create the objects whenever the geometry collected for them reaches this size, instead of once all files are parsed. Bounds the memory of large imports. 0 for no limit",
+        default = 0,
+        min = 0)
+
+    stats_profile: StringProperty(
+        name = "cProfile output",
+        description = "Write a cProfile dump of each import to this file, empty for no profiling",
+        subtype = 'FILE_PATH',
+        default = "")
     
 #    def update_test_xenums(self, context):
 #        print("Hey")
@@ -132,203 +204,782 @@ class SosiImporterPreferences(AddonPreferences):
     def draw(self, context):
         layout = self.layout
         layout.prop(self, "log_level")
+        layout.prop(self, "parser_engine")
+        layout.prop(self, "parallel_workers")
+        layout.prop(self, "memory_budget_mb")
+        layout.prop(self, "use_cache")
+        col = layout.column()
+        col.enabled = self.use_cache
+        col.prop(self, "cache_dir")
+        col.prop(self, "cache_max_mb")
+        layout.operator(ClearSOSICache.bl_idname)
+        layout.prop(self, "stats_mode")
+        col = layout.column()
+        col.enabled = self.stats_mode != 'NONE'
+        col.prop(self, "stats_memory")
+        col.prop(self, "stats_profile")
 #        layout.prop(self, "test_xenum")
 
 # -----------------------------------------------------------------------------
 
-def coord_array_to_list(ndims, ncoords, ary):
-    coordList = []
-    if (ndims == 2):
-        for i in range(ncoords):
-            coordList.append((ary[i * 2], ary[i * 2 + 1], 0.0))
-    else: # ndims == 3
-        for i in range(ncoords):
-            coordList.append((ary[i * 3], ary[i * 3 + 1], ary[i * 3 + 2]))
-    return coordList
+class ClearSOSICache(Operator):
+    """Remove all parsed SOSI files from the cache."""
+    bl_idname = "import_files.sosi_clear_cache"
+    bl_label = "Clear SOSI Cache"
+
+    def execute(self, context):
+        addon_prefs = context.preferences.addons[__package__].preferences
+        n = get_feature_cache(addon_prefs).clear()
+        self.report({'INFO'}, 'Removed {} cached SOSI files'.format(n))
+        return {'FINISHED'}
 
 # -----------------------------------------------------------------------------
 
+class ImportJobModal():
+    """Runs an ImportJob as a modal operator: the job works a little on each
+    timer tick, shows its progress in the status bar, Esc cancels it."""
+
+    # Running import and its timer, see modal()
+    _job = None
+    _timer = None
+
+    def run_job(self, context, job):
+        if import_running():
+            self.report({'ERROR'}, 'A SOSI import is running, wait for it to end or cancel it')
+            return {'CANCELLED'}
+        if context.window is None:
+            # No window to run modal in (background mode)
+            job.run()
+            return {'FINISHED'}
+        self._job = job
+        job.start()
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(soset.IMPORT_TICK_SECONDS, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, len(job.file_list))
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        job = self._job
+        if event.type == 'ESC' and event.value == 'PRESS':
+            job.cancel()
+            self.end_modal(context)
+            self.report({'WARNING'}, 'SOSI import cancelled after {} of {} files'.format(
+                job.nfiles, len(job.file_list)))
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        try:
+            done = job.step()
+        except Exception as e:
+            job.cancel()
+            self.end_modal(context)
+            logging.exception('SOSI import failed')
+            self.report({'ERROR'}, 'SOSI import failed: {}'.format(e))
+            return {'CANCELLED'}
+        if done:
+            self.end_modal(context)
+            self.report({'INFO'}, 'Imported {} SOSI files: {} features, {} vertices'.format(
+                job.nfiles, job.nfeatures, job.nverts))
+            return {'FINISHED'}
+        context.workspace.status_text_set(job.progress_text())
+        context.window_manager.progress_update(job.nfiles)
+        return {'RUNNING_MODAL'}
+
+    def cancel(self, context):
+        # Blender ends the modal operator, e.g. when loading another file
+        self._job.cancel()
+        self.end_modal(context)
+
+    def end_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        self._job = None
+        self._timer = None
+
 # -----------------------------------------------------------------------------
 
-# Function will be called per sosi object and return ptr to object name, ptr to coordinate array 
-def my_cb_func(id, objrefnum, sosires, pobjname, ndims, ncoords, pcoord_ary, pfilename):
-	
-    #global top_parent
-    #print('PAR2 before:', top_parent)
-    
-    sosi_parent_name = "SOSI_Parent"  
-    top_parent = bldhlp.get_or_create_SOSI_parent_object(sosi_parent_name)
-	
-    objname = pobjname.decode('utf-8')  # Interpret the byte array as utf-8
-    #print(objname)
-    # NUMPY copy
-    a = np.fromiter(pcoord_ary, dtype=np.double, count=ndims * ncoords)
-    coord_list = coord_array_to_list(ndims, ncoords, a)
-    #print("A", coord_list)
-    #bpy.ops.object.mode_set(mode = 'OBJECT')
-    filename = pfilename.decode('utf8')
-    #print(filename) # pfilename is already utf8
-    coll = bldhlp.Collection.get_or_create_linked_subcollection_by_name('SOSI', filename)
-    
-    if (sodhlp.SosiObjId(id) == sodhlp.SosiObjId.PUNKT):
-        ob = bldhlp.Mesh.point_cloud(objname, coord_list)
-        
-        if bldhlp.get_mesh_obj_named(objname) != None:
-            ob = bldhlp.mesh_obj_join_existing(objname, ob)
-            #print('  Joined', ob.data)
-            logging.debug('  Joined', ob.data)
-        else:
-            ob.parent = top_parent
-            #bpy.context.collection.objects.link(ob)
-            coll.objects.link(ob)
-            
-        bldhlp.lock_obj_to_parent(ob)
-        #print('PUNKT {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        logging.info('PUNKT {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-    elif (sodhlp.SosiObjId(id) == sodhlp.SosiObjId.KURVE):
-        #print("A", coord_list)
-        edg_list = sodhlp.points_to_edglist(coord_list)
-        #print("B", edg_list)
-        ob = bldhlp.Mesh.point_cloud(objname, coord_list, edg_list)
-        
-        if bldhlp.get_mesh_obj_named(objname) != None:
-            ob = bldhlp.mesh_obj_join_existing(objname, ob)
-            #print('  Joined', ob.data)
-            logging.debug('  Joined', ob.data)
-        else:
-            ob.parent = top_parent
-            #bpy.context.collection.objects.link(ob)
-            coll.objects.link(ob)
-            
-        bldhlp.lock_obj_to_parent(ob)
-        #print('KURVE {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        logging.info('KURVE {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-    elif (sodhlp.SosiObjId(id) == sodhlp.SosiObjId.FLATE):
-        #print("A", coord_list)
-        edg_list = sodhlp.points_to_edglist(coord_list)
-        ob = bldhlp.Mesh.point_cloud(objname, coord_list, edg_list)
-        
-        if bldhlp.get_mesh_obj_named(objname) != None:
-            ob = bldhlp.mesh_obj_join_existing(objname, ob)
-            #print('  Joined', ob.data)
-            logging.debug('  Joined', ob.data)
-        else:
-            ob.parent = top_parent
-            #ob = bldhlp.Mesh.point_cloud(filename, coord_list, edg_list)
-            #bpy.context.collection.objects.link(ob)
-            coll.objects.link(ob)
-            
-        bldhlp.lock_obj_to_parent(ob)
-        #print ('FLATE {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        logging.info('FLATE {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        if (sosires & RES_SOSI_DIMENSION_MISMATCH):
-            print('  WARNING: Dimension mismatch in FLATE elements, drawing might be strange.')
-        bpy.ops.object.select_all(action='DESELECT')
-        bpy.context.view_layer.objects.active = ob
-        ob.select_set(True)
-        bpy.ops.object.mode_set(mode = 'EDIT') 
-        bpy.ops.mesh.select_mode(type="EDGE")
-        bpy.ops.mesh.select_all(action = 'SELECT')
-        bpy.ops.mesh.edge_face_add() # Make the ngon
-        #bpy.ops.mesh.quads_convert_to_tris(quad_method='BEAUTY', ngon_method='BEAUTY') # Triangulate
-        bpy.ops.object.mode_set(mode = 'OBJECT')
-    elif (sodhlp.SosiObjId(id) == sodhlp.SosiObjId.BUEP):
-        num_segs = 8
-        arc_seg_pts = sogeohlp.arc_pts_segments_3D(coord_list, num_segs)
-        edg_list = sodhlp.points_to_edglist(arc_seg_pts)
-        ob = bldhlp.Mesh.point_cloud(objname, arc_seg_pts, edg_list)
-        
-        if bldhlp.get_mesh_obj_named(objname) != None:
-            ob = bldhlp.mesh_obj_join_existing(objname, ob)
-            #print('  Joined', ob.data)
-            logging.debug('  Joined', ob.data)
+class ImportSOSIData(ImportJobModal, Operator, ImportHelper):
+    """Import SOSI data."""
+    bl_idname = "import_files.sosi_data"
+    bl_label = "Import SOSI Data"
+
+    filename_ext = ".sos"
+    filter_glob: StringProperty(default="*.sos", options={'HIDDEN'})
+    files: CollectionProperty(type=PropertyGroup)
+
+    bbox_mode: EnumProperty(
+        name='Spatial window',
+        description='Only import the features intersecting a rectangle',
+        items=(('NONE', 'None', 'Import all features'),
+               ('COORDS', 'Coordinates', 'Rectangle given by min/max east and north'),
+               ('OBJECT', 'Selected objects', 'Bounding box of the selected objects')),
+        default='NONE',
+    )
+    min_e: FloatProperty(name='Min East', default=0.0)
+    min_n: FloatProperty(name='Min North', default=0.0)
+    max_e: FloatProperty(name='Max East', default=0.0)
+    max_n: FloatProperty(name='Max North', default=0.0)
+
+    objtype_include: StringProperty(
+        name='Include types',
+        description='Comma separated OBJTYPE values to import, empty imports all types',
+        default='',
+    )
+    objtype_exclude: StringProperty(
+        name='Exclude types',
+        description='Comma separated OBJTYPE values not to import',
+        default='',
+    )
+    attr_filter: StringProperty(
+        name='Attributes',
+        description="Comma separated attribute conditions that must all hold, e.g. 'HØYDE>100, MEDIUM=T'",
+        default='',
+    )
+    show_objtypes: BoolProperty(
+        name='List types in files',
+        description='Scan the selected files and list the OBJTYPE values found',
+        default=False,
+    )
+
+    point_symbols: StringProperty(
+        name='Point symbols',
+        description='Collection of symbol objects to draw on the points (PUNKT) instead of vertices, '
+                    'one of its objects per point',
+        default='',
+    )
+    tile_size: FloatProperty(
+        name='Tile size',
+        description='Split the features into square tiles of this size (in meters), '
+                    'each with its own collection. 0 imports without tiles',
+        default=0.0,
+        min=0.0,
+    )
+    tile_lazy: BoolProperty(
+        name='Only tiles near the 3D cursor',
+        description='Import only the tiles near the 3D cursor, load the others later '
+                    'with Load SOSI Tiles',
+        default=False,
+    )
+    tile_radius: IntProperty(
+        name='Radius',
+        description='Tiles to load around the tile of the 3D cursor, in each direction',
+        default=2,
+        min=0,
+    )
+    update: BoolProperty(
+        name='Update changed features',
+        description='Compare with the objects of an earlier import of the same files: '
+                    'only add new and changed features and remove the deleted ones',
+        default=False,
+    )
+    feature_keys: BoolProperty(
+        name='Store feature keys',
+        description='Store the key of each feature on its vertices (8 bytes per vertex), so a later '
+                    'update only replaces the changed features instead of all features of the file',
+        default=False,
+    )
+    simplify_method: EnumProperty(
+        name='Simplify lines',
+        description='Remove vertices of curves (KURVE) that add little to their shape, '
+                    'end points are kept',
+        items=(('NONE', 'None', 'Import all vertices'),
+               ('DOUGLAS_PEUCKER', 'Douglas-Peucker', 'Keep the vertices farther than the tolerance '
+                                                      'from the simplified line'),
+               ('VISVALINGAM', 'Visvalingam', 'Remove the vertices making triangles smaller than '
+                                              'the tolerance squared')),
+        default='NONE',
+    )
+    simplify_tolerance: FloatProperty(
+        name='Tolerance',
+        description='Simplification tolerance (in meters) of the most detailed level',
+        default=0.5,
+        min=0.0,
+        precision=3,
+    )
+    lod_levels: IntProperty(
+        name='Levels of detail',
+        description='Number of simplified versions of the curves, each in its own collection '
+                    'with {:g} times the tolerance of the one before'.format(soset.SIMPLIFY_LOD_FACTOR),
+        default=1,
+        min=1,
+        max=6,
+    )
+    weld: BoolProperty(
+        name='Weld vertices',
+        description='Merge coincident vertices of each object, e.g. the shared ends of curves',
+        default=False,
+    )
+    weld_tolerance: FloatProperty(
+        name='Tolerance',
+        description='Vertices closer than this distance (in meters) are merged',
+        default=0.001,
+        min=0.0,
+        precision=4,
+    )
+
+    def selected_paths(self):
+        directory = os.path.dirname(self.filepath)
+        return [os.path.join(directory, f.name) for f in self.files if f.name] or [self.filepath]
+
+    def draw(self, context):
+        layout = self.layout
+        box = layout.box()
+        box.prop(self, 'bbox_mode')
+        if self.bbox_mode == 'COORDS':
+            col = box.column(align=True)
+            col.prop(self, 'min_e')
+            col.prop(self, 'min_n')
+            col.prop(self, 'max_e')
+            col.prop(self, 'max_n')
+        box = layout.box()
+        box.prop(self, 'objtype_include')
+        box.prop(self, 'objtype_exclude')
+        box.prop(self, 'attr_filter')
+        box.prop(self, 'show_objtypes')
+        if self.show_objtypes:
+            counts = scan_objtypes(self.selected_paths())
+            col = box.column(align=True)
+            if not counts:
+                col.label(text='No object types found')
+            for objtype, n in sorted(counts.items()):
+                col.label(text='{} ({})'.format(objtype, n))
+        box = layout.box()
+        box.prop(self, 'simplify_method')
+        if self.simplify_method != 'NONE':
+            box.prop(self, 'simplify_tolerance')
+            box.prop(self, 'lod_levels')
+        box = layout.box()
+        box.prop_search(self, 'point_symbols', bpy.data, 'collections')
+        box = layout.box()
+        box.prop(self, 'tile_size')
+        if self.tile_size > 0:
+            box.prop(self, 'tile_lazy')
+            if self.tile_lazy:
+                box.prop(self, 'tile_radius')
+        box = layout.box()
+        box.prop(self, 'update')
+        if not self.update:
+            box.prop(self, 'feature_keys')
+        box.prop(self, 'weld')
+        if self.weld:
+            box.prop(self, 'weld_tolerance')
+
+    def get_bbox(self, context):
+        if self.bbox_mode == 'COORDS':
+            return (self.min_e, self.min_n, self.max_e, self.max_n)
+        if self.bbox_mode == 'OBJECT':
+            return bldhlp.objects_bbox_2d(context.selected_objects)
+        return None
+
+    def get_simplify(self):
+        if self.simplify_method == 'NONE' or self.simplify_tolerance <= 0:
+            return None
+        return (self.simplify_method,
+                [self.simplify_tolerance * soset.SIMPLIFY_LOD_FACTOR ** i for i in range(self.lod_levels)])
+
+    def execute(self, context):
+        bbox = self.get_bbox(context)
+        if self.bbox_mode != 'NONE' and (bbox is None or bbox[0] > bbox[2] or bbox[1] > bbox[3]):
+            self.report({'ERROR'}, 'Invalid spatial window')
+            return {'CANCELLED'}
+        try:
+            filt = sosi_filter.FeatureFilter.from_text(self.objtype_include, self.objtype_exclude,
+                                                       self.attr_filter)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        weld_tolerance = self.weld_tolerance if self.weld and self.weld_tolerance > 0 else None
+        if self.update and weld_tolerance:
+            # Welded vertices are shared by several features
+            self.report({'ERROR'}, 'Welded objects can not be updated, import without welding')
+            return {'CANCELLED'}
+        if self.update and (bbox is not None or filt is not None):
+            # The features left out would count as deleted from the files
+            self.report({'ERROR'}, 'Updates take whole files, import without a spatial window or filter')
+            return {'CANCELLED'}
+        tiling = None
+        if self.tile_size > 0:
+            tiles = None
+            if self.tile_lazy:
+                point = bldhlp.scene_point_to_sosi(context.scene.cursor.location, SOSI_PARENT_NAME)
+                tiles = sotiles.tiles_near(point, self.tile_radius, self.tile_size)
+            tiling = (self.tile_size, tiles)
+        job = create_import_job(self.selected_paths(), bbox, filt, weld_tolerance, self.update,
+                                self.get_simplify(), tiling,
+                                bpy.data.collections.get(self.point_symbols) if self.point_symbols else None,
+                                self.feature_keys)
+        return self.run_job(context, job)
+
+# -----------------------------------------------------------------------------
+
+def get_tile_index(scene):
+    """Return the sosi_tiles.TileIndex of the tiled imports into scene, or None."""
+    text = scene.get(TILE_INDEX_PROP)
+    return sotiles.TileIndex.from_json(text) if text else None
+
+
+class LoadSOSITiles(ImportJobModal, Operator):
+    """Import the tiles near the 3D cursor not loaded yet by a tiled import."""
+    bl_idname = "import_files.sosi_load_tiles"
+    bl_label = "Load SOSI Tiles"
+
+    radius: IntProperty(
+        name='Radius',
+        description='Tiles to load around the tile of the 3D cursor, in each direction',
+        default=2,
+        min=0,
+    )
+
+    def execute(self, context):
+        index = get_tile_index(context.scene)
+        if index is None:
+            self.report({'ERROR'}, 'No tiled SOSI import in this scene')
+            return {'CANCELLED'}
+        point = bldhlp.scene_point_to_sosi(context.scene.cursor.location, SOSI_PARENT_NAME)
+        tiles = index.unloaded(sotiles.tiles_near(point, self.radius, index.tile_size))
+        if not tiles:
+            self.report({'INFO'}, 'All SOSI tiles near the 3D cursor are loaded')
+            return {'FINISHED'}
+        settings = index.settings
+        filt = sosi_filter.FeatureFilter.from_dict(settings['filter']) if settings.get('filter') else None
+        job = create_import_job(index.tile_files(tiles), None, filt, settings.get('weld_tolerance'),
+                                False, settings.get('simplify'), (index.tile_size, tiles),
+                                bpy.data.collections.get(settings.get('point_symbols') or ''),
+                                settings.get('feature_keys', False))
+        return self.run_job(context, job)
+
+# -----------------------------------------------------------------------------
+
+class ShowSOSITiles(Operator):
+    """Exclude the SOSI tile collections far from the 3D cursor from the view layer."""
+    bl_idname = "import_files.sosi_show_tiles"
+    bl_label = "Show Nearby SOSI Tiles"
+
+    radius: IntProperty(
+        name='Radius',
+        description='Tiles to show around the tile of the 3D cursor, in each direction',
+        default=2,
+        min=0,
+    )
+
+    def execute(self, context):
+        index = get_tile_index(context.scene)
+        if index is None:
+            self.report({'ERROR'}, 'No tiled SOSI import in this scene')
+            return {'CANCELLED'}
+        point = bldhlp.scene_point_to_sosi(context.scene.cursor.location, SOSI_PARENT_NAME)
+        near = sotiles.tiles_near(point, self.radius, index.tile_size)
+        shown = 0
+        stack = [context.view_layer.layer_collection]
+        while stack:
+            layer_coll = stack.pop()
+            tile = layer_coll.collection.get(TILE_PROP)
+            if tile is None:
+                stack.extend(layer_coll.children)
+                continue
+            layer_coll.exclude = tuple(tile) not in near
+            shown += not layer_coll.exclude
+        self.report({'INFO'}, 'Showing {} SOSI tile collections'.format(shown))
+        return {'FINISHED'}
+
+# -----------------------------------------------------------------------------
+
+# Pre-scan results of the import dialog, keyed by (path, size, mtime)
+_objtype_scans = {}
+
+def scan_objtypes(paths):
+    """OBJTYPE counts of the files, scanned once per file version."""
+    counts = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        key = (path, st.st_size, st.st_mtime_ns)
+        if key not in _objtype_scans:
+            _objtype_scans[key] = sosi_native_parser.scan_objtypes([path])
+        for objtype, n in _objtype_scans[key].items():
+            counts[objtype] = counts.get(objtype, 0) + n
+    return counts
+
+# -----------------------------------------------------------------------------
+
+def get_feature_cache(addon_prefs):
+    cache_dir = bpy.path.abspath(addon_prefs.cache_dir) if addon_prefs.cache_dir else None
+    return sosi_cache.FeatureCache(cache_dir, addon_prefs.cache_max_mb * 1024 * 1024)
+
+# -----------------------------------------------------------------------------
+
+class ImportJob():
+    """An import split into small steps, see step().
+
+    A background thread parses the files with sosi_core.read_files (in
+    worker processes when several files are imported) and puts the mesh
+    data of each file in a queue. The main thread drains the queue, adding
+    a bounded number of features per step to the mesh builder, then
+    creates the objects, one per step. Only the main thread touches
+    Blender data.
+
+    With update, files imported before are compared feature by feature
+    with the objects in their collection: only new and changed features are
+    prepared and added, the features no longer in the file (or changed) are
+    cut out of the objects (see MeshBatchBuilder.remove_stale). This needs
+    the feature keys on the vertices: with feature_keys, update or
+    point_symbols (which picks symbols by serial number) the objects store
+    them. A file imported without them has all its features replaced.
+    The file keys are those of the features read, so update is not meant
+    to be combined with bbox or filt.
+
+    simplify (see sosi_core.read_file) simplifies the lines. Levels of
+    detail go into sub collections of the file collection, only the first
+    one is visible (see lod_collection).
+
+    With tiling, a (tile size, tiles) pair, the features go into one
+    collection per tile within the file collection, and only the tiles in
+    the set tiles are imported (all if None). The tiles of all files are
+    recorded in the sosi_tiles.TileIndex of the scene, so LoadSOSITiles can
+    import the others later.
+
+    With point_symbols, a collection, the objects holding only points (PUNKT)
+    draw the objects of this collection on their points through a Geometry
+    Nodes modifier (see blender_helper.instance_point_symbols).
+
+    With a memory_budget (bytes) the objects are built whenever the geometry
+    collected by the mesh builder reaches it, rather than once all files
+    are added; later geometry is appended to the objects built before (see
+    MeshBatchBuilder.build_iter). Only one parsed file waits in the queue.
+    Each flush appends to the objects it touches (rewriting those whose
+    attributes no longer fit). bpy only writes whole arrays, so appending
+    copies all arrays of the object: k flushes into one object cost k times
+    its size in time, and each needs temporary arrays of its size. Small
+    objects (a tile size) keep both low.
+
+    With stats_mode 'SUMMARY' or 'JSON' the import is instrumented (see
+    sosi_stats) and the statistics are printed when it ends. With
+    trace_memory or a memory_budget they include the peak RSS per stage;
+    with a memory_budget and stats_mode 'NONE' the peak RSS is logged.
+
+    One job runs at a time, start() raises a RuntimeError while another
+    one has not ended (see import_running).
+    """
+
+    def __init__(self, file_list, engine, cache=None, nworkers=1, bbox=None, filt=None,
+                 weld_tolerance=None, stats_mode='NONE', trace_memory=False, profile_path='',
+                 update=False, simplify=None, tiling=None, point_symbols=None, memory_budget=None,
+                 feature_keys=False):
+        self.file_list = file_list
+        self.engine = engine
+        self.cache = cache
+        self.nworkers = nworkers
+        self.bbox = bbox
+        self.filt = filt
+        self.weld_tolerance = weld_tolerance
+        self.stats_mode = stats_mode
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+        self.update = update
+        self.simplify = simplify
+        self.tiling = tiling
+        self.point_symbols = point_symbols
+        self.memory_budget = memory_budget
+        self.feature_keys = feature_keys or update or point_symbols is not None
+        self.tile_index = None
+        self.tiles_loaded = set()
+        self.known = None       # File name -> keys of the features imported before
+        self.queue = queue.Queue(maxsize=1 if memory_budget else soset.IMPORT_QUEUE_FILES)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._parse, name='SOSI parser', daemon=True)
+        self.pending = []       # MeshData of the current file not added yet
+        self.next_feature = 0   # First feature of pending[0] not added yet
+        self.registry = None    # blender_helper.ImportRegistry while running
+        self.parent = None      # SOSI parent object of the objects created
+        self.builder = None     # blender_helper.MeshBatchBuilder collecting the geometry
+        self.objects = None     # builder.build_iter() while building objects
+        self.parsed = False     # All files are added to the mesh builder
+        self.done = False
+        self.nfiles = 0
+        self.nfeatures = 0
+        self.nverts = 0
+        self.nobjects = 0
+
+    def start(self):
+        global _running_job
+        if import_running():
+            raise RuntimeError('A SOSI import is running')
+        self.registry = bldhlp.ImportRegistry()
+        self.parent = self.registry.parent_object(SOSI_PARENT_NAME)
+        self.builder = bldhlp.MeshBatchBuilder(self.registry, self.weld_tolerance, self.feature_keys)
+        if self.stats_mode != 'NONE' or self.memory_budget:
+            sostats.enable(self.trace_memory, bool(self.profile_path),
+                           trace_rss=self.trace_memory or bool(self.memory_budget))
+        if self.tiling is not None:
+            index = get_tile_index(bpy.context.scene)
+            if index is None or index.tile_size != self.tiling[0]:
+                index = sotiles.TileIndex(self.tiling[0])
+            index.settings = dict(simplify=self.simplify, weld_tolerance=self.weld_tolerance,
+                                  filter=self.filt.to_dict() if self.filt else None,
+                                  point_symbols=self.point_symbols.name if self.point_symbols else None,
+                                  feature_keys=self.feature_keys)
+            self.tile_index = index
+        if self.update:
+            self.known = {}
+            for path in self.file_list:
+                keys = self.registry.collection_feature_keys(os.path.basename(path))
+                if keys is not None:
+                    self.known[os.path.basename(path)] = keys
+        _running_job = self
+        self.thread.start()
+
+    # Parser thread -----------------------------------------------------------
+
+    def _put(self, item):
+        # Give up when cancelled, the main thread no longer drains the queue
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _parse(self):
+        results = sosi_core.read_files(self.file_list, self.engine, self.nworkers,
+                                       self.cache, self.bbox, self.filt, self.known, self.simplify,
+                                       self.tiling)
+        try:
+            with sostats.profiled():
+                for item in results:
+                    if not self._put(item):
+                        return
+                    item = None  # Not kept while parsing the next file
+            self._put(None)  # All files parsed
+        except Exception as e:
+            self._put(e)
+        finally:
+            results.close()
+
+    # Main thread -------------------------------------------------------------
+
+    def _add_chunk(self):
+        mdata = self.pending[0]
+        start = self.next_feature
+        stop = min(start + soset.IMPORT_CHUNK_FEATURES, len(mdata))
+        coll = mesh_data_collection(self.registry, mdata, self.tiling[0] if self.tiling else None)
+        with sostats.timer("batching"):
+            self.builder.add_mesh_data(coll, mdata, start, stop)
+        self.nfeatures += stop - start
+        self.nverts += int(mdata.vert_offsets[stop] - mdata.vert_offsets[start])
+        if stop < len(mdata):
+            self.next_feature = stop
         else:
-            ob.parent = top_parent
-            #bpy.context.collection.objects.link(ob)
-            coll.objects.link(ob)
-            
-        bldhlp.lock_obj_to_parent(ob)
-        #print('BUEP {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        logging.info('BUEP {}: Res= 0x{:x} NoOfCoords= {}'.format(objrefnum, sosires, ncoords))
-        
-    return 0
+            logging.info('%s: %d elements, NoOfCoords= %d', mdata.filename, len(mdata), len(mdata.coords))
+            self.pending.pop(0)
+            self.next_feature = 0
+        if self.memory_budget and self.builder.nbytes >= self.memory_budget:
+            logging.info('Memory budget reached (%.0f MB collected), creating the objects',
+                         self.builder.nbytes / 1e6)
+            sostats.incr("memory flushes")
+            self.objects = self.builder.build_iter(self.parent)
+
+    def step(self, seconds=soset.IMPORT_TICK_SECONDS):
+        """Work for about seconds, return True once the import is done.
+        An error of the parser thread is raised here.
+        """
+        with sostats.profiled():
+            return self._step(seconds)
+
+    def _step(self, seconds):
+        t_end = time.perf_counter() + seconds
+        while not self.done:
+            if self.objects is not None:
+                ob = next(self.objects, None)
+                if ob is None:
+                    self.objects = None
+                    if self.parsed:
+                        self._finish()
+                else:
+                    self.nobjects += 1
+                    if self.point_symbols is not None and bldhlp.is_point_cloud(ob):
+                        bldhlp.instance_point_symbols(ob, self.point_symbols)
+            elif self.pending:
+                self._add_chunk()
+            else:
+                try:
+                    item = self.queue.get(timeout=max(t_end - time.perf_counter(), 0.001))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.parsed = True
+                    self.objects = self.builder.build_iter(self.parent)
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    self.pending = list(item[1])
+                    self.next_feature = 0
+                    self.nfiles += 1
+                    self._file_received(item[0], self.pending)
+            if time.perf_counter() >= t_end:
+                break
+        return self.done
+
+    def _file_received(self, path, mdatas):
+        if mdatas and mdatas[0].file_keys is not None:
+            # Features of the file may be in any of its tile and LOD collections
+            coll = self.registry.file_collection(mdatas[0].filename)
+            for c in [coll] + list(coll.children_recursive):
+                self.builder.remove_stale(c, mdatas[0].file_keys)
+        if self.tile_index is not None and mdatas:
+            tile_counts = mdatas[0].tile_counts
+            self.tile_index.add_file(path, tile_counts)
+            tiles = self.tiling[1]
+            self.tiles_loaded.update(tile_counts if tiles is None else tiles & tile_counts.keys())
+
+    def _finish(self):
+        self.done = True
+        if self.tile_index is not None:
+            self.tile_index.loaded |= self.tiles_loaded
+            bpy.context.scene[TILE_INDEX_PROP] = self.tile_index.to_json()
+        if self.cache is not None:
+            self.cache.evict()
+        self._end()
+
+    def cancel(self):
+        """Stop the import. The objects already created are kept, the
+        geometry collected for the other objects is dropped."""
+        self.cancelled.set()
+        self.done = True
+        if self.registry is not None:
+            # Collections of the objects created so far
+            self.registry.link_collections()
+        self._end()
+
+    def _end(self):
+        global _running_job
+        self.objects = None
+        self.builder = None
+        self.registry = None
+        if _running_job is self:
+            _running_job = None
+        self.report_stats()
+
+    def report_stats(self):
+        """Print the statistics of an instrumented import, once."""
+        stats = sostats.disable()
+        if stats is None:
+            return
+        if self.stats_mode == 'NONE':
+            # Only traced for the memory budget
+            logging.info('Memory budget %.0f MB: %d flushes, peak RSS %s', self.memory_budget / 1e6,
+                         stats.counters.get("memory flushes", 0),
+                         'unknown' if stats.peak_rss is None else '%.1f MB' % (stats.peak_rss / 1e6))
+            return
+        print(stats.to_json() if self.stats_mode == 'JSON' else stats.summary())
+        if self.profile_path:
+            stats.dump_profile(self.profile_path)
+            logging.info('cProfile data written to %s', self.profile_path)
+
+    def run(self):
+        """Do the whole import at once. Return the number of files imported."""
+        self.start()
+        try:
+            while not self.step(1.0):
+                pass
+        except BaseException:
+            self.cancel()
+            raise
+        return self.nfiles
+
+    def progress_text(self):
+        text = 'SOSI import: {}/{} files, {} features, {} vertices'.format(
+            self.nfiles, len(self.file_list), self.nfeatures, self.nverts)
+        if self.nobjects:
+            text += ', {} objects created'.format(self.nobjects)
+        return text + ' (Esc to cancel)'
 
 # -----------------------------------------------------------------------------
 
-def do_imports(file_list=None):
-    
-    preferences = bpy.context.preferences
-    addon_prefs = preferences.addons[__package__].preferences
-    
-    #logger = sologhlp.get_logger(soset.ACT_LOG_LEVEL)
-    logger = sologhlp.get_logger(addon_prefs.log_level)
-    
-    global top_parent
-    top_parent = None
-    
-    if not GDAL_AVAILABLE:
-        logging.error('GDAL Python bindings not available')
-        return 0
-    from . import sosi_gdal_parser
+def import_running():
+    """True while an ImportJob runs, see ImportJob.start."""
+    return _running_job is not None
 
-    if file_list is None:
+# -----------------------------------------------------------------------------
 
-    env_files = os.environ.get('SOSI_FILES')
-    if env_files:
-        file_list = env_files.split(os.pathsep)
-    else:
-        pkg_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        file_list = [os.path.join(pkg_dir, 'test_data', 'SomeBorders.sos')]
-    nfiles = sosi_gdal_parser.process_sosi_files(file_list, my_cb_func)
+def mesh_data_collection(registry, mdata, tile_size=None):
+    """Collection for the objects of a MeshData: the one of its file, or the
+    tile and/or level of detail collection within it. registry is the
+    blender_helper.ImportRegistry of the import."""
+    coll = registry.file_collection(mdata.filename)
+    if mdata.tile is not None:
+        coll = tile_collection(registry, coll, mdata.tile, tile_size)
+    if mdata.lod is None:
+        return coll
+    return lod_collection(registry, coll, mdata.lod)
 
-        rel_path = soset.REL_DLL_PATH
-        dll_path = get_full_path(rel_path)
 
-    use_dll = platform.system() == 'Windows' and os.path.exists(dll_path)
+def tile_collection(registry, coll, tile, tile_size):
+    """Return the collection of a tile (see sosi_tiles) in the file collection coll."""
+    name = '{} {}'.format(coll.name, sotiles.tile_name(tile, tile_size))
+    return registry.child_collection(coll, name, TILE_PROP, list(tile))
 
-    #Prototype callback
-    callback_type = ctypes.CFUNCTYPE(c_int, c_int, c_int, c_int, c_char_p, c_int, c_int, ctypes.POINTER(c_double), c_char_p)
-    my_callback = callback_type(my_cb_func)  # Use a variable to avoid garbage collection
 
-    if use_dll:
-        my_dll = ctypes.WinDLL(dll_path)
+def lod_collection(registry, coll, lod):
+    """Return the level of detail lod collection of the file or tile
+    collection coll. New ones are hidden except for level 0, switch levels
+    by showing another collection."""
+    def hide(lod_coll):
+        lod_coll.hide_viewport = lod > 0
+        lod_coll.hide_render = lod > 0
 
-        # Prototype get_SosiInputObjects()
-        my_dll.get_SosiInputObjects.argtypes = [ctypes.POINTER(c_double), ctypes.POINTER(c_double), ctypes.POINTER(c_double), ctypes.c_double, ctypes.c_double, ctypes.c_int, ctypes.c_int, ctypes.c_double]
-        my_dll.get_SosiInputObjects.restype = c_int
+    return registry.child_collection(coll, '{} LOD{}'.format(coll.name, lod), LOD_PROP, lod, hide)
+
+# -----------------------------------------------------------------------------
 
-        #Prototype process_SosiFiles()
-        my_dll.process_SosiFiles.argtypes = [c_int, c_void_p]
-        my_dll.process_SosiFiles.restype = c_int
+def create_import_job(file_list=None, bbox=None, filt=None, weld_tolerance=None, update=False,
+                      simplify=None, tiling=None, point_symbols=None, feature_keys=False):
+    """Return an ImportJob for the SOSI files in file_list, set up from the
+    add-on preferences. See do_imports for the arguments.
+    """
+    preferences = bpy.context.preferences
+    addon_prefs = preferences.addons[__package__].preferences
+    
+    #logger = sologhlp.get_logger(soset.ACT_LOG_LEVEL)
+    logger = sologhlp.get_logger(addon_prefs.log_level)
     
-    bldscale = 1.0  # bldhlp.LocalUnits.scene_unit_factor() # STRANGE??? Blender takes numbers as m always???
-    #bldhlp.setMyEnvironment()   # TEMPORARY to set my local environment
-
-    peasting = (ctypes.c_double)()
-    pnorthing = (ctypes.c_double)()
-    punity = (ctypes.c_double)()
-    clip_end = bldhlp.SceneSettings.get_clip_end()
-    unit_system = bldhlp.UnitSettings.scene_unit_system_get()
-    unit_length = bldhlp.UnitSettings.scene_unit_length_get()
-    unit_scale = bldhlp.UnitSettings.scene_unit_scale_get()
-
-    if use_dll:
-        nfiles = my_dll.get_SosiInputObjects(peasting, pnorthing, punity, bldscale, clip_end, unit_system, unit_length, unit_scale)
-        if nfiles > 0:
-            my_dll.process_SosiFiles(nfiles, my_callback)
-        lib_handle = my_dll._handle
-        free_library(lib_handle)
-    else:
-        if not GDAL_AVAILABLE:
-            logging.error('GDAL Python bindings not available')
-            return 0
-        from . import sosi_gdal_parser
+    engine = sosi_core.resolve_engine(addon_prefs.parser_engine)
+    cache = get_feature_cache(addon_prefs) if addon_prefs.use_cache else None
+
+    if file_list is None:
         env_files = os.environ.get('SOSI_FILES')
         if env_files:
             file_list = env_files.split(os.pathsep)
         else:
             pkg_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
             file_list = [os.path.join(pkg_dir, 'test_data', 'SomeBorders.sos')]
-        nfiles = sosi_gdal_parser.process_sosi_files(file_list, my_cb_func)
 
-    return nfiles
+    nworkers = addon_prefs.parallel_workers or os.cpu_count() or 1
+    profile_path = bpy.path.abspath(addon_prefs.stats_profile) if addon_prefs.stats_profile else ''
+    return ImportJob(file_list, engine, cache, nworkers, bbox, filt, weld_tolerance,
+                     addon_prefs.stats_mode, addon_prefs.stats_memory, profile_path, update, simplify,
+                     tiling, point_symbols, addon_prefs.memory_budget_mb * 1024 * 1024, feature_keys)
+
+# -----------------------------------------------------------------------------
+
+def do_imports(file_list=None, bbox=None, filt=None, weld_tolerance=None, update=False,
+               simplify=None, tiling=None, point_symbols=None, feature_keys=False):
+    """Import the SOSI files in file_list. With a bbox (min E, min N, max E,
+    max N) only the features intersecting this spatial window are imported,
+    filt (sosi_filter.FeatureFilter) selects features by OBJTYPE/attributes.
+    With a weld_tolerance the vertices of each object closer than this
+    distance are merged. With update, files imported before only get their
+    new and changed features added and the deleted ones removed, with
+    feature_keys the objects keep what later updates need for that. simplify
+    is a (method, tolerances) pair, tiling a (tile size, tiles) pair and
+    point_symbols a collection to draw on the points, see ImportJob.
+    The import is done at once, the import operator runs an ImportJob in
+    steps instead.
+    """
+    return create_import_job(file_list, bbox, filt, weld_tolerance, update, simplify, tiling,
+                             point_symbols, feature_keys).run()
@@ -0,0 +1,491 @@
+"""Native SOSI parser reading memory mapped .sos files, no GDAL needed."""
+
+import logging
+import mmap
+import os
+import re
+from collections import Counter
+import numpy as np
+from . import sosi_datahelper as sodhlp
+from . import sosi_geom_helper as sogeohlp
+from . import sosi_settings as soset
+from . import sosi_stats as sostats
+
+# Top level (single dot) elements and the object ids they are reported as
+ELEMENT_IDS = {
+    "PUNKT": sodhlp.SosiObjId.PUNKT,
+    "SYMBOL": sodhlp.SosiObjId.PUNKT,
+    "KURVE": sodhlp.SosiObjId.KURVE,
+    "LINJE": sodhlp.SosiObjId.KURVE,
+    "BUEP": sodhlp.SosiObjId.BUEP,
+    "FLATE": sodhlp.SosiObjId.FLATE,
+}
+
+# ..TEGNSETT values and the matching Python codecs
+CHARSETS = {
+    "ISO8859-10": "iso8859_10",
+    "ISO8859-1": "latin_1",
+    "UTF-8": "utf_8",
+    "ANSI": "cp1252",
+    "DOSN8": "cp865",
+    "ND7": "nd7",
+    "DECN7": "nd7",
+}
+DEFAULT_CHARSET = "ISO8859-10"
+
+# Norwegian 7 bit charset, national letters replace these ASCII characters
+ND7_TO_TEXT = str.maketrans("[\\]{|}", "ÆØÅæøå")
+TEXT_TO_ND7 = str.maketrans("ÆØÅæøå", "[\\]{|}")
+
+# Header is searched for ..TEGNSETT within this many bytes
+HEADER_SCAN_LEN = 65536
+
+_GROUP_RE = re.compile(rb"^[ \t]*\.(?=[^.\s])(\S+)[ \t]*([^\r\n]*)", re.M)
+_ATTR_RE = re.compile(rb"^[ \t]*\.\.(?=[^.\s])(\S+)", re.M)
+_SUBATTR_RE = re.compile(rb"\.\.\.\S+([ \t]+[^\s.!]\S*)?")
+_SUBATTR_VALUE_RE = re.compile(rb"\.\.\.(?=[^.\s])(\S+)[ \t]*((?:(?!\.\.\.)[^\r\n])*)")
+_COMMENT_RE = re.compile(rb"![^\r\n]*")
+_CHARSET_RE = re.compile(rb"\.\.TEGNSETT[ \t]+(\S+)")
+_REF_RE = re.compile(rb"(\()|(\))|(-?):(-?)(\d+)")
+_OBJTYPE_RE = re.compile(rb"^[ \t]*\.\.OBJTYPE[ \t]+([^\r\n!]*)", re.M)
+
+
+class SosiCodec:
+    """Encode/decode text in the charset given by ..TEGNSETT."""
+
+    def __init__(self, charset):
+        self.charset = charset.upper()
+        self.codec = CHARSETS.get(self.charset)
+        if self.codec is None:
+            logging.warning("Unknown charset %s, using %s", charset, DEFAULT_CHARSET)
+            self.codec = CHARSETS[DEFAULT_CHARSET]
+
+    def decode(self, data):
+        if self.codec == "nd7":
+            return data.decode("ascii", "replace").translate(ND7_TO_TEXT)
+        return data.decode(self.codec, "replace")
+
+    def encode(self, text):
+        if self.codec == "nd7":
+            return text.translate(TEXT_TO_ND7).encode("ascii")
+        return text.encode(self.codec)
+
+
+class SosiHeader:
+    """Values from the .HODE element needed to convert the coordinates."""
+
+    def __init__(self, codec, text):
+        self.codec = codec
+        self.enhet = self._float(text, "ENHET", 1.0)
+        self.enhet_h = self._float(text, "ENHET-H", self.enhet)
+        origo = self._values(text, "ORIGO-NØ", 2)
+        self.origo_n, self.origo_e = origo if origo else (0.0, 0.0)
+        # ..OMRÅDE, given in meters (no ENHET) as (min E, min N, max E, max N)
+        min_no = self._values(text, "MIN-NØ", 2)
+        max_no = self._values(text, "MAX-NØ", 2)
+        self.extent = None
+        if min_no and max_no:
+            self.extent = (min_no[1], min_no[0], max_no[1], max_no[0])
+
+    def _values(self, text, key, count):
+        pattern = rb"\.+" + re.escape(self.codec.encode(key)) + rb"(?:[ \t]+(\S+))" * count
+        m = re.search(pattern, text)
+        if m is None:
+            return None
+        try:
+            return tuple(float(v) for v in m.groups())
+        except ValueError:
+            return None
+
+    def _float(self, text, key, default):
+        v = self._values(text, key, 1)
+        return v[0] if v else default
+
+
+def _clean(value):
+    return _SUBATTR_RE.sub(b" ", _COMMENT_RE.sub(b"", value))
+
+
+def _parse_refs(value):
+    """Return the rings of a ..REF as lists of (serial, reversed) pairs:
+    the exterior ring first, then one list per parenthesised hole."""
+    rings = [[]]
+    depth = 0
+    for m in _REF_RE.finditer(value):
+        if m.group(1):
+            depth += 1
+            if depth == 1:
+                rings.append([])
+        elif m.group(2):
+            depth = max(depth - 1, 0)
+        else:
+            rings[-1 if depth else 0].append((int(m.group(5)), bool(m.group(3) or m.group(4))))
+    rings = [rings[0]] + [r for r in rings[1:] if r]
+    return rings if any(rings) else []
+
+
+def _add_attr(codec, key, value, attrs):
+    """Add the text value of the attribute key (value is the element text up
+    to the next attribute) and of its sub-attributes, named KEY.SUB, to attrs.
+    Only the first line of a value is kept."""
+    name = codec.decode(key).upper()
+    eol = value.find(b"\n")
+    text = codec.decode(_clean(value[:eol if eol >= 0 else len(value)])).strip().strip("\"'")
+    if text:
+        attrs.setdefault(name, text)
+    if b"..." in value:
+        for m in _SUBATTR_VALUE_RE.finditer(_COMMENT_RE.sub(b"", value)):
+            text = codec.decode(m.group(2)).strip().strip("\"'")
+            if text:
+                attrs.setdefault(name + "." + codec.decode(m.group(1)).upper(), text)
+
+
+def _iter_attrs(body):
+    """Yield the (key, value) of the attributes of an element body, value
+    being the text up to the next attribute."""
+    attrs = list(_ATTR_RE.finditer(body))
+    for i, m in enumerate(attrs):
+        end = attrs[i + 1].start() if i + 1 < len(attrs) else len(body)
+        yield m.group(1), body[m.end():end]
+
+
+def _parse_feature(codec, kw_no, kw_noh, kw_hoyde, name, rest, body):
+    """Collect the geometry and the other attributes of one element."""
+    feat = {
+        "id": ELEMENT_IDS[name],
+        "serial": None,
+        "name": None,
+        "coords": b"",
+        "ndims": 2,
+        "height": 0.0,
+        "refs": [],
+        "report": True,
+        "parts": None,
+        "attrs": {},
+    }
+    try:
+        feat["serial"] = int(rest.split(b":")[0])
+    except ValueError:
+        pass
+    for key, value in _iter_attrs(body):
+        if key == b"OBJTYPE":
+            feat["name"] = codec.decode(_clean(value).strip())
+        elif key == kw_no:
+            feat["coords"] = _clean(value)
+            feat["ndims"] = 2
+        elif key == kw_noh:
+            feat["coords"] = _clean(value)
+            feat["ndims"] = 3
+        elif key == b"REF":
+            feat["refs"] = _parse_refs(_COMMENT_RE.sub(b"", value))
+        else:
+            if key == kw_hoyde:
+                try:
+                    feat["height"] = float(_clean(value).split()[0])
+                except (ValueError, IndexError):
+                    pass
+            _add_attr(codec, key, value, feat["attrs"])
+    return feat
+
+
+def _element_attrs(codec, body, skip):
+    """Return the attributes of an element as {NAME: text value}, as
+    _parse_feature collects them. skip holds the keys it reads otherwise
+    (OBJTYPE, coordinates, REF)."""
+    attrs = {}
+    for key, value in _iter_attrs(body):
+        if key not in skip:
+            _add_attr(codec, key, value, attrs)
+    return attrs
+
+
+def _element_accepted(filt, codec, skip, data, start, end):
+    """Apply a sosi_filter.FeatureFilter to the element in data[start:end]
+    without parsing its geometry."""
+    m = _OBJTYPE_RE.search(data, start, end)
+    objtype = codec.decode(m.group(1)).strip() if m else ""
+    if not filt.accepts_objtype(objtype):
+        return False
+    if not filt.predicates:
+        return True
+    return filt.accepts(objtype, _element_attrs(codec, data[start:end], skip))
+
+
+def _convert_coords(header, feats):
+    """Convert the coordinate text of all features in one vectorised pass.
+
+    Returns the (n, 3) float64 coordinates and the per-feature offsets.
+    """
+    chunks = [f["coords"] for f in feats]
+    ntoks = np.array([len(c.split()) for c in chunks], dtype=np.int64)
+    ndims = np.array([f["ndims"] for f in feats], dtype=np.int64)
+    heights = np.array([f["height"] for f in feats], dtype=np.float64)
+    npts = ntoks // ndims
+    for f, nt, nd in zip(feats, ntoks, ndims):
+        if nt % nd:
+            logging.warning("Element %s: coordinate count not a multiple of %d", f["serial"], nd)
+
+    ntotal = int(ntoks.sum())
+    vals = np.fromstring(b" ".join(chunks), dtype=np.float64, sep=" ") if ntotal else np.zeros(0)
+    if len(vals) != ntotal:
+        raise ValueError("non-numeric coordinate values")
+    tok_starts = np.cumsum(ntoks) - ntoks
+    pt_offsets = np.concatenate(([0], np.cumsum(npts)))
+    total = int(pt_offsets[-1])
+
+    pt_dims = np.repeat(ndims, npts)
+    pt_k = np.arange(total) - np.repeat(pt_offsets[:-1], npts)
+    base = np.repeat(tok_starts, npts) + pt_k * pt_dims
+
+    coords = np.empty((total, 3), dtype=np.float64)
+    coords[:, 0] = vals[base + 1] * header.enhet + header.origo_e
+    coords[:, 1] = vals[base] * header.enhet + header.origo_n
+    has_h = pt_dims == 3
+    coords[:, 2] = np.repeat(heights, npts)
+    coords[has_h, 2] = vals[base[has_h] + 2] * header.enhet_h
+    return coords, pt_offsets
+
+
+def _flate_ring(feat, refs, feats, serials, coords, pt_offsets):
+    """Chain the curves referred to by one ring of a FLATE."""
+    parts = []
+    for serial, rev in refs:
+        idx = serials.get(serial)
+        if idx is None:
+            logging.warning("FLATE %s: missing reference %d", feat["serial"], serial)
+            continue
+        pts = coords[pt_offsets[idx]:pt_offsets[idx + 1]]
+        if feats[idx]["id"] == sodhlp.SosiObjId.BUEP and len(pts) == 3:
+            with sostats.timer("arc tessellation"):
+                pts = sogeohlp.arcs_tessellate(pts)[0]
+        if rev:
+            pts = pts[::-1]
+        if parts and len(pts) and np.array_equal(parts[-1][-1], pts[0]):
+            pts = pts[1:]
+        parts.append(pts)
+    if not parts:
+        return np.zeros((0, 3))
+    return np.concatenate(parts)
+
+
+def _file_codec(data):
+    m = _CHARSET_RE.search(data, 0, HEADER_SCAN_LEN)
+    return SosiCodec(m.group(1).decode("ascii", "replace") if m else DEFAULT_CHARSET)
+
+
+def read_sosi_extent(path):
+    """Return the ..OMRÅDE of a SOSI file as (min E, min N, max E, max N),
+    or None when the header does not give it. Only the start of the file is read.
+    """
+    with open(path, "rb") as f:
+        data = f.read(HEADER_SCAN_LEN)
+    codec = _file_codec(data)
+    groups = _GROUP_RE.finditer(data)
+    head = next(groups, None)
+    if head is None or head.group(1).upper() != b"HODE":
+        return None
+    end = next(groups, None)
+    return SosiHeader(codec, data[head.end():end.start() if end else len(data)]).extent
+
+
+def _scan_elements(codec, mm):
+    """Return the header and the (name, rest of line, start, end) of the elements."""
+    groups = list(_GROUP_RE.finditer(mm))
+    header = None
+    elements = []
+    for i, g in enumerate(groups):
+        name = g.group(1).decode("ascii", "replace").upper()
+        end = groups[i + 1].start() if i + 1 < len(groups) else len(mm)
+        if name == "HODE":
+            header = SosiHeader(codec, mm[g.end():end])
+        elif name == "SLUTT":
+            break
+        elif name in ELEMENT_IDS:
+            elements.append((name, g.group(2), g.end(), end))
+    return header, elements
+
+
+def _parse_elements(codec, mm, elements, filt):
+    """Parse the elements accepted by filt, and the curves they refer to."""
+    kw_no = codec.encode("NØ")
+    kw_noh = codec.encode("NØH")
+    kw_hoyde = codec.encode("HØYDE")
+
+    def parse(element):
+        name, rest, start, end = element
+        return _parse_feature(codec, kw_no, kw_noh, kw_hoyde, name, rest, mm[start:end])
+
+    if not filt:
+        return [parse(e) for e in elements]
+    skip = (b"OBJTYPE", kw_no, kw_noh, b"REF")
+    parsed = [parse(e) if _element_accepted(filt, codec, skip, mm, e[2], e[3]) else None
+              for e in elements]
+    needed = {serial for f in parsed if f is not None
+              for ring in f["refs"] for serial, rev in ring}
+    feats = []
+    for element, feat in zip(elements, parsed):
+        if feat is None and needed:
+            try:
+                serial = int(element[1].split(b":")[0])
+            except ValueError:
+                continue
+            if serial in needed:
+                feat = parse(element)
+                feat["report"] = False
+        if feat is not None:
+            feats.append(feat)
+    return feats
+
+
+def read_sosi_file(path, filt=None):
+    """Parse one SOSI file.
+
+    Returns a list of features (dicts with id, serial, name and attrs) and the
+    matching list of (n, 3) float64 coordinate arrays. A FLATE with holes
+    has its rings one after the other, feat["parts"] holding the ring
+    offsets (exterior ring first). With a
+    sosi_filter.FeatureFilter, elements that are not accepted are skipped
+    before they are parsed. Curves referred to by an accepted FLATE are
+    still read, with 'report' set to False.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # The mapping is lazy, most of the opening is the first scan
+        with sostats.timer("file open"):
+            codec = _file_codec(mm)
+            header, elements = _scan_elements(codec, mm)
+        with sostats.timer("feature iteration"):
+            feats = _parse_elements(codec, mm, elements, filt)
+    finally:
+        mm.close()
+
+    if header is None:
+        logging.warning("%s: no .HODE found", path)
+        header = SosiHeader(codec, b"")
+    if not feats:
+        return [], []
+
+    with sostats.timer("coordinate decoding"):
+        coords, pt_offsets = _convert_coords(header, feats)
+    serials = {f["serial"]: i for i, f in enumerate(feats) if f["serial"] is not None}
+    coord_arys = []
+    for i, feat in enumerate(feats):
+        if feat["id"] == sodhlp.SosiObjId.FLATE and feat["refs"]:
+            rings = [_flate_ring(feat, refs, feats, serials, coords, pt_offsets) for refs in feat["refs"]]
+            rings = [rings[0]] + [r for r in rings[1:] if len(r) >= 3]
+            if len(rings) > 1:
+                feat["parts"] = np.concatenate(([0], np.cumsum([len(r) for r in rings])))
+            coord_arys.append(np.concatenate(rings))
+        else:
+            coord_arys.append(coords[pt_offsets[i]:pt_offsets[i + 1]])
+    return feats, coord_arys
+
+
+def scan_objtypes(file_paths):
+    """Count the OBJTYPE values in the files without parsing them.
+
+    Returns a collections.Counter {objtype: number of elements}.
+    """
+    counts = Counter()
+    for path in file_paths:
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    codec = _file_codec(mm)
+                    raw = Counter(m.group(1).strip() for m in _OBJTYPE_RE.finditer(mm))
+        except OSError as e:
+            logging.error("Could not read %s: %s", path, e)
+            continue
+        for value, n in raw.items():
+            counts[codec.decode(value)] += n
+    return counts
+
+
+def _file_batches(path, batch_size=None, bbox=None, filt=None):
+    """Yield the features of one SOSI file as FeatureBatch of at most
+    batch_size features (None: one batch). Raises OSError or ValueError
+    when the file can not be read."""
+    feats, coord_arys = read_sosi_file(path, filt)
+    keep = None
+    if bbox is not None and feats:
+        offsets = np.concatenate(([0], np.cumsum([len(c) for c in coord_arys])))
+        keep = sogeohlp.features_in_bbox(np.concatenate(coord_arys), offsets, bbox)
+    idx = [i for i, f in enumerate(feats) if f["report"] and (keep is None or keep[i])]
+    filename = os.path.basename(path)
+    step = batch_size or max(len(idx), 1)
+    for start in range(0, len(idx), step):
+        chunk = idx[start:start + step]
+        parts = [(0, len(coord_arys[i])) if feats[i]["parts"] is None else feats[i]["parts"] for i in chunk]
+        yield sodhlp.FeatureBatch.from_lists(
+            filename,
+            [feats[i]["id"].value for i in chunk],
+            [feats[i]["serial"] if feats[i]["serial"] is not None else i for i in chunk],
+            [feats[i]["name"] or f"feat_{i}" for i in chunk],
+            [coord_arys[i] for i in chunk],
+            parts,
+            # The first ring of a FLATE is its exterior
+            [np.arange(len(p) - 1) > 0 for p in parts],
+            [feats[i]["attrs"] for i in chunk])
+
+
+def iter_feature_batches(file_paths, batch_size=soset.PARSE_BATCH_FEATURES, bbox=None, filt=None,
+                         strict=False):
+    """Parse SOSI files natively, yielding their features as
+    sosi_datahelper.FeatureBatch of at most batch_size features.
+
+    Same interface as sosi_gdal_parser.iter_feature_batches. A batch holds
+    features of one file only. Files that can not be read are logged and
+    skipped, or with strict raise OSError or ValueError.
+
+    Args:
+        file_paths (list[str]): list of SOSI files to parse
+        batch_size (int): features per batch, None for one batch per file
+        bbox (tuple): optional (min E, min N, max E, max N), only
+            features with a bounding box intersecting it are passed on
+        filt (sosi_filter.FeatureFilter): optional OBJTYPE/attribute filter
+        strict (bool): raise on files that can not be read
+    """
+    for path in file_paths:
+        try:
+            yield from _file_batches(path, batch_size, bbox, filt)
+        except (OSError, ValueError) as e:
+            if strict:
+                raise
+            logging.error("Could not read %s: %s", path, e)
+
+
+def process_sosi_files(file_paths, callback, bbox=None, filt=None):
+    """Process SOSI files natively and invoke callback for each feature.
+
+    Same interface as sosi_gdal_parser.process_sosi_files, kept for the
+    callers of the old per feature interface: the batches of
+    iter_feature_batches are replayed through the callback.
+
+    Args:
+        file_paths (list[str]): list of SOSI files to parse
+        callback (callable): function called for each geometry, the
+            coordinates are passed as an (n, 3) float64 array. A FLATE
+            with holes also gets the keyword arguments parts (ring offsets
+            into the coordinates) and holes (True for interior rings).
+            The other attributes are passed as attrs, {NAME: text value}
+        bbox (tuple): optional (min E, min N, max E, max N), only
+            features with a bounding box intersecting it are passed on
+        filt (sosi_filter.FeatureFilter): optional OBJTYPE/attribute filter
+    Returns:
+        int: number of files processed
+    """
+    count = 0
+    for path in file_paths:
+        try:
+            for batch in _file_batches(path, None, bbox, filt):
+                batch.replay(callback)
+        except (OSError, ValueError) as e:
+            logging.error("Could not read %s: %s", path, e)
+            continue
+        count += 1
+    return count
@@ -0,0 +1,73 @@
+"""Parse SOSI files in worker processes, leaving only the Blender work
+(mesh creation) to the main thread.
+
+Each worker runs sosi_core.read_file, so it only imports the bpy-free
+modules of the add-on. Use sosi_core.read_files rather than calling this
+module directly.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool  # noqa: re-exported for callers
+
+from . import sosi_core
+from . import sosi_settings as soset
+from . import sosi_stats as sostats
+
+
+def _read_file_stats(path, engine, cache, bbox, filt, known, simplify, tiling, trace_memory, trace_rss):
+    """Worker of an instrumented import: sosi_core.read_file with its own
+    sosi_stats, returned for the main process to merge."""
+    stats = sostats.enable(trace_memory, trace_rss=trace_rss)
+    try:
+        mdatas = sosi_core.read_file(path, engine, cache, bbox, filt, known, simplify, tiling)
+    finally:
+        sostats.disable()
+    return mdatas, stats.as_dict()
+
+
+def parse_files_parallel(file_paths, engine, max_workers=None, cache=None, bbox=None, filt=None,
+                         known=None, simplify=None, tiling=None):
+    """Parse the files in a process pool, one file per worker task.
+
+    Yields (path, list[MeshData]) in file order as the results arrive.
+    At most PARALLEL_FILES_AHEAD files per worker are parsed ahead of the
+    caller, so parsed files do not pile up in memory when the caller is
+    slower than the workers. Closing the generator cancels the remaining
+    files. When sosi_stats is
+    enabled, the statistics of the workers are added to it.
+    The pool uses the 'spawn' start method, forking Blender is not safe.
+    """
+    stats = sostats.active()
+    args = [file_paths, itertools.repeat(engine), itertools.repeat(cache),
+            itertools.repeat(bbox), itertools.repeat(filt),
+            [(known or {}).get(os.path.basename(p)) for p in file_paths],
+            itertools.repeat(simplify), itertools.repeat(tiling)]
+    if stats is not None:
+        args += [itertools.repeat(stats.trace_memory), itertools.repeat(stats.trace_rss)]
+    read = sosi_core.read_file if stats is None else _read_file_stats
+    tasks = zip(*args)
+    ahead = soset.PARALLEL_FILES_AHEAD * (max_workers or os.cpu_count() or 1)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+        try:
+            futures = collections.deque((task[0], executor.submit(read, *task))
+                                        for task in itertools.islice(tasks, ahead))
+            while futures:
+                path, future = futures.popleft()
+                mdatas = future.result()
+                del future
+                for task in itertools.islice(tasks, 1):
+                    futures.append((task[0], executor.submit(read, *task)))
+                if stats is not None:
+                    mdatas, worker_stats = mdatas
+                    stats.merge(worker_stats)
+                yield path, mdatas
+                del mdatas  # Not kept while waiting for the next file
+        finally:
+            # When the caller stops early (cancelled import) the files not
+            # started yet are dropped, only the running ones are waited for
+            executor.shutdown(cancel_futures=True)
@@ -41,5 +41,24 @@ ACT_LOG_LEVEL = logging.INFO
 
     
 # Number of segments for BUE drawing
-SOSI_ARC_SEGMENTS = 32 # 32 segments over angle Pi (half circle)
+SOSI_ARC_SEGMENTS = 32 # At most 32 segments per arc
 
+# Max distance between a tessellated arc and its true circle [m],
+# arcs get as many segments as needed, up to SOSI_ARC_SEGMENTS per arc
+SOSI_ARC_TOLERANCE = 0.01
+
+# Features per FeatureBatch yielded by the parsers (iter_feature_batches)
+PARSE_BATCH_FEATURES = 10000
+
+# Modal import: seconds of work per timer tick, and max features added at once
+IMPORT_TICK_SECONDS = 0.05
+IMPORT_CHUNK_FEATURES = 2000
+
+# Parsed files waiting in the queue for the main thread
+IMPORT_QUEUE_FILES = 4
+
+# Files parsed ahead of the main thread per worker process (sosi_parallel)
+PARALLEL_FILES_AHEAD = 2
+
+# Line simplification: each level of detail multiplies the tolerance by this
+SIMPLIFY_LOD_FACTOR = 4.0
@@ -0,0 +1,306 @@
+"""Opt-in instrumentation of the import: wall and CPU time per stage,
+feature and vertex counts per element type, peak memory and cProfile.
+
+    sosi_stats.enable(trace_memory=True)
+    with sosi_stats.timer("coordinate decoding"):
+        ...
+    sosi_stats.count("KURVE", features=1, vertices=n)
+    print(sosi_stats.disable().summary())
+
+Instrumentation is off by default. Then timer() returns a shared no-op
+context and count() returns at once, so the instrumented code pays next
+to nothing. Stages may nest (e.g. coordinate decoding within feature
+iteration for GDAL), their times are not exclusive. CPU times are those
+of the thread running the stage.
+
+With trace_rss the resident set size (RSS) of the process is sampled when
+a stage begins and ends, giving the peak RSS seen per stage. Memory
+allocated and freed within one call of a stage is not seen, and the RSS
+is that of the whole process, so it includes other threads.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def _rss_reader():
+    """Return a function giving the resident set size of this process in
+    bytes, or None if unknown. Where the current size can not be read
+    without extra packages (macOS, BSD) it gives the peak size so far."""
+    if sys.platform.startswith("linux"):
+        page = os.sysconf("SC_PAGE_SIZE")
+
+        def statm_rss():
+            # Opened per call: a kept descriptor would leak into forked
+            # workers and give them the RSS of this process
+            with open("/proc/self/statm", "rb") as f:
+                return int(f.read().split()[1]) * page
+        return statm_rss
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage",
+                    "PeakPagefileUsage")]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        get_info = ctypes.WinDLL("psapi").GetProcessMemoryInfo
+        get_info.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD]
+        return lambda: counters.WorkingSetSize if get_info(process, ctypes.byref(counters), counters.cb) else None
+    import resource
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in KiB except on macOS
+    return lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+_read_rss = None
+
+
+def current_rss():
+    """Resident set size of this process in bytes, see _rss_reader."""
+    global _read_rss
+    if _read_rss is None:
+        try:
+            _read_rss = _rss_reader()
+        except (ImportError, OSError, AttributeError):
+            _read_rss = lambda: None  # noqa: E731
+    try:
+        return _read_rss()
+    except (OSError, ValueError):
+        return None
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class _Timer:
+    __slots__ = ("stats", "stage", "wall", "cpu", "rss")
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.rss = current_rss() if self.stats.trace_rss else None
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu = time.perf_counter() - self.wall, time.thread_time() - self.cpu
+        rss = self.rss
+        if rss is not None:
+            rss = max(rss, current_rss() or 0)
+        self.stats.add_time(self.stage, wall, cpu, rss=rss)
+        return False
+
+
+class _Profiled:
+    """Enables a cProfile.Profile for a with block. Python 3.12+ allows only
+    one active profiler, the block then runs unprofiled."""
+    __slots__ = ("prof", "on")
+
+    def __init__(self, prof):
+        self.prof = prof
+
+    def __enter__(self):
+        try:
+            self.prof.enable()
+            self.on = True
+        except ValueError:
+            self.on = False
+        return self
+
+    def __exit__(self, *exc):
+        if self.on:
+            self.prof.disable()
+        return False
+
+
+class Stats:
+    """Timers and counters of one import, safe to update from several threads."""
+
+    def __init__(self, trace_memory=False, profile=False, trace_rss=False):
+        self.lock = threading.Lock()
+        self.stages = {}     # stage -> [calls, wall, cpu, peak RSS or None]
+        self.types = {}      # element type -> [features, vertices]
+        self.counters = {}   # other counts, e.g. files and objects
+        self.trace_memory = trace_memory
+        self.trace_rss = trace_rss
+        self.profile = profile
+        self.profiles = {}   # thread id -> cProfile.Profile
+        self.peak_memory = None
+        self.peak_rss = None
+        self.wall = self.cpu = None
+        self._own_tracing = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracing = True
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._wall0
+        self.cpu = time.process_time() - self._cpu0
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_memory = max(self.peak_memory or 0, peak)
+            if self._own_tracing:
+                tracemalloc.stop()
+
+    def add_time(self, stage, wall, cpu, calls=1, rss=None):
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                self.stages[stage] = [calls, wall, cpu, rss]
+            else:
+                s[0] += calls
+                s[1] += wall
+                s[2] += cpu
+                if rss is not None:
+                    s[3] = max(s[3] or 0, rss)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def count(self, objtype, features=1, vertices=0):
+        with self.lock:
+            t = self.types.get(objtype)
+            if t is None:
+                self.types[objtype] = [features, vertices]
+            else:
+                t[0] += features
+                t[1] += vertices
+
+    def incr(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def profiled(self):
+        """Context profiling the calling thread, when profiling is on."""
+        if not self.profile:
+            return _NO_TIMER
+        with self.lock:
+            return _Profiled(self.profiles.setdefault(threading.get_ident(), cProfile.Profile()))
+
+    def as_dict(self):
+        return dict(
+            wall=self.wall, cpu=self.cpu, peak_memory=self.peak_memory, peak_rss=self.peak_rss,
+            stages={k: dict(calls=v[0], wall=v[1], cpu=v[2], peak_rss=v[3]) for k, v in self.stages.items()},
+            types={k: dict(features=v[0], vertices=v[1]) for k, v in self.types.items()},
+            counters=dict(self.counters),
+        )
+
+    def merge(self, d):
+        """Add the as_dict() of another Stats, e.g. from a worker process."""
+        for k, v in d["stages"].items():
+            self.add_time(k, v["wall"], v["cpu"], v["calls"], v.get("peak_rss"))
+        for k, v in d["types"].items():
+            self.count(k, v["features"], v["vertices"])
+        for k, n in d["counters"].items():
+            self.incr(k, n)
+        if d.get("peak_memory") is not None:
+            with self.lock:
+                self.peak_memory = max(self.peak_memory or 0, d["peak_memory"])
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def summary(self):
+        lines = ["SOSI import statistics: {:.3f} s wall, {:.3f} s CPU".format(self.wall or 0, self.cpu or 0)]
+        if self.peak_memory is not None:
+            lines[0] += ", peak traced memory {:.1f} MB".format(self.peak_memory / 1e6)
+        if self.peak_rss is not None:
+            lines[0] += ", peak RSS {:.1f} MB".format(self.peak_rss / 1e6)
+        if self.counters:
+            lines.append("  " + ", ".join("{} {}".format(n, k) for k, n in sorted(self.counters.items())))
+        if self.stages:
+            rss = self.peak_rss is not None
+            lines.append("  {:<22} {:>9} {:>10} {:>10}".format("stage", "calls", "wall [s]", "cpu [s]")
+                         + (" {:>10}".format("RSS [MB]") if rss else ""))
+            for k, (calls, wall, cpu, peak) in sorted(self.stages.items(), key=lambda kv: -kv[1][1]):
+                lines.append("  {:<22} {:>9} {:>10.3f} {:>10.3f}".format(k, calls, wall, cpu)
+                             + (" {:>10.1f}".format(peak / 1e6) if rss and peak is not None else ""))
+        if self.types:
+            lines.append("  {:<22} {:>9} {:>10}".format("type", "features", "vertices"))
+            for k, (features, vertices) in sorted(self.types.items()):
+                lines.append("  {:<22} {:>9} {:>10}".format(k, features, vertices))
+        return "\n".join(lines)
+
+    def dump_profile(self, path):
+        """Write the collected cProfile data of all threads to path."""
+        with self.lock:
+            profiles = [p for p in self.profiles.values() if p.getstats()]
+        if profiles:
+            pstats.Stats(*profiles).dump_stats(path)
+
+# -----------------------------------------------------------------------------
+
+# Stats of the running import, None when instrumentation is off
+_active = None
+
+
+def enable(trace_memory=False, profile=False, trace_rss=False):
+    """Start collecting, return the new Stats."""
+    global _active
+    _active = Stats(trace_memory, profile, trace_rss)
+    _active.start()
+    return _active
+
+
+def disable():
+    """Stop collecting, return the Stats collected (None if not enabled)."""
+    global _active
+    stats, _active = _active, None
+    if stats is not None:
+        stats.stop()
+    return stats
+
+
+def active():
+    return _active
+
+
+def timer(stage):
+    stats = _active
+    return _NO_TIMER if stats is None else _Timer(stats, stage)
+
+
+def profiled():
+    """Context profiling the calling thread, see Stats.profiled."""
+    stats = _active
+    return _NO_TIMER if stats is None else stats.profiled()
+
+
+def count(objtype, features=1, vertices=0):
+    stats = _active
+    if stats is not None:
+        stats.count(objtype, features, vertices)
+
+
+def incr(counter, n=1):
+    stats = _active
+    if stats is not None:
+        stats.incr(counter, n)
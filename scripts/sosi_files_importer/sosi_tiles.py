@@ -0,0 +1,96 @@
+"""Regular grid of square tiles over the SOSI coordinates, for the tiled
+import.
+
+A feature belongs to the tile holding the centre of its bounding box, so
+each feature is in exactly one tile, whatever tiles it crosses. Tile
+(ix, iy) covers east ix * size to (ix + 1) * size and north iy * size to
+(iy + 1) * size, and is named after its south west corner.
+
+A TileIndex records the feature count of every tile per file and which
+tiles are loaded. It is small (a few numbers per tile), so the importer
+keeps it with the scene and loads the other tiles on demand.
+"""
+
+import json
+
+import numpy as np
+
+from . import sosi_stats as sostats
+
+
+def feature_tiles(coords, offsets, tile_size):
+    """Return the (n, 2) int64 tile (ix, iy) of each feature, see module doc.
+    Features without coordinates get tile (0, 0)."""
+    counts = np.diff(offsets)
+    tiles = np.zeros((len(counts), 2), dtype=np.int64)
+    has = np.flatnonzero(counts > 0)
+    if len(has):
+        with sostats.timer("tiling"):
+            xy = coords[:, :2]
+            lo = np.minimum.reduceat(xy, offsets[:-1][has])
+            hi = np.maximum.reduceat(xy, offsets[:-1][has])
+            tiles[has] = np.floor((lo + hi) / (2.0 * tile_size)).astype(np.int64)
+    return tiles
+
+
+def tile_name(tile, tile_size):
+    return "E{:.0f} N{:.0f}".format(tile[0] * tile_size, tile[1] * tile_size)
+
+
+def tile_bbox(tile, tile_size):
+    """(min E, min N, max E, max N) of a tile."""
+    return (tile[0] * tile_size, tile[1] * tile_size, (tile[0] + 1) * tile_size, (tile[1] + 1) * tile_size)
+
+
+def tiles_near(point, radius, tile_size):
+    """Set of the tiles at most radius tiles (in east and north) from the
+    tile holding point (E, N)."""
+    cx, cy = int(np.floor(point[0] / tile_size)), int(np.floor(point[1] / tile_size))
+    return {(ix, iy) for ix in range(cx - radius, cx + radius + 1) for iy in range(cy - radius, cy + radius + 1)}
+
+
+class TileIndex:
+    """Feature counts per tile and file, and the tiles loaded, of a tiled import.
+
+    settings holds what a later load of more tiles needs to import them the
+    same way (file paths, simplification, filter), as JSON compatible values.
+    """
+
+    def __init__(self, tile_size, settings=None):
+        self.tile_size = tile_size
+        self.settings = settings or {}
+        self.files = {}      # tile -> {path: features}
+        self.loaded = set()
+
+    def add_file(self, path, tile_counts):
+        """Record the features per tile ({tile: count}) of the file path."""
+        for tile, n in tile_counts.items():
+            self.files.setdefault(tuple(tile), {})[path] = int(n)
+
+    def tile_files(self, tiles):
+        """Files with features in any of tiles, in path order."""
+        return sorted({path for tile in tiles for path in self.files.get(tile, ())})
+
+    def unloaded(self, tiles=None):
+        """Tiles with features that are not loaded, of tiles (default all)."""
+        tiles = self.files.keys() if tiles is None else tiles
+        return {t for t in tiles if t in self.files and t not in self.loaded}
+
+    def features(self, tile):
+        return sum(self.files.get(tile, {}).values())
+
+    def to_json(self):
+        return json.dumps(dict(
+            tile_size=self.tile_size, settings=self.settings,
+            tiles=[dict(tile=list(t), files=f, loaded=t in self.loaded) for t, f in sorted(self.files.items())]))
+
+    @classmethod
+    def from_json(cls, text):
+        d = json.loads(text)
+        index = cls(d["tile_size"], d.get("settings"))
+        for t in d["tiles"]:
+            tile = tuple(t["tile"])
+            index.files[tile] = dict(t["files"])
+            if t["loaded"]:
+                index.loaded.add(tile)
+        return index
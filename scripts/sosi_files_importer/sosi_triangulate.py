@@ -0,0 +1,355 @@
+"""Triangulation of polygons with holes (FLATE with interior rings).
+
+The holes are first bridged into the exterior ring, giving one weakly
+simple ring, which is then ear clipped. Both steps are NumPy vectorised:
+a bridge is found with one pass over the ring edges, and each ear
+clipping pass clips a set of non neighbouring ears at once and only
+re-tests the vertices next to them, against the reflex vertices found
+through a uniform grid. Small rings, where the NumPy call overhead
+dominates, are ear clipped in plain Python instead.
+"""
+
+import logging
+import numpy as np
+from . import sosi_datahelper as sodhlp
+
+# Triangle and reflex vertex pairs tested in one array operation
+CHUNK_SIZE = 1 << 22
+# Rings up to this many vertices (holes bridged in) are clipped in plain Python
+SMALL_RING = 64
+
+
+def _signed_area(xy):
+    x, y = xy[:, 0], xy[:, 1]
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def _cross(a, b, c):
+    """z of (b - a) x (c - b) for arrays of 2D points."""
+    return (b[..., 0] - a[..., 0]) * (c[..., 1] - b[..., 1]) - (b[..., 1] - a[..., 1]) * (c[..., 0] - b[..., 0])
+
+
+def plane_axes(coords):
+    """The two coordinate axes spanning the axis plane that best faces the
+    normal of the 3D ring coords (Newell's method), ordered so that the
+    third axis points along the positive normal direction of that plane.
+    """
+    nxt = np.roll(coords, -1, axis=0)
+    normal = np.array([
+        np.sum((coords[:, 1] - nxt[:, 1]) * (coords[:, 2] + nxt[:, 2])),
+        np.sum((coords[:, 2] - nxt[:, 2]) * (coords[:, 0] + nxt[:, 0])),
+        np.sum((coords[:, 0] - nxt[:, 0]) * (coords[:, 1] + nxt[:, 1]))])
+    axis = int(np.argmax(np.abs(normal)))
+    return [(axis + 1) % 3, (axis + 2) % 3]
+
+
+def _bridge_slot(ring, p, target, xy):
+    """An earlier bridge may have put vertex ring[p] in the ring more than
+    once, return the slot whose interior angle contains the target point."""
+    slots = np.flatnonzero(ring == ring[p])
+    if len(slots) == 1:
+        return p
+    n = len(ring)
+    for s in slots:
+        pa, pv, pb = xy[ring[s - 1]], xy[ring[s]], xy[ring[(s + 1) % n]]
+        after_next = _cross(pv, pb, target) > 0
+        before_prev = _cross(pv, target, pa) > 0
+        if _cross(pa, pv, pb) > 0:
+            if after_next and before_prev:
+                return s
+        elif after_next or before_prev:
+            return s
+    return p
+
+
+def _bridge_hole(ring, hole, xy):
+    """Splice hole into ring (both index arrays into xy) through a bridge
+    from the rightmost hole vertex to a visible ring vertex."""
+    m = hole[np.argmax(xy[hole, 0])]
+    mx, my = xy[m]
+    a = xy[ring]
+    b = xy[np.roll(ring, -1)]
+    # Ring edges crossing the horizontal ray from m towards +x
+    spans = (a[:, 1] - my) * (b[:, 1] - my) <= 0
+    dy = b[:, 1] - a[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(dy != 0, (my - a[:, 1]) / dy, 0.0)
+    ix = a[:, 0] + t * (b[:, 0] - a[:, 0])
+    ix = np.where(dy == 0, np.maximum(a[:, 0], b[:, 0]), ix)
+    hit = spans & (ix >= mx)
+    if not hit.any():
+        # Hole outside the exterior ring, bridge to the nearest vertex
+        p = int(np.argmin(np.sum((a - xy[m]) ** 2, axis=1)))
+    else:
+        e = int(np.flatnonzero(hit)[np.argmin(ix[hit])])
+        ixe = ix[e]
+        # Candidate: the end point of the hit edge furthest towards +x
+        p = e if a[e, 0] >= b[e, 0] else (e + 1) % len(ring)
+        if xy[ring[p], 0] != ixe or xy[ring[p], 1] != my:
+            # Other ring vertices inside the triangle (m, hit point, p) may
+            # hide p, the one with the smallest angle to the ray is visible
+            px, py = xy[ring[p]]
+            tri = np.array([[mx, my], [ixe, my], [px, py]])
+            if _cross(tri[0], tri[1], tri[2]) < 0:
+                tri = tri[::-1]
+            inside = ((_cross(tri[0], tri[1], a) >= 0) & (_cross(tri[1], tri[2], a) >= 0)
+                      & (_cross(tri[2], tri[0], a) >= 0) & (a[:, 0] >= mx))
+            inside &= ring != ring[p]
+            if inside.any():
+                cand = np.flatnonzero(inside)
+                ang = np.abs(a[cand, 1] - my) / np.maximum(a[cand, 0] - mx, 1e-300)
+                dist = (a[cand, 0] - mx) ** 2 + (a[cand, 1] - my) ** 2
+                p = int(cand[np.lexsort((dist, ang))[0]])
+    p = _bridge_slot(ring, p, xy[m], xy)
+    k = int(np.flatnonzero(hole == m)[0])
+    hole_seq = np.concatenate((hole[k:], hole[:k + 1]))
+    return np.concatenate((ring[:p + 1], hole_seq, ring[p:]))
+
+
+class _Ring:
+    """Doubly linked ring of vertex slots being ear clipped.
+
+    Slot i holds vertex idx[i]; prv/nxt link the remaining slots. The
+    reflex slots are binned in a uniform grid. A clipped ear only makes its
+    neighbours more convex, so the reflex set only shrinks and the grid
+    is built once, slots that turned convex are skipped when queried.
+    """
+
+    def __init__(self, xy, idx):
+        self.idx = idx
+        self.pts = xy[idx]
+        n = len(idx)
+        slots = np.arange(n)
+        self.prv = np.roll(slots, 1)
+        self.nxt = np.roll(slots, -1)
+        self.alive = np.ones(n, dtype=bool)
+        self.cross = _cross(self.pts[self.prv], self.pts, self.pts[self.nxt])
+        reflex = np.flatnonzero(self.cross <= 0)
+        # About one reflex slot per grid cell
+        self.gn = max(1, int(np.sqrt(len(reflex))))
+        self.lo = self.pts.min(axis=0)
+        extent = self.pts.max(axis=0) - self.lo
+        self.cell = np.where(extent > 0, extent / self.gn, 1.0)
+        cx, cy = self._cells(self.pts[reflex])
+        cid = cy * self.gn + cx
+        self.grid_slots = reflex[np.argsort(cid, kind='stable')]
+        self.cell_start = np.concatenate(([0], np.cumsum(np.bincount(cid, minlength=self.gn * self.gn))))
+        self.ear = np.zeros(n, dtype=bool)
+        self.update(slots)
+
+    def _cells(self, pts):
+        c = np.clip(((pts - self.lo) / self.cell).astype(np.int64), 0, self.gn - 1)
+        return c[:, 0], c[:, 1]
+
+    def _pairs(self, a, b, d):
+        """(triangle, reflex slot) pairs for the reflex slots in the grid
+        cells overlapped by the bounding boxes of the triangles."""
+        tmin = np.minimum(np.minimum(a, b), d)
+        tmax = np.maximum(np.maximum(a, b), d)
+        cx0, cy0 = self._cells(tmin)
+        cx1, cy1 = self._cells(tmax)
+        ncx = cx1 - cx0 + 1
+        ncell = ncx * (cy1 - cy0 + 1)
+        tri = np.repeat(np.arange(len(a)), ncell)
+        k = sodhlp.ranges_concat(np.zeros(len(a), dtype=np.int64), ncell)
+        cid = (cy0[tri] + k // ncx[tri]) * self.gn + cx0[tri] + k % ncx[tri]
+        first = self.cell_start[cid]
+        cnt = self.cell_start[cid + 1] - first
+        return np.repeat(tri, cnt), self.grid_slots[sodhlp.ranges_concat(first, cnt)]
+
+    def update(self, slots):
+        """Recompute convexity and the ear test of slots."""
+        pts, prv, nxt = self.pts, self.prv, self.nxt
+        self.cross[slots] = _cross(pts[prv[slots]], pts[slots], pts[nxt[slots]])
+        cand = slots[self.cross[slots] > 0]
+        self.ear[slots] = False
+        if len(cand) == 0:
+            return
+        blocked = np.zeros(len(cand), dtype=bool)
+        # Chunks bound the size of the pair arrays
+        step = max(1, CHUNK_SIZE // max(1, len(self.grid_slots)))
+        for s in range(0, len(cand), step):
+            c = cand[s:s + step]
+            a, b, d = pts[prv[c]], pts[c], pts[nxt[c]]
+            pc, pr = self._pairs(a, b, d)
+            # Reflex slots may have turned convex since, the triangle's own
+            # slots do not count
+            cc = c[pc]
+            keep = (self.cross[pr] <= 0) & (pr != cc) & (pr != prv[cc]) & (pr != nxt[cc])
+            pc, pr, cc = pc[keep], pr[keep], cc[keep]
+            a, b, d = a[pc], b[pc], d[pc]
+            p = pts[pr]
+            inside = (_cross(a, b, p) >= 0) & (_cross(b, d, p) >= 0) & (_cross(d, a, p) >= 0)
+            # Other slots at one of the triangle's corners (the two ends of
+            # a bridge) only count when one of their edges enters the
+            # triangle's angle at that corner
+            v = self.idx[pr]
+            for corner, s1, s2 in ((prv[cc], b, d), (cc, d, a), (nxt[cc], a, b)):
+                copy = np.flatnonzero(inside & (v == self.idx[corner]))
+                if len(copy):
+                    o, s1, s2, r = pts[corner[copy]], s1[copy], s2[copy], pr[copy]
+                    enters = np.zeros(len(copy), dtype=bool)
+                    for q in (pts[prv[r]], pts[nxt[r]]):
+                        enters |= (_cross(o, s1, q) > 0) & (_cross(o, q, s2) > 0)
+                    inside[copy] = enters
+            blocked[s + pc[inside]] = True
+        self.ear[cand] = ~blocked
+
+    def clip(self, slots):
+        """Remove the independent (non neighbouring) slots from the ring,
+        return the slots next to them."""
+        p, q = self.prv[slots], self.nxt[slots]
+        self.nxt[p] = q
+        self.prv[q] = p
+        self.alive[slots] = False
+        self.ear[slots] = False
+        self.cross[slots] = 1.0   # Never reflex again
+        return np.unique(np.concatenate((p, q)))
+
+
+def _ear_clip_small(xy, idx):
+    """ear_clip for small rings: one ear at a time, tested against the
+    reflex vertices only, in plain Python."""
+    pts = xy[idx].tolist()
+    ids = idx.tolist()
+    n = len(ids)
+    prv = [n - 1] + list(range(n - 1))
+    nxt = list(range(1, n)) + [0]
+
+    def cross(s):
+        (ax, ay), (bx, by), (cx, cy) = pts[prv[s]], pts[s], pts[nxt[s]]
+        return (bx - ax) * (cy - by) - (by - ay) * (cx - bx)
+
+    def is_ear(s):
+        if crosses[s] <= 0:
+            return False
+        p, q = prv[s], nxt[s]
+        corners = (ids[p], ids[s], ids[q])
+        (ax, ay), (bx, by), (cx, cy) = pts[p], pts[s], pts[q]
+        for r in reflex:
+            # Other slots of a corner vertex (the two ends of a bridge) do not block
+            if ids[r] in corners:
+                continue
+            px, py = pts[r]
+            if ((bx - ax) * (py - by) - (by - ay) * (px - bx) >= 0
+                    and (cx - bx) * (py - cy) - (cy - by) * (px - cx) >= 0
+                    and (ax - cx) * (py - ay) - (ay - cy) * (px - ax) >= 0):
+                return False
+        return True
+
+    crosses = [cross(s) for s in range(n)]
+    reflex = {s for s in range(n) if crosses[s] <= 0}
+    tris = []
+    s, remaining, tried = 0, n, 0
+    while remaining > 3:
+        if tried == remaining:
+            # Self intersecting or degenerate input: clip the most convex
+            # vertex, as ear_clip does
+            s = max((t for t in range(n) if crosses[t] is not None), key=lambda t: crosses[t])
+            logging.debug("Triangulation: no ear among %d vertices", remaining)
+            ear = crosses[s] > 0
+        else:
+            ear = is_ear(s)
+        if not ear and tried < remaining:
+            s = nxt[s]
+            tried += 1
+            continue
+        p, q = prv[s], nxt[s]
+        if crosses[s] > 0:
+            tris.append((ids[p], ids[s], ids[q]))
+        nxt[p], prv[q] = q, p
+        crosses[s] = None
+        reflex.discard(s)
+        remaining -= 1
+        for t in (p, q):
+            crosses[t] = cross(t)
+            if crosses[t] > 0:
+                reflex.discard(t)
+            else:
+                reflex.add(t)
+        s, tried = p, 0
+    s = next(t for t in range(n) if crosses[t] is not None)
+    tris.append((ids[prv[s]], ids[s], ids[nxt[s]]))
+    return np.array(tris, dtype=np.int32).reshape(-1, 3)
+
+
+def ear_clip(xy, idx):
+    """Triangulate the counter clockwise ring idx (indices into the (n, 2)
+    array xy). Return an (n - 2, 3) int array of counter clockwise triangles.
+
+    In each pass all ears that are local maxima of a fixed random priority
+    are clipped together, so no two neighbours are clipped at once.
+    """
+    idx = np.asarray(idx)
+    n = len(idx)
+    if n < 3:
+        return np.zeros((0, 3), dtype=np.int32)
+    if n <= SMALL_RING:
+        return _ear_clip_small(xy, idx)
+    ring = _Ring(xy, idx)
+    prio = np.random.default_rng(0).permutation(n)
+    tris = []
+    remaining = n
+    while remaining > 3:
+        ears = np.flatnonzero(ring.ear)
+        if len(ears):
+            pp, pn = ring.prv[ears], ring.nxt[ears]
+            best = ((~ring.ear[pp] | (prio[ears] > prio[pp]))
+                    & (~ring.ear[pn] | (prio[ears] > prio[pn])))
+            sel = ears[best][:remaining - 3]
+        else:
+            # Self intersecting or degenerate input: clip the most convex
+            # vertex, no triangle for a vertex on a straight line
+            alive = np.flatnonzero(ring.alive)
+            sel = alive[np.argmax(ring.cross[alive])][None]
+            logging.debug("Triangulation: no ear among %d vertices", remaining)
+            if ring.cross[sel[0]] <= 0:
+                ring.update(ring.clip(sel))
+                remaining -= 1
+                continue
+        tris.append(np.column_stack((idx[ring.prv[sel]], idx[sel], idx[ring.nxt[sel]])))
+        ring.update(ring.clip(sel))
+        remaining -= len(sel)
+    last = np.flatnonzero(ring.alive)
+    if len(last) == 3:
+        s = last[0]
+        tris.append(np.array([[idx[ring.prv[s]], idx[s], idx[ring.nxt[s]]]]))
+    if not tris:
+        return np.zeros((0, 3), dtype=np.int32)
+    return np.concatenate(tris).astype(np.int32)
+
+
+def polygon_triangulate(coords, ring_offsets):
+    """Triangulate one polygon with holes.
+
+    coords -- (n, 3) or (n, 2) coordinates of all rings, without closing points
+    ring_offsets -- ring i is coords[ring_offsets[i]:ring_offsets[i + 1]],
+        ring 0 is the exterior ring, the others are holes
+    Return an (m, 3) int32 array of vertex indices into coords. The triangles
+    are counter clockwise in the plane given by plane_axes, so horizontal
+    polygons face upwards whatever the orientation of their rings.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    ring_offsets = np.asarray(ring_offsets)
+    if ring_offsets[1] - ring_offsets[0] < 3:
+        return np.zeros((0, 3), dtype=np.int32)
+    if coords.shape[1] == 3:
+        xy = coords[:, plane_axes(coords[ring_offsets[0]:ring_offsets[1]])]
+    else:
+        xy = coords
+    rings = [np.arange(ring_offsets[i], ring_offsets[i + 1])
+             for i in range(len(ring_offsets) - 1)]
+    outer = rings[0]
+    if _signed_area(xy[outer]) < 0:
+        outer = outer[::-1]
+    holes = []
+    for h in rings[1:]:
+        if len(h) < 3:
+            continue
+        holes.append(h[::-1] if _signed_area(xy[h]) > 0 else h)  # Holes clockwise
+    # Rightmost holes first, so the bridges do not cross each other
+    holes.sort(key=lambda h: -xy[h, 0].max())
+    for h in holes:
+        outer = _bridge_hole(outer, h, xy)
+    return ear_clip(xy, outer)
+
@@ -0,0 +1,89 @@
+"""Coordinates of ISO WKB geometries, as exported by the GDAL parser."""
+
+import numpy as np
+
+# ISO WKB geometry type codes (+1000 for Z, +2000 for M, +3000 for ZM)
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+WKB_MULTIPOINT = 4
+WKB_MULTILINESTRING = 5
+WKB_MULTIPOLYGON = 6
+
+# Values per coordinate and whether the third is Z, by type code // 1000
+WKB_DIMS = {0: (2, False), 1: (3, True), 2: (3, False), 3: (4, True)}
+
+
+def _wkb_runs(wkb, offset, runs, holes):
+    """Collect the coordinate runs of the WKB geometry at offset as
+    (byte offset, point count, values per point, has Z) in runs, with True
+    in holes for the interior rings of polygons. Return the offset after
+    the geometry. Only the headers are read, the coordinates are skipped.
+    """
+    code = int.from_bytes(wkb[offset + 1:offset + 5], "little")
+    gtype = code % 1000
+    ndims, has_z = WKB_DIMS.get(code // 1000, (None, False))
+    if ndims is None:
+        raise ValueError("unsupported WKB geometry type {}".format(code))
+    coord_len = 8 * ndims
+    offset += 5
+    if gtype == WKB_POINT:
+        runs.append((offset, 1, ndims, has_z))
+        holes.append(False)
+        return offset + coord_len
+    count = int.from_bytes(wkb[offset:offset + 4], "little")
+    offset += 4
+    if gtype == WKB_LINESTRING:
+        runs.append((offset, count, ndims, has_z))
+        holes.append(False)
+        return offset + count * coord_len
+    if gtype == WKB_POLYGON:
+        for r in range(count):
+            npts = int.from_bytes(wkb[offset:offset + 4], "little")
+            runs.append((offset + 4, npts, ndims, has_z))
+            holes.append(r > 0)
+            offset += 4 + npts * coord_len
+        return offset
+    if gtype in (WKB_MULTIPOINT, WKB_MULTILINESTRING, WKB_MULTIPOLYGON):
+        for k in range(count):
+            offset = _wkb_runs(wkb, offset, runs, holes)
+        return offset
+    raise ValueError("unsupported WKB geometry type {}".format(code))
+
+
+def _run_coords(wkb, offset, npts, ndims, has_z):
+    """The (npts, 3) coordinates of one run, Z being 0 without Z values."""
+    values = np.frombuffer(wkb, dtype="<f8", count=npts * ndims, offset=offset).reshape(npts, ndims)
+    if ndims == 3 and has_z:
+        return values
+    coords = np.zeros((npts, 3))
+    coords[:, :3 if has_z else 2] = values[:, :3 if has_z else 2]
+    return coords
+
+
+def wkb_coords(wkb):
+    """Return the coordinates of a little endian ISO WKB (multi) point, line
+    or polygon as an (n, 3) array, plus the part offsets and hole flags.
+    Raise ValueError for other geometry types.
+
+    XYZ coordinates are viewed directly in the WKB buffer with np.frombuffer,
+    so no Python work is done per vertex, others are copied with Z 0 (2D)
+    and without M. The parts (lines of a MULTILINESTRING, rings of the
+    polygons, exterior ring first) follow each other in the array, part j
+    being coords[parts[j]:parts[j + 1]], and holes[j] is True for interior
+    rings. parts and holes are None for a single part and for points.
+    """
+    runs, holes = [], []
+    _wkb_runs(wkb, 0, runs, holes)
+    if len(runs) == 1:
+        return _run_coords(wkb, *runs[0]), None, None
+    if all(ndims == 3 and has_z for _, _, ndims, has_z in runs):
+        # The parts are separated by WKB headers, join them into one buffer
+        buf = b"".join(wkb[offset:offset + npts * 24] for offset, npts, _, _ in runs)
+        coords = np.frombuffer(buf, dtype="<f8").reshape(-1, 3)
+    else:
+        coords = np.concatenate([_run_coords(wkb, *run) for run in runs])
+    if int.from_bytes(wkb[1:5], "little") % 1000 == WKB_MULTIPOINT:
+        return coords, None, None
+    parts = np.concatenate(([0], np.cumsum([run[1] for run in runs])))
+    return coords, parts, np.asarray(holes, dtype=bool)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+SOME_BORDERS = os.path.join(ROOT, 'test_data', 'SomeBorders.sos')
+
+# Elements of the file written by make_sosi for the tests
+SYNTHETIC_COUNTS = {'PUNKT': 40, 'KURVE': 60, 'BUEP': 20, 'FLATE': 30}
+
+
+@pytest.fixture(scope='session')
+def synthetic_sos(tmp_path_factory):
+    """Path of a SOSI file written by benchmarks/make_sosi.py."""
+    import make_sosi
+    path = str(tmp_path_factory.mktemp('sosi') / 'synthetic.sos')
+    make_sosi.write_sosi(path, SYNTHETIC_COUNTS, holes=2, attributes=True)
+    return path
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from sosi_files_importer import sosi_geom_helper as sogeom
+from sosi_files_importer import sosi_settings as soset
+
+UTM = np.array([600000.0, 6600000.0, 100.0])
+
+
+def arc(angles, radius=10.0, center=(0.0, 0.0, 0.0)):
+    """Start, middle and end point at angles (radians) on a horizontal circle."""
+    t = np.asarray(angles, dtype=float)
+    return np.asarray(center) + radius * np.column_stack((np.cos(t), np.sin(t), np.zeros(3)))
+
+
+def sagittas(pts, center, radius):
+    """Distance from the middle of each segment to the circle."""
+    mid = (pts[1:] + pts[:-1]) / 2
+    return radius - np.linalg.norm(mid - center, axis=1)
+
+
+@pytest.mark.parametrize('angles', [
+    (0.0, np.pi / 2, np.pi), (np.pi, np.pi / 2, 0.0),               # CCW, CW half circle
+    (0.3, 2.0, 5.5), (5.5, 2.0, 0.3),                               # CCW, CW three quarters
+    (0.0, 0.01, 0.02)])                                             # short arc
+@pytest.mark.parametrize('center', [np.zeros(3), UTM])
+def test_arc_on_circle(angles, center):
+    radius = 50.0
+    pts3 = arc(angles, radius, center)
+    coords, offsets = sogeom.arcs_tessellate(pts3, tolerance=0.01, max_segs=1000)
+    assert offsets.tolist() == [0, len(coords)]
+    # The original points are kept exactly
+    assert coords[0].tolist() == pts3[0].tolist() and coords[-1].tolist() == pts3[2].tolist()
+    assert any(c.tolist() == pts3[1].tolist() for c in coords)
+    assert np.allclose(np.linalg.norm(coords - center, axis=1), radius, atol=1e-6)
+    # The arc goes through the middle point, in one direction
+    d = coords - center
+    t = np.unwrap(np.arctan2(d[:, 1], d[:, 0]))
+    steps = np.diff(t)
+    assert (steps > 0).all() or (steps < 0).all()
+    assert np.isclose(abs(t[-1] - t[0]), abs(angles[2] - angles[0]))
+    # Chord error below tolerance, with no more segments than needed
+    sag = sagittas(coords, center, radius)
+    assert sag.max() <= 0.01
+    step = 2 * np.arccos(1 - 0.01 / radius)
+    assert len(coords) - 1 <= np.ceil(abs(t[-1] - t[0]) / step) + 1
+
+
+def test_chord_tolerance():
+    pts3 = arc((0.0, np.pi / 2, np.pi), 100.0)
+    counts = [len(sogeom.arcs_tessellate(pts3, tolerance=tol, max_segs=10 ** 6)[0]) - 1
+              for tol in (1.0, 0.1, 0.01)]
+    assert counts[0] < counts[1] < counts[2]
+    # A tolerance above the radius still keeps the middle point
+    assert len(sogeom.arcs_tessellate(pts3, tolerance=1000.0)[0]) == 3
+
+
+@pytest.mark.parametrize('angles', [(0.0, np.pi / 2, np.pi), (0.0, 0.2, 2 * np.pi - 0.2)])
+def test_segments_capped_per_arc(angles):
+    pts3 = arc(angles, 1000.0)
+    coords, _ = sogeom.arcs_tessellate(pts3, tolerance=1e-6, max_segs=32)
+    assert len(coords) - 1 == 32
+    coords, _ = sogeom.arcs_tessellate(pts3, tolerance=1e-6)
+    assert len(coords) - 1 == soset.SOSI_ARC_SEGMENTS
+
+
+@pytest.mark.parametrize('pts3', [
+    [[0, 0, 0], [1, 1, 0], [2, 2, 0]],                  # collinear
+    [[0, 0, 0], [2, 2, 0], [1, 1, 0]],                  # collinear, middle outside
+    [[0, 0, 0], [0, 0, 0], [1, 0, 0]],                  # coincident
+    [[0, 0, 0], [0, 0, 0], [0, 0, 0]]])
+def test_degenerate_arc_kept(pts3):
+    pts3 = np.asarray(pts3, dtype=float) + UTM
+    coords, offsets = sogeom.arcs_tessellate(pts3)
+    assert offsets.tolist() == [0, 3]
+    assert coords.tolist() == pts3.tolist()
+
+
+def test_many_arcs():
+    arcs = np.stack([arc((0.0, np.pi / 2, np.pi), 10.0, UTM),
+                     [[0, 0, 0], [1, 1, 0], [2, 2, 0]],
+                     arc((np.pi, np.pi / 2, 0.0), 20.0, UTM)])
+    coords, offsets = sogeom.arcs_tessellate(arcs)
+    assert len(offsets) == 4
+    for i in range(3):
+        one = sogeom.arcs_tessellate(arcs[i])[0]
+        assert coords[offsets[i]:offsets[i + 1]].tolist() == one.tolist()
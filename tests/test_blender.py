@@ -0,0 +1,74 @@
+"""Mesh building tests, run where the bpy module is installed (pip install bpy)."""
+import json
+import re
+
+import numpy as np
+import pytest
+
+bpy = pytest.importorskip('bpy')
+
+from sosi_files_importer import blender_helper as bldhlp  # noqa: E402
+from sosi_files_importer import sosi_core  # noqa: E402
+from sosi_files_importer import sosi_stats as sostats  # noqa: E402
+
+
+def build(path, chunk):
+    """Build the objects of path with the mesh builder, flushing every
+    chunk features. Return {sosi name: (mesh sizes, attribute arrays, kinds)}."""
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    registry = bldhlp.ImportRegistry()
+    builder = bldhlp.MeshBatchBuilder(registry)
+    coll = bpy.data.collections.new('test')
+    bpy.context.scene.collection.children.link(coll)
+    for _, mdatas in sosi_core.read_files([path]):
+        for mdata in mdatas:
+            for start in range(0, len(mdata), chunk):
+                builder.add_mesh_data(coll, mdata, start, min(start + chunk, len(mdata)))
+                builder.build()
+    res = {}
+    for ob in coll.objects:
+        mesh = ob.data
+        arrays = {}
+        for attr in mesh.attributes:
+            if attr.data_type == 'FLOAT_VECTOR':
+                values = np.empty(len(attr.data) * 3, dtype=np.float32)
+                attr.data.foreach_get('vector', values)
+            elif attr.data_type in ('INT', 'FLOAT'):
+                values = np.empty(len(attr.data), dtype=np.int32 if attr.data_type == 'INT' else np.float32)
+                attr.data.foreach_get('value', values)
+            else:
+                continue
+            arrays[(attr.name, attr.domain)] = values
+        sizes = (len(mesh.vertices), len(mesh.edges), len(mesh.polygons))
+        res[ob[bldhlp.ImportRegistry.SOSI_NAME_PROP]] = (sizes, arrays, json.loads(mesh[bldhlp.Mesh.ATTRS_PROP]))
+    return res
+
+
+@pytest.fixture(scope='module')
+def mixed_sos(synthetic_sos, tmp_path_factory):
+    """synthetic_sos with some lines and points named like surfaces, so
+    that object mixes faces, edges and points."""
+    with open(synthetic_sos, encoding='utf-8') as f:
+        text = re.sub(r'\.\.OBJTYPE (Veikant|Terrengpunkt)', '..OBJTYPE Bygning', f.read())
+    path = tmp_path_factory.mktemp('sosi') / 'mixed.sos'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('sos', ['synthetic_sos', 'mixed_sos'])
+def test_flushes_append_like_one_build(request, sos):
+    path = request.getfixturevalue(sos)
+    once = build(path, 10 ** 9)
+    sostats.enable()
+    try:
+        flushed = build(path, 7)
+    finally:
+        counters = sostats.disable().counters
+    assert counters.get("objects extended", 0) > 0
+    assert once.keys() == flushed.keys()
+    for name, (sizes, arrays, kinds) in once.items():
+        assert flushed[name][0] == sizes
+        assert flushed[name][2] == kinds
+        assert flushed[name][1].keys() == arrays.keys()
+        for key, values in arrays.items():
+            assert np.array_equal(flushed[name][1][key], values, equal_nan=True), (name, key)
@@ -0,0 +1,95 @@
+import numpy as np
+
+from sosi_files_importer import sosi_cache
+from sosi_files_importer import sosi_core
+from sosi_files_importer import sosi_datahelper as sodhlp
+from sosi_files_importer import sosi_tiles
+
+
+def file_keys(path):
+    batch = sodhlp.FeatureBatch.concat(sosi_cache.read_batches(path, 'NATIVE'))
+    return batch, sodhlp.feature_keys(batch.serials, batch.hashes())
+
+
+def nfeatures(mdatas):
+    return sum(len(m) for m in mdatas)
+
+
+def move_first_point(src, dst):
+    """Copy the SOSI file src to dst with the coordinates of .PUNKT 1 changed."""
+    lines = open(src, 'rb').read().split(b'\n')
+    k = lines.index(b'.PUNKT 1:')
+    while not lines[k].startswith(b'..N'):
+        k += 1
+    n, e = lines[k + 1].split()[:2]
+    lines[k + 1] = b'%d %d' % (int(n) + 100, int(e))
+    open(dst, 'wb').write(b'\n'.join(lines))
+
+
+def test_feature_keys_stable(synthetic_sos):
+    _, keys = file_keys(synthetic_sos)
+    _, again = file_keys(synthetic_sos)
+    assert len(np.unique(keys)) == len(keys)
+    assert np.array_equal(keys, again)
+
+
+def test_update_prepares_changed_only(synthetic_sos, tmp_path):
+    batch, keys = file_keys(synthetic_sos)
+    mdatas = sosi_core.read_file(synthetic_sos, known=keys)
+    assert nfeatures(mdatas) == 0
+    assert np.array_equal(mdatas[0].file_keys, keys)
+
+    changed = str(tmp_path / 'changed.sos')
+    move_first_point(synthetic_sos, changed)
+    mdatas = sosi_core.read_file(changed, known=keys)
+    assert nfeatures(mdatas) == 1
+    assert mdatas[0].serials.tolist() == [1]
+    new_keys = mdatas[0].file_keys
+    assert len(new_keys) == len(keys)
+    # Only the key of the moved point differs
+    assert np.isin(new_keys, keys).sum() == len(keys) - 1
+    assert keys[batch.serials == 1][0] not in new_keys
+
+
+def test_tiling(synthetic_sos):
+    batch, _ = file_keys(synthetic_sos)
+    tile_size = 200.0
+    ftiles = [tuple(t) for t in sosi_tiles.feature_tiles(batch.coords, batch.offsets, tile_size).tolist()]
+    mdatas = sosi_core.read_file(synthetic_sos, tiling=(tile_size, None))
+    counts = mdatas[0].tile_counts
+    assert sum(counts.values()) == len(batch)
+    assert counts == {t: ftiles.count(t) for t in set(ftiles)}
+    assert len(counts) > 1
+    tile_of = dict(zip(batch.serials.tolist(), ftiles))
+    assert nfeatures(mdatas) == len(batch)
+    for mdata in mdatas:
+        assert all(tile_of[s] == mdata.tile for s in mdata.serials.tolist())
+
+    # Only the requested tile is prepared, the counts still cover the file
+    tile = max(counts, key=counts.get)
+    mdatas = sosi_core.read_file(synthetic_sos, tiling=(tile_size, {tile}))
+    assert {m.tile for m in mdatas} == {tile}
+    assert nfeatures(mdatas) == counts[tile]
+    assert mdatas[0].tile_counts == counts
+
+    # No requested tile in the file, an empty MeshData with the counts
+    mdatas = sosi_core.read_file(synthetic_sos, tiling=(tile_size, {(0, 0)}))
+    assert nfeatures(mdatas) == 0
+    assert mdatas[0].tile_counts == counts
+
+
+def test_mesh_data_features(synthetic_sos):
+    batch, _ = file_keys(synthetic_sos)
+    mdata, = sosi_core.read_file(synthetic_sos)
+    assert len(mdata) == len(batch)
+    nverts = np.diff(mdata.vert_offsets)
+    nedges = np.diff(mdata.edge_offsets)
+    nfaces = np.diff(mdata.face_offsets)
+    punkt = batch.obj_ids == sodhlp.SosiObjId.PUNKT.value
+    kurve = batch.obj_ids == sodhlp.SosiObjId.KURVE.value
+    flate = batch.obj_ids == sodhlp.SosiObjId.FLATE.value
+    assert (nedges[punkt] == 0).all() and (nfaces[punkt] == 0).all()
+    assert (nedges[kurve] == nverts[kurve] - 1).all()
+    # Surfaces with holes are triangulated
+    assert (nfaces[flate] > 1).all() and (nedges[flate] == 0).all()
+    assert (mdata.edges[:, 0] < mdata.edges[:, 1]).all()
@@ -0,0 +1,33 @@
+import pytest
+
+from sosi_files_importer import sosi_filter
+
+
+@pytest.mark.parametrize('text, sql', [
+    ('HØYDE>100', '"høyde" > 100'),
+    ('..MEDIUM=T', '"medium" = \'T\''),
+    ("NAVN!=O'Hara", '"navn" <> \'O\'\'Hara\''),
+    ('NAVN="Øvre vei"', '"navn" = \'Øvre vei\''),
+    ('KVALITET.NØYAKTIGHET<=2.5', '"kvalitet.nøyaktighet" <= 2.5')])
+def test_predicate_sql(text, sql):
+    assert sosi_filter.Predicate.parse(text).to_sql() == sql
+
+
+def test_filter_sql():
+    assert sosi_filter.FeatureFilter().to_sql() is None
+    filt = sosi_filter.FeatureFilter(['Veikant', "Ku'lvert"], ['Bygning'], ['medium=T'])
+    assert filt.to_sql() == ("objekttypenavn IN ('Ku''lvert', 'Veikant') AND "
+                             "objekttypenavn NOT IN ('Bygning') AND \"medium\" = 'T'")
+    assert sosi_filter.FeatureFilter(exclude=['Bygning', 'Bru']).to_sql() == \
+        "objekttypenavn NOT IN ('Bru', 'Bygning')"
+    assert sosi_filter.FeatureFilter.from_text(include='Veikant').to_sql() == "objekttypenavn IN ('Veikant')"
+
+
+def test_predicate_matches():
+    attrs = {'HØYDE': '120.5', 'MEDIUM': 'T'}
+    assert sosi_filter.Predicate.parse('HØYDE>100').matches(attrs)
+    assert not sosi_filter.Predicate.parse('høyde<=100').matches(attrs)
+    assert sosi_filter.Predicate.parse('MEDIUM!=L').matches(attrs)
+    # A missing attribute only matches '!='
+    assert not sosi_filter.Predicate.parse('KOMM=301').matches(attrs)
+    assert sosi_filter.Predicate.parse('KOMM!=301').matches(attrs)
@@ -0,0 +1,69 @@
+import shutil
+
+import pytest
+
+from conftest import SOME_BORDERS
+from sosi_files_importer import sosi_core
+from sosi_files_importer import sosi_parallel
+from sosi_files_importer import sosi_stats as sostats
+
+
+@pytest.fixture(scope='module')
+def files(synthetic_sos, tmp_path_factory):
+    """Files of different sizes, so the workers finish out of order."""
+    folder = tmp_path_factory.mktemp('parallel')
+    paths = []
+    for i, src in enumerate([synthetic_sos, SOME_BORDERS, synthetic_sos, SOME_BORDERS]):
+        dst = folder / '{}_{}'.format(i, src.rsplit('/', 1)[-1])
+        shutil.copyfile(src, dst)
+        paths.append(str(dst))
+    return paths
+
+
+def summary(results):
+    """The path and the features of each (path, list[MeshData])."""
+    return [(path, [(m.serials.tolist(), m.names, m.coords.tolist(), m.vert_offsets.tolist(),
+                     m.hashes.tolist()) for m in mdatas])
+            for path, mdatas in results]
+
+
+def test_workers_like_one(files):
+    one = summary(sosi_core.read_files(files, workers=1))
+    assert [path for path, _ in one] == files
+    assert summary(sosi_core.read_files(files, workers=2)) == one
+
+
+def test_worker_stats_merged(files):
+    sostats.enable()
+    try:
+        list(sosi_core.read_files(files, workers=1))
+    finally:
+        one = sostats.disable()
+    sostats.enable()
+    try:
+        list(sosi_core.read_files(files, workers=2))
+    finally:
+        two = sostats.disable()
+    assert two.counters == one.counters
+    assert two.counters["files"] == len(files)
+    assert two.types == one.types
+    assert {k: v[0] for k, v in two.stages.items()} == {k: v[0] for k, v in one.stages.items()}
+
+
+def test_broken_pool_reads_the_rest(files, monkeypatch):
+    # The pool delivers the first two files, then breaks
+    read_file = sosi_core.read_file
+
+    def parse_files_parallel(file_paths, *args):
+        for path in file_paths[:2]:
+            yield path, read_file(path)
+        raise sosi_parallel.BrokenProcessPool('worker killed')
+
+    monkeypatch.setattr(sosi_parallel, 'parse_files_parallel', parse_files_parallel)
+    read = []
+    monkeypatch.setattr(sosi_core, 'read_file', lambda path, *args: read.append(path) or read_file(path, *args))
+    expected = summary(sosi_core.read_files(files, workers=1))
+    read.clear()
+    assert summary(sosi_core.read_files(files, workers=2)) == expected
+    # Only the files not yielded yet are parsed again
+    assert read == files[2:]
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+
+from conftest import SOME_BORDERS, SYNTHETIC_COUNTS
+from sosi_files_importer import sosi_cache
+from sosi_files_importer import sosi_datahelper as sodhlp
+from sosi_files_importer import sosi_filter
+
+ids = sodhlp.SosiObjId
+
+
+def read(path, cache=None, bbox=None, filt=None):
+    return sodhlp.FeatureBatch.concat(sosi_cache.read_batches(path, 'NATIVE', cache, bbox, filt))
+
+
+def feature_bbox(batch, i):
+    xy = batch.feature_coords(i)[:, :2]
+    return xy.min(axis=0), xy.max(axis=0)
+
+
+def test_native_some_borders():
+    batch = read(SOME_BORDERS)
+    assert batch.obj_ids.tolist() == [ids.KURVE.value, ids.BUEP.value, ids.KURVE.value,
+                                      ids.KURVE.value, ids.BUEP.value]
+    assert batch.serials.tolist() == [1, 2, 3, 4, 5]
+    assert batch.names[:4] == ['Teiggrense'] * 3 + ['Fasadeliv']
+    assert np.diff(batch.offsets).tolist() == [2, 3, 7, 3, 3]
+    # First point, see SomeBorders_ref.txt
+    assert batch.coords[0].tolist() == pytest.approx([579843.71, 6635218.06, 0.0])
+
+
+def test_native_synthetic(synthetic_sos):
+    batch = read(synthetic_sos)
+    counts = {i: int((batch.obj_ids == i.value).sum()) for i in ids}
+    # Each surface adds its exterior ring and 2 holes as KURVE
+    assert counts[ids.PUNKT] == SYNTHETIC_COUNTS['PUNKT']
+    assert counts[ids.KURVE] == SYNTHETIC_COUNTS['KURVE'] + 3 * SYNTHETIC_COUNTS['FLATE']
+    assert counts[ids.BUEP] == SYNTHETIC_COUNTS['BUEP']
+    assert counts[ids.FLATE] == SYNTHETIC_COUNTS['FLATE']
+    flate = np.flatnonzero(batch.obj_ids == ids.FLATE.value)
+    for i in flate:
+        parts, holes = batch.feature_parts(i)
+        assert holes.tolist() == [False, True, True]
+    assert 'MEDIUM' in batch.attrs.columns
+
+
+def assert_same_batches(a, b):
+    assert a.obj_ids.tolist() == b.obj_ids.tolist()
+    assert a.serials.tolist() == b.serials.tolist()
+    assert a.names == b.names
+    assert np.array_equal(a.coords, b.coords)
+    assert np.array_equal(a.offsets, b.offsets)
+    assert np.array_equal(a.part_offsets, b.part_offsets)
+    assert np.array_equal(a.holes, b.holes)
+    assert np.array_equal(a.hashes(), b.hashes())
+
+
+def test_cache_gives_same_features(synthetic_sos, tmp_path):
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    direct = read(synthetic_sos)
+    stored = read(synthetic_sos, cache)
+    assert len(cache.entries()) == 1
+    assert_same_batches(direct, stored)
+    # The second read comes from the entry
+    assert cache.load(synthetic_sos, 'NATIVE') is not None
+    assert_same_batches(direct, read(synthetic_sos, cache))
+
+
+def test_filter_counts(synthetic_sos, tmp_path):
+    everything = read(synthetic_sos)
+    filt = sosi_filter.FeatureFilter.from_text(include='Bygning, Bue')
+    expected = sum(name in ('Bygning', 'Bue') for name in everything.names)
+    parsed = read(synthetic_sos, filt=filt)
+    assert len(parsed) == expected
+    assert set(parsed.names) == {'Bygning', 'Bue'}
+    # Surfaces keep the rings of their excluded curves
+    flate = np.flatnonzero(parsed.obj_ids == ids.FLATE.value)
+    assert (np.diff(parsed.offsets)[flate] > 0).all()
+    # Same features through the cache
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    read(synthetic_sos, cache)
+    assert_same_batches(parsed, read(synthetic_sos, cache, filt=filt))
+
+    filt = sosi_filter.FeatureFilter.from_text(exclude='Avgrensning', predicates='MEDIUM=T')
+    parsed = read(synthetic_sos, filt=filt)
+    medium = everything.attrs.columns['MEDIUM']
+    expected = [i for i in range(len(everything))
+                if everything.names[i] != 'Avgrensning'
+                and everything.attrs.enums['MEDIUM'][medium[i]] == 'T']
+    assert expected
+    assert parsed.serials.tolist() == everything.serials[expected].tolist()
+
+    # Fasadeliv has no HØYDE
+    filt = sosi_filter.FeatureFilter.from_text(exclude='Bue', predicates='HØYDE=0')
+    assert read(SOME_BORDERS, filt=filt).serials.tolist() == [1, 2, 3]
+
+
+@pytest.mark.parametrize('predicates', ['KVALITET.NØYAKTIGHET<50', 'KVALITET.DATAFANGSTMETODE=dig, KOMM>302'])
+def test_predicates_same_through_cache(synthetic_sos, tmp_path, predicates):
+    # Sub-attributes are compared as the cache stores them
+    everything = read(synthetic_sos)
+    filt = sosi_filter.FeatureFilter.from_text(predicates=predicates)
+    expected = [i for i in range(len(everything)) if filt.accepts(everything.names[i], everything.attrs.row(i))]
+    assert 0 < len(expected) < len(everything)
+    parsed = read(synthetic_sos, filt=filt)
+    assert parsed.serials.tolist() == everything.serials[expected].tolist()
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    read(synthetic_sos, cache)
+    assert read(synthetic_sos, cache, filt=filt).serials.tolist() == parsed.serials.tolist()
+
+def test_bbox_counts(synthetic_sos, tmp_path):
+    everything = read(synthetic_sos)
+    lo, hi = everything.coords[:, :2].min(axis=0), everything.coords[:, :2].max(axis=0)
+    mid = (lo + hi) / 2
+    bbox = (lo[0], lo[1], mid[0], mid[1])
+    expected = []
+    for i in range(len(everything)):
+        fmin, fmax = feature_bbox(everything, i)
+        if fmin[0] <= bbox[2] and fmax[0] >= bbox[0] and fmin[1] <= bbox[3] and fmax[1] >= bbox[1]:
+            expected.append(int(everything.serials[i]))
+    assert 0 < len(expected) < len(everything)
+    assert read(synthetic_sos, bbox=bbox).serials.tolist() == expected
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    read(synthetic_sos, cache)
+    assert read(synthetic_sos, cache, bbox=bbox).serials.tolist() == expected
+    # Outside the header extent the file is not read
+    assert sosi_cache.read_batches(synthetic_sos, 'NATIVE', bbox=(0, 0, 10, 10)) == []
+
+
+def test_unreadable_file_not_cached(tmp_path):
+    cache = sosi_cache.FeatureCache(str(tmp_path / 'cache'))
+    folder = tmp_path / 'folder.sos'
+    folder.mkdir()
+    assert sosi_cache.read_batches(str(folder), 'NATIVE', cache) == []
+    assert cache.entries() == []
+
+
+@pytest.mark.parametrize('damage', [lambda data: data[:len(data) // 2], lambda data: b'', lambda data: b'x' * 100],
+                         ids=['truncated', 'empty', 'garbage'])
+def test_corrupt_cache_entry_removed(synthetic_sos, tmp_path, damage):
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    direct = read(synthetic_sos, cache)
+    entry = cache.entry_path(synthetic_sos, 'NATIVE')
+    with open(entry, 'rb') as f:
+        data = f.read()
+    with open(entry, 'wb') as f:
+        f.write(damage(data))
+    assert cache.load(synthetic_sos, 'NATIVE') is None
+    assert cache.entries() == []
+    # Parsed and stored again
+    assert_same_batches(direct, read(synthetic_sos, cache))
+    assert cache.load(synthetic_sos, 'NATIVE') is not None
+
+
+def test_failed_store_leaves_no_file(synthetic_sos, tmp_path, monkeypatch):
+    def savez(f, **arrays):
+        f.write(b'partial')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(sosi_cache.np, 'savez', savez)
+    cache = sosi_cache.FeatureCache(str(tmp_path))
+    assert len(read(synthetic_sos, cache)) > 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from sosi_files_importer import sosi_datahelper as sodhlp
+from sosi_files_importer import sosi_geom_helper as sogeom
+
+METHODS = sorted(sogeom.SIMPLIFY_METHODS)
+
+
+def random_lines(seed, n_lines=50):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(3, 80, n_lines)
+    coords = np.cumsum(rng.normal(0, 1, (counts.sum(), 3)), axis=0)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return coords, offsets
+
+
+def segment_dist2(p, a, b):
+    ab = b - a
+    l2 = ab @ ab
+    t = 0.0 if l2 == 0 else min(max((p - a) @ ab / l2, 0.0), 1.0)
+    d = p - a - t * ab
+    return d @ d
+
+
+def area2(a, b, c):
+    cr = np.cross(b - a, c - a)
+    return cr @ cr
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_end_points_kept(method):
+    coords, offsets = random_lines(1)
+    keep = sogeom.SIMPLIFY_METHODS[method](coords, offsets, 2.0)
+    assert keep[offsets[:-1]].all() and keep[offsets[1:] - 1].all()
+    assert keep.sum() < len(coords)
+
+
+def test_douglas_peucker_within_tolerance():
+    coords, offsets = random_lines(2)
+    tol = 1.5
+    keep = sogeom.douglas_peucker(coords, offsets, tol)
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        kept = lo + np.flatnonzero(keep[lo:hi])
+        for s, e in zip(kept[:-1], kept[1:]):
+            for i in range(s + 1, e):
+                assert segment_dist2(coords[i], coords[s], coords[e]) <= tol * tol
+
+
+@pytest.mark.parametrize('rounds', [sogeom.VISVALINGAM_ROUNDS, 0])
+def test_visvalingam_done(monkeypatch, rounds):
+    # With the heap fallback right away too, no vertex left has an area
+    # below the tolerance
+    monkeypatch.setattr(sogeom, 'VISVALINGAM_ROUNDS', rounds)
+    coords, offsets = random_lines(3)
+    tol = 1.0
+    keep = sogeom.visvalingam(coords, offsets, tol)
+    assert keep[offsets[:-1]].all() and keep[offsets[1:] - 1].all()
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        kept = coords[lo + np.flatnonzero(keep[lo:hi])]
+        for a, b, c in zip(kept[:-2], kept[1:-1], kept[2:]):
+            assert area2(a, b, c) >= 4 * tol ** 4
+
+
+def test_visvalingam_heap_matches_rounds(monkeypatch):
+    # Areas growing along a line: one vertex per vectorised round
+    x = np.arange(300.0)
+    coords = np.column_stack((x, 1e-6 * x ** 3, np.zeros_like(x)))
+    offsets = np.array([0, len(x)])
+    monkeypatch.setattr(sogeom, 'VISVALINGAM_ROUNDS', 10 ** 6)
+    rounds = sogeom.visvalingam(coords, offsets, 1.0)
+    monkeypatch.setattr(sogeom, 'VISVALINGAM_ROUNDS', 0)
+    heap = sogeom.visvalingam(coords, offsets, 1.0)
+    assert (rounds == heap).all()
+
+
+def test_visvalingam_worst_case_bounded(monkeypatch):
+    # Areas growing along the line need one round per vertex: after
+    # VISVALINGAM_ROUNDS the line is finished by the heap, once
+    x = np.arange(5000.0)
+    coords = np.column_stack((x, 1e-6 * x ** 3, np.zeros_like(x)))
+    calls = []
+    heap_line = sogeom._visvalingam_line
+    monkeypatch.setattr(sogeom, '_visvalingam_line', lambda *args: calls.append(1) or heap_line(*args))
+    keep = sogeom.visvalingam(coords, np.array([0, len(x)]), 50.0)
+    assert len(calls) == 1
+    assert keep[0] and keep[-1] and keep.sum() < 100
+
+
+def test_simplify_multi_part_line():
+    # Two parts of one KURVE, as GDAL reads a MULTILINESTRING
+    coords = np.array([[0, 0, 0], [10, 0.05, 0], [20, 0, 0],
+                       [25, 0, 0], [30, 0.05, 0], [40, 0, 0]], dtype=float)
+    batch = sodhlp.FeatureBatch('multi.sos', np.array([sodhlp.SosiObjId.KURVE.value]), np.array([1]),
+                                ['Veikant'], coords, np.array([0, 6]), np.array([0, 3, 6]),
+                                np.array([0, 2]), np.zeros(2, dtype=bool))
+    for method in METHODS:
+        res = sogeom.simplify_batch(batch, 1.0, method)
+        assert res.part_offsets.tolist() == [0, 2, 4]
+        assert res.coords.tolist() == coords[[0, 2, 3, 5]].tolist()
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_closed_rings_stay_rings(method):
+    # Small rings, simplified away completely without the ring check
+    rings = []
+    for i in range(10):
+        t = np.linspace(0, 2 * np.pi, 12 + i)
+        ring = np.column_stack((np.cos(t) * (i + 1) * 0.1, np.sin(t) * 0.1, np.zeros_like(t)))
+        ring[-1] = ring[0]
+        rings.append(ring + i * 10)
+    coords = np.vstack(rings)
+    offsets = np.concatenate(([0], np.cumsum([len(r) for r in rings])))
+    keep = sogeom.SIMPLIFY_METHODS[method](coords, offsets, 5.0)
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        kept = coords[lo + np.flatnonzero(keep[lo:hi])]
+        assert len(kept) >= 4
+        assert (kept[0] == kept[-1]).all()
+        assert len(np.unique(kept, axis=0)) >= 3
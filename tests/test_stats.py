@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+from sosi_files_importer import sosi_stats as sostats
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc/self/fd')
+def test_current_rss_keeps_no_descriptor():
+    before = len(os.listdir('/proc/self/fd'))
+    assert sostats.current_rss() > 0
+    assert sostats.current_rss() > 0
+    assert len(os.listdir('/proc/self/fd')) == before
+
+
+def test_stage_timers():
+    stats = sostats.enable(trace_rss=True)
+    try:
+        with sostats.timer('stage'):
+            pass
+        sostats.incr('files', 2)
+    finally:
+        assert sostats.disable() is stats
+    assert sostats.active() is None
+    assert 'stage' in stats.summary()
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from bench_triangulate import make_surface
+from sosi_files_importer import sosi_geom_helper as sogeom
+from sosi_files_importer import sosi_triangulate as sotri
+
+
+def tri_areas(coords, tris):
+    p = coords[tris]
+    return 0.5 * ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1])
+                  - (p[:, 1, 1] - p[:, 0, 1]) * (p[:, 2, 0] - p[:, 0, 0]))
+
+
+# Small cases take the plain Python ear clip, the others the NumPy one
+@pytest.mark.parametrize('nverts, nholes, hole_verts', [
+    (12, 1, 4), (20, 4, 6), (30, 2, 8), (1000, 10, 16), (2000, 100, 8)])
+def test_holed_polygon(nverts, nholes, hole_verts):
+    coords, offsets, area = make_surface(nverts, nholes, hole_verts)
+    tris = sotri.polygon_triangulate(coords, offsets)
+    assert len(tris) == len(coords) + 2 * nholes - 2
+    areas = tri_areas(coords, tris)
+    assert areas.min() > 0
+    assert np.isclose(areas.sum(), area)
+
+
+def test_ring_orientation_ignored():
+    coords, offsets, area = make_surface(12, 1, 4)
+    # Clockwise exterior ring, counter clockwise hole
+    rings = [coords[offsets[i]:offsets[i + 1]][::-1] for i in range(len(offsets) - 1)]
+    tris = sotri.polygon_triangulate(np.concatenate(rings), offsets)
+    areas = tri_areas(np.concatenate(rings), tris)
+    assert len(tris) == 16
+    assert areas.min() > 0
+    assert np.isclose(areas.sum(), area)
+
+
+def test_small_and_large_paths_agree(monkeypatch):
+    coords, offsets, area = make_surface(30, 2, 8)
+    small = sotri.polygon_triangulate(coords, offsets)
+    monkeypatch.setattr(sotri, 'SMALL_RING', 0)
+    large = sotri.polygon_triangulate(coords, offsets)
+    assert len(small) == len(large)
+    assert np.isclose(tri_areas(coords, small).sum(), tri_areas(coords, large).sum())
+
+
+def test_polygon_mesh_data():
+    coords, offsets, area = make_surface(20, 4, 6)
+    # Closed rings, as read from the file, followed by a second polygon without holes
+    rings = [np.vstack((coords[offsets[i]:offsets[i + 1]], coords[offsets[i]:offsets[i] + 1]))
+             for i in range(len(offsets) - 1)]
+    square = np.array([[2000.0, 0, 0], [2010, 0, 0], [2010, 10, 0], [2000, 10, 0], [2000, 0, 0]])
+    rings.append(square)
+    parts = np.concatenate(([0], np.cumsum([len(r) for r in rings])))
+    holes = [False] + [True] * 4 + [False]
+    verts, edges, faces = sogeom.polygon_mesh_data(np.concatenate(rings), parts, holes)
+    assert edges is None
+    assert len(verts) == len(coords) + 4
+    ngons = [f for f in faces if len(f) == 4]
+    assert len(ngons) == 1
+    tris = np.array([f for f in faces if len(f) == 3])
+    assert len(tris) == len(coords) + 2 * 4 - 2
+    assert np.isclose(tri_areas(verts, tris).sum(), area)
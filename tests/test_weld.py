@@ -0,0 +1,47 @@
+import numpy as np
+
+from sosi_files_importer import sosi_geom_helper as sogeom
+
+
+def test_weld_straddling_cell_edges():
+    # Each pair straddles a line of a grid of cell size tolerance, the
+    # first one also of the grid shifted by half a cell
+    coords = np.array([[0.9997, 0.4994, 0], [1.0003, 0.4996, 0],
+                       [5.0, 2.9999, 1], [5.0, 3.0001, 1]])
+    welded, inverse = sogeom.weld_vertices(coords, 0.001)
+    assert len(welded) == 2
+    assert inverse.tolist() == [0, 0, 1, 1]
+    # Kept vertices keep their coordinates
+    assert (welded == coords[[0, 2]]).all()
+
+
+def test_weld_no_chaining():
+    coords = np.array([[0.0, 0, 0], [0.6, 0, 0], [1.2, 0, 0], [1.8, 0, 0]])
+    welded, inverse = sogeom.weld_vertices(coords, 1.0)
+    assert inverse.tolist() == [0, 0, 1, 1]
+    assert (welded == coords[[0, 2]]).all()
+
+
+def test_weld_invariants():
+    rng = np.random.default_rng(0)
+    pts = rng.random((2000, 3)) * 10
+    coords = np.vstack((pts, pts + rng.normal(0, 0.01, pts.shape), pts[:500]))
+    tol = 0.03
+    welded, inverse = sogeom.weld_vertices(coords, tol)
+    assert np.linalg.norm(coords - welded[inverse], axis=1).max() <= tol
+    dist = np.linalg.norm(welded[:, None] - welded[None], axis=2)
+    np.fill_diagonal(dist, np.inf)
+    assert dist.min() > tol
+    # Exact copies always go to the same vertex
+    assert (inverse[-500:] == inverse[:500]).all()
+
+
+def test_weld_mesh_arrays_drops_collapsed():
+    coords = np.array([[0.0, 0, 0], [1, 0, 0], [1.0001, 0, 0], [1, 1, 0]])
+    edges = [0, 1, 1, 2, 2, 3]
+    loops = [0, 1, 2, 3]
+    coords, edges, loops, starts = sogeom.weld_mesh_arrays(coords, edges, loops, [0], 0.001)
+    assert len(coords) == 3
+    assert edges.tolist() == [[0, 1], [1, 2]]
+    assert loops.tolist() == [0, 1, 2]
+    assert starts.tolist() == [0]
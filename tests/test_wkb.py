@@ -0,0 +1,105 @@
+import struct
+
+import pytest
+
+from sosi_files_importer import sosi_wkb as sowkb
+
+
+def header(gtype, ndims, count=None):
+    code = gtype + {2: 0, 3: 1000, 4: 3000}[ndims]
+    return struct.pack('<BI', 1, code) + (b'' if count is None else struct.pack('<I', count))
+
+
+def points(pts):
+    return b''.join(struct.pack('<{}d'.format(len(p)), *p) for p in pts)
+
+
+def point(p):
+    return header(sowkb.WKB_POINT, len(p)) + points([p])
+
+
+def linestring(pts):
+    return header(sowkb.WKB_LINESTRING, len(pts[0]), len(pts)) + points(pts)
+
+
+def polygon(rings):
+    return (header(sowkb.WKB_POLYGON, len(rings[0][0]), len(rings))
+            + b''.join(struct.pack('<I', len(r)) + points(r) for r in rings))
+
+
+def multi(gtype, geoms, ndims):
+    return header(gtype, ndims, len(geoms)) + b''.join(geoms)
+
+
+def xyz(pts):
+    """pts as (n, 3), Z 0 for 2D points and without M."""
+    return [(p[0], p[1], p[2] if len(p) > 2 else 0.0) for p in pts]
+
+
+LINE = [(600000.5, 6600000.25, 10.0), (600010.0, 6600005.0, 12.5), (600020.0, 6600000.0, 11.0)]
+EXTERIOR = [(0, 0, 1), (10, 0, 1), (10, 10, 1), (0, 10, 1), (0, 0, 1)]
+HOLE = [(2, 2, 1), (2, 4, 1), (4, 4, 1), (2, 2, 1)]
+
+
+def dims(pts, ndims):
+    return [p[:2] if ndims == 2 else p + (7.0,) * (ndims - 3) for p in pts]
+
+
+@pytest.mark.parametrize('ndims', [2, 3, 4])
+def test_point_and_line(ndims):
+    coords, parts, holes = sowkb.wkb_coords(point(dims(LINE, ndims)[0]))
+    assert coords.tolist() == [list(p) for p in xyz(dims(LINE, ndims)[:1])]
+    assert parts is None and holes is None
+    coords, parts, holes = sowkb.wkb_coords(linestring(dims(LINE, ndims)))
+    assert coords.tolist() == [list(p) for p in xyz(dims(LINE, ndims))]
+    assert parts is None and holes is None
+
+
+@pytest.mark.parametrize('ndims', [2, 3, 4])
+def test_polygon_with_hole(ndims):
+    rings = [dims(EXTERIOR, ndims), dims(HOLE, ndims)]
+    coords, parts, holes = sowkb.wkb_coords(polygon(rings))
+    assert coords.tolist() == [list(p) for p in xyz(rings[0] + rings[1])]
+    assert parts.tolist() == [0, 5, 9]
+    assert holes.tolist() == [False, True]
+
+
+@pytest.mark.parametrize('ndims', [2, 3, 4])
+def test_multi_linestring(ndims):
+    lines = [dims(LINE, ndims), dims(LINE[:2], ndims)]
+    coords, parts, holes = sowkb.wkb_coords(
+        multi(sowkb.WKB_MULTILINESTRING, [linestring(l) for l in lines], ndims))
+    assert coords.tolist() == [list(p) for p in xyz(lines[0] + lines[1])]
+    assert parts.tolist() == [0, 3, 5]
+    assert holes.tolist() == [False, False]
+
+
+@pytest.mark.parametrize('ndims', [2, 3, 4])
+def test_multi_polygon(ndims):
+    first = [dims(EXTERIOR, ndims), dims(HOLE, ndims)]
+    second = [dims([(20, 0, 2), (30, 0, 2), (30, 10, 2), (20, 0, 2)], ndims)]
+    coords, parts, holes = sowkb.wkb_coords(
+        multi(sowkb.WKB_MULTIPOLYGON, [polygon(first), polygon(second)], ndims))
+    assert coords.tolist() == [list(p) for p in xyz(first[0] + first[1] + second[0])]
+    assert parts.tolist() == [0, 5, 9, 13]
+    assert holes.tolist() == [False, True, False]
+
+
+def test_multi_point():
+    pts = [(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)]
+    coords, parts, holes = sowkb.wkb_coords(multi(sowkb.WKB_MULTIPOINT, [point(p) for p in pts], 3))
+    assert coords.tolist() == [list(p) for p in pts]
+    assert parts is None and holes is None
+
+
+def test_xyz_not_copied():
+    wkb = linestring(LINE)
+    coords = sowkb.wkb_coords(wkb)[0]
+    assert not coords.flags.owndata and coords.base is not None
+
+
+def test_unsupported_type():
+    with pytest.raises(ValueError):
+        sowkb.wkb_coords(struct.pack('<BII', 1, 1007, 0))
+    with pytest.raises(ValueError):
+        sowkb.wkb_coords(struct.pack('<BII', 1, 4002, 0))